@@ -0,0 +1,266 @@
+from gym_minigrid.minigrid import Wall, OBJECT_TO_IDX, STATE_TO_IDX
+import itertools
+import numpy as np
+
+from vis_mask_grid import VisMaskGrid
+
+EMPTY_ENCODING = (OBJECT_TO_IDX['empty'], 0, 0)
+WALL_ENCODING = Wall().encode()
+WALL = OBJECT_TO_IDX['wall']
+DOOR = OBJECT_TO_IDX['door']
+STATE_OPEN = STATE_TO_IDX['open']
+# Widest grid for which process_vis() uses a lookup table (of 2 ** (2 * width) entries)
+MAX_VIS_TABLE_WIDTH = 8
+# Version numbers of grid (and env) states, which are never reused so they can key caches of anything computed from
+# a state
+VERSIONS = itertools.count()
+
+
+class ArrayGrid(VisMaskGrid):
+    """
+    Grid whose cells are kept in a (width, height) object array, along with their encoding in a (width, height, 3)
+    uint8 array updated by set(), so that encode(), slice(), rotate_left() and process_vis() are array operations
+    instead of loops over the cells. The `grid` list of the cells (row by row, as in Grid) is built on access.
+
+    Doors are the only objects whose encoding changes without a call to set() (when they are opened or unlocked), so
+    the cells holding doors are re-encoded by sync() before the array is read. For the same reason, `version`, which
+    changes whenever a cell is set, doesn't account for doors being opened. Objects changed otherwise after being set
+    (e.g. recolored while generating the mission) need a call to refresh().
+    """
+
+    # Visibility lookup tables of process_vis(), by grid width
+    vis_tables = {}
+
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        self.array = np.empty((width, height, 3), dtype=np.uint8)
+        self.array[:] = EMPTY_ENCODING
+        # (i, j) -> Door, for the cells holding a door
+        self.doors = {}
+
+    @property
+    def grid(self):
+        return self.objects.T.ravel().tolist()
+
+    @grid.setter
+    def grid(self, cells):
+        objects = np.empty(len(cells), dtype=object)
+        objects[:] = cells
+        self.objects = objects.reshape(self.height, self.width).T
+        self.version = next(VERSIONS)
+
+    def __setstate__(self, state):
+        # Versions come from a per-process counter, so an unpickled grid draws a new one from this process's counter
+        self.__dict__.update(state)
+        self.version = next(VERSIONS)
+
+    @classmethod
+    def from_grid(cls, grid):
+        """
+        Copy a Grid (the objects are shared, not copied)
+        """
+        array_grid = cls(grid.width, grid.height)
+        for index, v in enumerate(grid.grid):
+            if v is not None:
+                array_grid.set(index % grid.width, index // grid.width, v)
+        return array_grid
+
+    @classmethod
+    def from_arrays(cls, objects, array):
+        """
+        Build a grid from a (width, height) object array of cells and the matching encoding array, without copying.
+        """
+        grid = cls.__new__(cls)
+        grid.width, grid.height = objects.shape
+        grid.objects = objects
+        grid.version = next(VERSIONS)
+        grid.array = array
+        grid.doors = {(i, j): objects[i, j] for i, j in zip(*np.nonzero(array[..., 0] == DOOR))}
+        return grid
+
+    def set(self, i, j, v):
+        assert i >= 0 and i < self.width
+        assert j >= 0 and j < self.height
+        self.objects[i, j] = v
+        self.version = next(VERSIONS)
+        self.array[i, j] = EMPTY_ENCODING if v is None else v.encode()
+        if v is not None and v.type == 'door':
+            self.doors[(i, j)] = v
+        else:
+            self.doors.pop((i, j), None)
+
+    def get(self, i, j):
+        assert i >= 0 and i < self.width
+        assert j >= 0 and j < self.height
+        return self.objects[i, j]
+
+    def sync(self):
+        for (i, j), door in self.doors.items():
+            self.array[i, j] = door.encode()
+
+    def refresh(self):
+        """
+        Re-encode all the cells, for objects changed after they were set (e.g. recolored by the mission generation)
+        """
+        for (i, j), v in np.ndenumerate(self.objects):
+            self.array[i, j] = EMPTY_ENCODING if v is None else v.encode()
+        self.version = next(VERSIONS)
+
+    def encode(self, vis_mask=None):
+        """
+        Produce a compact numpy encoding of the grid
+        """
+        self.sync()
+        if vis_mask is None:
+            return self.array.copy()
+        return self.array * vis_mask[..., None]
+
+    def slice(self, topX, topY, width, height):
+        """
+        Get a subset of the grid. Cells outside of the grid are walls.
+        """
+        self.sync()
+        array = np.empty((width, height, 3), dtype=np.uint8)
+        array[:] = WALL_ENCODING
+        objects = np.empty((width, height), dtype=object)
+        objects[:] = Wall()
+        x0, y0 = max(topX, 0), max(topY, 0)
+        x1, y1 = min(topX + width, self.width), min(topY + height, self.height)
+        if x0 < x1 and y0 < y1:
+            array[x0 - topX:x1 - topX, y0 - topY:y1 - topY] = self.array[x0:x1, y0:y1]
+            objects[x0 - topX:x1 - topX, y0 - topY:y1 - topY] = self.objects[x0:x1, y0:y1]
+        return ArrayGrid.from_arrays(objects, array)
+
+    def rotate_left(self, k=1):
+        """
+        Rotate the grid to the left (counter-clockwise), k times
+        """
+        self.sync()
+        return ArrayGrid.from_arrays(np.rot90(self.objects, -k).copy(), np.rot90(self.array, -k).copy())
+
+    @staticmethod
+    def spread_vis(mask, see):
+        """
+        One row of Grid.process_vis(): the visible cells spread to the right, then to the left, until a cell which
+        can't be seen through, and from there to the row above. Works on any number of rows at once.
+        :param mask: (..., width) bool array of the visible cells of the rows
+        :param see: (..., width) bool array of the cells which can be seen through
+        :return: (visible cells of the rows, cells of the rows above which become visible)
+        """
+        blocked = (~see).astype(np.int64)
+        zeros = np.zeros(blocked.shape[:-1] + (1,), dtype=np.int64)
+        # Number of blockers strictly to the left/right of each cell. A cell is reached from a visible cell if there
+        # is no blocker in between (including the visible cell itself), i.e. if their counts are the same.
+        blockers_left = np.concatenate([zeros, np.cumsum(blocked, axis=-1)[..., :-1]], axis=-1)
+        blockers_right = np.concatenate([np.cumsum(blocked[..., ::-1], axis=-1)[..., ::-1][..., 1:], zeros], axis=-1)
+        right = np.maximum.accumulate(np.where(mask, blockers_left, -1), axis=-1) == blockers_left
+        left = np.maximum.accumulate(np.where(right, blockers_right, -1)[..., ::-1], axis=-1)[..., ::-1] == \
+            blockers_right
+        spread_right = right & see
+        spread_right[..., -1] = False
+        spread_left = left & see
+        spread_left[..., 0] = False
+        above = spread_right | spread_left
+        above[..., 1:] |= spread_right[..., :-1]
+        above[..., :-1] |= spread_left[..., 1:]
+        return left, above
+
+    @classmethod
+    def vis_table(cls, width):
+        """
+        Lookup table of spread_vis() for rows of the given width, indexed by the bits of the visible cells followed
+        by the bits of the cells which can be seen through. Each entry holds the bits of the visible cells, followed
+        by the bits of the cells of the row above which become visible.
+        """
+        if width not in cls.vis_tables:
+            bits = 1 << np.arange(width)
+            codes = np.arange(1 << (2 * width))[:, None]
+            mask, above = cls.spread_vis((codes >> width) & bits > 0, codes & bits > 0)
+            cls.vis_tables[width] = ((mask @ bits) << width | (above @ bits)).tolist()
+        return cls.vis_tables[width]
+
+    def process_vis(grid, agent_pos):
+        """
+        Same as Grid.process_vis(), but each row is processed with one lookup in vis_table() (or, for grids wider
+        than MAX_VIS_TABLE_WIDTH, with array operations).
+        """
+        grid.sync()
+        types, states = grid.array[..., 0], grid.array[..., 2]
+        see_behind = (types != WALL) & ~((types == DOOR) & (states != STATE_OPEN))
+
+        if grid.width <= MAX_VIS_TABLE_WIDTH:
+            table = grid.vis_table(grid.width)
+            bits = 1 << np.arange(grid.width)
+            see_bits = (see_behind.T @ bits).tolist()
+            mask_bits = [0] * grid.height
+            mask_bits[agent_pos[1]] = 1 << agent_pos[0]
+            for j in reversed(range(0, grid.height)):
+                entry = table[mask_bits[j] << grid.width | see_bits[j]]
+                mask_bits[j] = entry >> grid.width
+                if j > 0:
+                    mask_bits[j - 1] |= entry & ((1 << grid.width) - 1)
+            mask = (np.array(mask_bits)[None, :] & bits[:, None]) > 0
+        else:
+            mask = np.zeros(shape=(grid.width, grid.height), dtype=bool)
+            mask[agent_pos[0], agent_pos[1]] = True
+            for j in reversed(range(0, grid.height)):
+                mask[:, j], above = grid.spread_vis(mask[:, j], see_behind[:, j])
+                if j > 0:
+                    mask[:, j - 1] |= above
+
+        # Forget what is not visible
+        grid.objects[~mask] = None
+        grid.array[~mask] = EMPTY_ENCODING
+        grid.doors = {pos: door for pos, door in grid.doors.items() if mask[pos]}
+        return mask
+
+
+def test(num_steps=200):
+    """
+    Check ArrayGrid against Grid on the cells, the agent's view and the visibility of seeded levels, as they change
+    under random actions
+    """
+    import random
+    from gym_minigrid.minigrid import Grid
+    from babyai.levels.iclr19_levels import Level_GoToRedBallGrey, Level_PickupLocalS5N2, Level_OpenLocalS5N2, \
+        Level_GoToObjMazeS4
+
+    def plain_grid(grid):
+        plain = Grid(grid.width, grid.height)
+        plain.grid = list(grid.grid)
+        return plain
+
+    # Level_GoToObjMazeS4 is wider than MAX_VIS_TABLE_WIDTH, so process_vis() doesn't use the lookup table on its
+    # whole grid
+    for level in [Level_GoToRedBallGrey, Level_PickupLocalS5N2, Level_OpenLocalS5N2, Level_GoToObjMazeS4]:
+        print('ArrayGrid on %s' % level.__name__)
+        rng = random.Random(0)
+        env = level(seed=0)
+        env.reset()
+        if level is Level_GoToObjMazeS4:
+            assert env.grid.width > MAX_VIS_TABLE_WIDTH
+        for _ in range(num_steps):
+            assert isinstance(env.grid, ArrayGrid)
+            plain = plain_grid(env.grid)
+            assert np.array_equal(env.grid.encode(), plain.encode())
+
+            # Agent view, as computed by MiniGridEnv.gen_obs_grid()
+            topX, topY, _, _ = env.get_view_exts()
+            view = plain.slice(topX, topY, env.agent_view_size, env.agent_view_size)
+            for i in range(env.agent_dir + 1):
+                view = view.rotate_left()
+            vis_mask = view.process_vis(agent_pos=(view.width // 2, view.height - 1))
+            view.set(view.width // 2, view.height - 1, env.carrying)
+            array_view, array_vis_mask = env.gen_obs_grid()
+            assert np.array_equal(array_vis_mask, vis_mask)
+            assert np.array_equal(array_view.encode(array_vis_mask), view.encode(vis_mask))
+
+            # Visibility over the whole grid
+            full = plain_grid(env.grid)
+            array_full = ArrayGrid.from_grid(full)
+            assert np.array_equal(array_full.process_vis(env.agent_pos), full.process_vis(env.agent_pos))
+            assert np.array_equal(array_full.encode(), full.encode())
+
+            _, _, done, _ = env.step(rng.randint(0, env.action_space.n - 1))
+            if done:
+                env.reset()
@@ -169,6 +169,12 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--distillation_steps', type=int, default=15)
         self.add_argument('--buffer_capacity', type=int, default=500)
         self.add_argument('--prob_current', type=float, default=.5)
+        self.add_argument('--prefetch_batches', type=int, default=0,
+                          help="number of distillation batches to sample and preprocess ahead in a background thread "
+                               "(0 to do it on the training thread)")
+        self.add_argument('--shared_trunk_distill', action='store_true',
+                          help="when distilling to several teacher subsets, preprocess the batch and run the policy "
+                               "trunk once, and take one optimizer step on the summed loss of the subsets")
         self.add_argument('--buffer_path', type=str, default=None)
         self.add_argument('--distillation_strategy', type=str, choices=[
             'all_teachers', 'no_teachers', 'all_but_none', 'powerset', 'single_teachers', 'single_teachers_none'
@@ -191,6 +197,18 @@ class ArgumentParser(argparse.ArgumentParser):
         # Arguments we rarely change
         self.add_argument('--meta_batch_size', type=int, default=200)
         self.add_argument('--sequential', action='store_true')
+        self.add_argument('--batched_env', action='store_true',
+                          help="step all envs at once with array operations (envs without teachers only)")
+        self.add_argument('--shared_memory_env', action='store_true',
+                          help="send observations from the env workers through shared memory instead of pipes")
+        self.add_argument('--pipelined_collection', action='store_true',
+                          help="compute the actions of half the envs while the other half is stepping")
+        self.add_argument('--env0_worker', action='store_true',
+                          help="run the first env in its own worker instead of the main process")
+        self.add_argument('--task_pool_dir', type=str, default=None,
+                          help="directory of pre-generated task pools (see scripts/make_task_pools.py)")
+        self.add_argument('--warm_next_level', action='store_true',
+                          help="build the next level of the curriculum in a background process")
         self.add_argument('--max_path_length', type=float, default=float('inf'))
         self.add_argument('--gae_lambda', type=float, default=.99)
         self.add_argument('--num_envs', type=int, default=20)
@@ -2,6 +2,8 @@ from gym_minigrid.minigrid import *
 from babyai.levels.verifier import *
 from babyai.levels.verifier import (ObjDesc, pos_next_to,
                                     GoToInstr, OpenInstr, PickupInstr, PutNextInstr, BeforeInstr, AndInstr, AfterInstr)
+from babyai.planning import PathPlanner
+import copy
 import random
 
 OBJ_TYPES = ['box', 'ball', 'key', 'door']
@@ -379,30 +381,29 @@ class GoNextToSubgoal(Subgoal):
 
         # We are still far from the target
         # -> try to find a non-blocker path
-        path, _, _ = self.bot._shortest_path(
-            lambda pos, cell: pos == target_pos,
+        next_cell, _, _ = self.bot._shortest_path_to(
+            target_pos,
             plan_through_doors=self.bot.fully_observed,
         )
 
         # No non-blocker path found and
         # reexploration within the room is not allowed or there is nothing to explore
         # -> Look for blocker paths
-        if not path:
-            path, _, _ = self.bot._shortest_path(
-                lambda pos, cell: pos == target_pos,
+        if next_cell is None:
+            next_cell, _, _ = self.bot._shortest_path_to(
+                target_pos,
                 try_with_blockers=True,
                 plan_through_doors=self.bot.fully_observed,
             )
 
         # No path found
         # -> explore the world
-        if not path:
+        if next_cell is None:
             self.bot.stack.append(ExploreSubgoal(self.bot))
             return
 
         # So there is a path (blocker, or non-blockers)
         # -> try following it
-        next_cell = path[0]
 
         # Choose the action in the case when the forward cell
         # is the one we should go next to
@@ -524,6 +525,35 @@ class ExploreSubgoal(Subgoal):
         return True
 
 
+class BotSnapshot:
+    """Planning state of a `Bot`, as returned by `Bot.snapshot`.
+
+    Parameters:
+    ----------
+    attrs : dict
+        Shallow copy of the remaining bot attributes (mission, counters, previous state).
+    grid_cells : tuple
+        Cells of the mapped-out grid. The world objects themselves are shared with the bot.
+    vis_mask : np.ndarray
+        Copy of the visibility mask.
+    stack : list
+        (subgoal class, subgoal attributes) pairs, bottom of the stack first.
+    rng_state : tuple
+        State of the bot's random number generator.
+
+    """
+
+    # Attributes which are copied explicitly rather than shared
+    COPIED_ATTRS = ('grid', 'vis_mask', 'stack', 'rng')
+
+    def __init__(self, attrs, grid_cells, vis_mask, stack, rng_state):
+        self.attrs = attrs
+        self.grid_cells = grid_cells
+        self.vis_mask = vis_mask
+        self.stack = stack
+        self.rng_state = rng_state
+
+
 class Bot:
     """A bot that can solve all BabyAI levels.
 
@@ -542,10 +572,13 @@ class Bot:
     Parameters:
     ----------
     mission : a freshly created BabyAI environment
+    vis_mask : np.ndarray, optional
+        The cells of the mission already seen. The bot updates this array in place,
+        so the bots of a mission which observe the same views can share it.
 
     """
 
-    def __init__(self, mission, rng=None, fully_observed=False):
+    def __init__(self, mission, rng=None, fully_observed=False, vis_mask=None):
         # Mission to be solved
         self.mission = mission
         self.rng = rng if rng is not None else np.random.RandomState()
@@ -555,7 +588,10 @@ class Bot:
         self.grid = Grid(mission.width, mission.height)
 
         # Visibility mask. True for explored/seen, false for unexplored.
-        if fully_observed:
+        # It can be given, e.g. to share it between the bots of a mission which observe the same views.
+        if vis_mask is not None:
+            self.vis_mask = vis_mask
+        elif fully_observed:
             self.vis_mask = np.ones(shape=(mission.width, mission.height), dtype=np.bool)
         else:
             self.vis_mask = np.zeros(shape=(mission.width, mission.height), dtype=np.bool)
@@ -564,7 +600,7 @@ class Bot:
         self.stack = []
 
         # Process/parse the instructions
-        self._process_instr(mission.instrs)
+        self._plan_from_instr()
 
         # How many BFS searches this bot has performed
         self.bfs_counter = 0
@@ -574,6 +610,87 @@ class Bot:
         self.bfs_step_counter = 0
         self.step = 0
 
+    @property
+    def planner(self):
+        """Searches of paths in the mission grid, shared with the other bots of the mission"""
+        return PathPlanner.for_env(self.mission)
+
+    def snapshot(self):
+        """Capture the planning state of the bot so that it can later be rolled back with `restore`.
+
+        Only the state mutated by `replan` is copied (subgoal stack, explored map, rng and counters).
+        The mission and the grid cells are shared with the live bot.
+
+        Returns:
+        -------
+        snapshot : BotSnapshot
+
+        """
+        attrs = {k: v for k, v in self.__dict__.items() if k not in BotSnapshot.COPIED_ATTRS}
+        return BotSnapshot(attrs=attrs,
+                           grid_cells=tuple(self.grid.grid),
+                           vis_mask=self.vis_mask.copy(),
+                           stack=[(type(subgoal), dict(subgoal.__dict__)) for subgoal in self.stack],
+                           rng_state=self.rng.get_state())
+
+    def restore(self, snapshot):
+        """Roll the bot back to a state captured with `snapshot`. A snapshot can be restored several times."""
+        self.__dict__.update(snapshot.attrs)
+        if getattr(self, 'grid', None) is None:
+            self.grid = Grid(self.mission.width, self.mission.height)
+        self.grid.grid = list(snapshot.grid_cells)
+        self.vis_mask = snapshot.vis_mask.copy()
+        self.stack = []
+        for subgoal_class, subgoal_state in snapshot.stack:
+            subgoal = subgoal_class.__new__(subgoal_class)
+            subgoal.__dict__.update(subgoal_state)
+            subgoal.bot = self
+            self.stack.append(subgoal)
+        if getattr(self, 'rng', None) is None:
+            self.rng = np.random.RandomState()
+        self.rng.set_state(snapshot.rng_state)
+
+    def fork(self):
+        """Return an independent copy of the bot which plans on the same mission.
+
+        This is much cheaper than pickling the bot, since the mission is not copied. Callers which step the
+        mission with the copy should snapshot and restore the mission themselves.
+        """
+        bot = type(self).__new__(type(self))
+        bot.restore(self.snapshot())
+        return bot
+
+    def reset_plan(self):
+        """Drop the current plan and make a new one from the instructions.
+
+        The bot then plans as a newly created bot would, except that it keeps
+        what it has explored (as well as its rng, step and counters). This is
+        much cheaper than creating a new bot. Call `replan` with no action afterwards.
+
+        """
+        self._plan_from_instr()
+
+    def _plan_from_instr(self):
+        """Fill the stack with the subgoals of the instructions.
+
+        When the agent is not carrying anything, the subgoals only depend on the
+        instructions, so copies of them are kept to reset the plan without parsing again.
+
+        """
+        instrs = self.mission.instrs
+        carrying = self.mission.carrying
+        instr_subgoals = getattr(self, 'instr_subgoals', None)
+        if carrying is None and instr_subgoals is not None and instr_subgoals[0] is instrs:
+            self.stack = [copy.copy(subgoal) for subgoal in instr_subgoals[1]]
+            for subgoal in self.stack:
+                subgoal.bot = self
+                subgoal.update_agent_attributes()
+            return
+        self.stack = []
+        self._process_instr(instrs)
+        if carrying is None:
+            self.instr_subgoals = (instrs, [copy.copy(subgoal) for subgoal in self.stack])
+
     def replan(self, action_taken=None):
         """Replan and suggest an action.
 
@@ -763,12 +880,12 @@ class Bot:
                 obj_pos = obj_desc.obj_poss[i]
 
                 if self.vis_mask[obj_pos]:
-                    shortest_path_to_obj, _, with_blockers = self._shortest_path(
-                        lambda pos, cell: pos == obj_pos,
+                    _, distance_to_obj, with_blockers = self._shortest_path_to(
+                        obj_pos,
                         try_with_blockers=True,
                         plan_through_doors=self.fully_observed,
                     )
-                    if shortest_path_to_obj is None:
+                    if distance_to_obj is None:
                         print("=" * 100)
                         print("finding object", obj_desc)
                         print("position", obj_pos)
@@ -779,16 +896,8 @@ class Bot:
                         plt.show()
                         # self.mission.render('human')
                         print("???")
-                        shortest_path_to_obj, _, with_blockers = self._shortest_path(
-                            lambda pos, cell: pos == obj_pos,
-                            try_with_blockers=True,
-                            plan_through_doors=self.fully_observed,
-                        )
                         return
 
-                    assert shortest_path_to_obj is not None
-                    distance_to_obj = len(shortest_path_to_obj)
-
                     if with_blockers:
                         # The distance should take into account the steps necessary
                         # to unblock the way. Instead of computing it exactly,
@@ -798,8 +907,7 @@ class Bot:
                         # and 7 if the agent is carrying something
                         # (turn, drop, turn back, pick,
                         # turn to other direction, drop, turn back)
-                        distance_to_obj = (len(shortest_path_to_obj)
-                                           + (7 if self.mission.carrying else 4))
+                        distance_to_obj += 7 if self.mission.carrying else 4
 
                     # If we looking for a door and we are currently in that cell
                     # that contains the door, it will take us at least 2
@@ -825,37 +933,37 @@ class Bot:
 
         return best_obj, best_pos
 
+    # Offsets from the agent position of the cells of its view, by (view size, agent direction)
+    view_offsets = {}
+
+    @classmethod
+    def _view_offsets(cls, view_size, agent_dir):
+        key = (view_size, agent_dir)
+        if key not in cls.view_offsets:
+            f_vec = DIR_TO_VEC[agent_dir]
+            r_vec = np.array((-f_vec[1], f_vec[0]))
+            vis_i, vis_j = np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij')
+            # The top-left corner of the view is (view_size - 1) cells ahead and
+            # (view_size // 2) cells to the left of the agent
+            forward = view_size - 1 - vis_j
+            right = vis_i - view_size // 2
+            cls.view_offsets[key] = (forward * f_vec[0] + right * r_vec[0], forward * f_vec[1] + right * r_vec[1])
+        return cls.view_offsets[key]
+
     def _process_obs(self):
         """Parse the contents of an observation/image and update our state."""
 
         grid, vis_mask = self.mission.gen_obs_grid()
 
-        view_size = self.mission.agent_view_size
-        pos = self.mission.agent_pos
-        f_vec = self.mission.dir_vec
-        r_vec = self.mission.right_vec
-
-        # Compute the absolute coordinates of the top-left corner
-        # of the agent's view area
-        top_left = pos + f_vec * (view_size - 1) - r_vec * (view_size // 2)
-
+        # World coordinates of the cells of the view
+        offset_i, offset_j = self._view_offsets(self.mission.agent_view_size, self.mission.agent_dir)
+        abs_i = self.mission.agent_pos[0] + offset_i
+        abs_j = self.mission.agent_pos[1] + offset_j
 
         # Mark everything in front of us as visible
-        for vis_j in range(0, view_size):
-            for vis_i in range(0, view_size):
-
-                if not vis_mask[vis_i, vis_j]:
-                    continue
-
-                # Compute the world coordinates of this cell
-                abs_i, abs_j = top_left - (f_vec * vis_j) + (r_vec * vis_i)
-
-                if abs_i < 0 or abs_i >= self.vis_mask.shape[0]:
-                    continue
-                if abs_j < 0 or abs_j >= self.vis_mask.shape[1]:
-                    continue
-
-                self.vis_mask[abs_i, abs_j] = True
+        width, height = self.vis_mask.shape
+        visible = vis_mask & (abs_i >= 0) & (abs_i < width) & (abs_j >= 0) & (abs_j < height)
+        self.vis_mask[abs_i[visible], abs_j[visible]] = True
 
     def _remember_current_state(self):
         self.prev_agent_pos = self.mission.agent_pos
@@ -887,118 +995,27 @@ class Bot:
 
         """
         self.bfs_counter += 1
+        passable = self.planner.passable(self.mission.grid, ignore_blockers=ignore_blockers)
+        path, finish, previous_pos, num_steps = self.planner.search(
+            self.mission.grid, passable, initial_states, accept_fn)
+        self.bfs_step_counter += num_steps
+        return path, finish, previous_pos
 
-        queue = [(state, None) for state in initial_states]
-        grid = self.mission.grid
-        previous_pos = dict()
-
-        while len(queue) > 0:
-            state, prev_pos = queue[0]
-            queue = queue[1:]
-            i, j, di, dj = state
-
-            if (i, j) in previous_pos:
-                continue
-
-            self.bfs_step_counter += 1
-
-            cell = grid.get(i, j)
-            previous_pos[(i, j)] = prev_pos
-
-            # If we reached a position satisfying the acceptance condition
-            if accept_fn((i, j), cell):
-                path = []
-                pos = (i, j)
-                while pos:
-                    path.append(pos)
-                    pos = previous_pos[pos]
-                return path, (i, j), previous_pos
-
-            if cell:
-                if cell.type == 'wall':
-                    continue
-                # If this is a door
-                elif cell.type == 'door':
-                    # If the door is closed, don't visit neighbors
-                    if not cell.is_open:
-                        continue
-                elif not ignore_blockers:
-                    continue
-
-            # Location to which the bot can get without turning
-            # are put in the queue first
-            for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
-                next_pos = (i + k, j + l)
-                next_dir_vec = (k, l)
-                next_state = (*next_pos, *next_dir_vec)
-                queue.append((next_state, (i, j)))
-
-        # Path not found
-        return None, None, previous_pos
-
-        
     def _breadth_first_search(self, initial_states, accept_fn, ignore_blockers, plan_through_doors=False):
         """Performs breadth first search.
 
         This is pretty much your textbook BFS. The state space is agent's locations,
         but the current direction is also added to the queue to slightly prioritize
-        going straight over turning.
+        going straight over turning. Cells that were not visually observed are not
+        expanded.
 
         """
         self.bfs_counter += 1
-
-        queue = [(state, None) for state in initial_states]
-        grid = self.mission.grid
-        previous_pos = dict()
-
-        while len(queue) > 0:
-            state, prev_pos = queue[0]
-            queue = queue[1:]
-            i, j, di, dj = state
-
-            if (i, j) in previous_pos:
-                continue
-
-            self.bfs_step_counter += 1
-
-            cell = grid.get(i, j)
-            previous_pos[(i, j)] = prev_pos
-
-            # If we reached a position satisfying the acceptance condition
-            if accept_fn((i, j), cell):
-                path = []
-                pos = (i, j)
-                while pos:
-                    path.append(pos)
-                    pos = previous_pos[pos]
-                return path, (i, j), previous_pos
-
-            # If this cell was not visually observed, don't expand from it
-            if not self.vis_mask[i, j]:
-                continue
-
-            if cell:
-                if cell.type == 'wall':
-                    continue
-                # If this is a door
-                elif cell.type == 'door':
-                    if not plan_through_doors:
-                        # If the door is closed, don't visit neighbors
-                        if not cell.is_open:
-                            continue
-                elif not ignore_blockers:
-                    continue
-
-            # Location to which the bot can get without turning
-            # are put in the queue first
-            for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
-                next_pos = (i + k, j + l)
-                next_dir_vec = (k, l)
-                next_state = (*next_pos, *next_dir_vec)
-                queue.append((next_state, (i, j)))
-
-        # Path not found
-        return None, None, previous_pos
+        passable = self.planner.passable(self.mission.grid, self.vis_mask, ignore_blockers, plan_through_doors)
+        path, finish, previous_pos, num_steps = self.planner.search(
+            self.mission.grid, passable, initial_states, accept_fn)
+        self.bfs_step_counter += num_steps
+        return path, finish, previous_pos
 
     def _nonblind_shortest_path(self, accept_fn, try_with_blockers=False):
         """
@@ -1055,6 +1072,40 @@ class Bot:
         # Note, that with_blockers only makes sense if path is not None
         return path, finish, with_blockers
 
+    def _shortest_path_to(self, target_pos, try_with_blockers=False, plan_through_doors=False):
+        """
+        Same as `_shortest_path` with `pos == target_pos` as the acceptance condition, but only returns
+        the first cell of the path and its length, which are read from a cached distance field to the target.
+
+        Returns:
+        -------
+        next_cell : (int, int) tuple, or None if there is no path or we are on the target
+        distance : int, or None if there is no path
+        with_blockers : bool
+
+        """
+        target_pos = tuple(target_pos)
+        passable = self.planner.passable(self.mission.grid, self.vis_mask, plan_through_doors=plan_through_doors)
+        distance_field, computed = self.planner.distances(passable, target_pos)
+        if computed:
+            self.bfs_counter += 1
+            self.bfs_step_counter += sum(d >= 0 for d in distance_field)
+        next_cell, distance = self.planner.next_step(
+            distance_field, passable.shape, self.mission.agent_pos, self.mission.dir_vec)
+        if distance is not None or not try_with_blockers:
+            return next_cell, distance, False
+
+        # Paths with blockers start from any cell reachable without blockers, so
+        # they don't depend on the target only: use the plain search
+        path, _, with_blockers = self._shortest_path(
+            lambda pos, cell: pos == target_pos,
+            try_with_blockers=True,
+            plan_through_doors=plan_through_doors,
+        )
+        if path is None:
+            return None, None, with_blockers
+        return (path[0] if path else None), len(path), with_blockers
+
     def _find_drop_pos(self, except_pos=None):
         """
         Find a position where an object can be dropped, ideally without blocking anything.
@@ -1,5 +1,8 @@
+import copy
+
 import numpy as np
 import gym
+from gym.spaces import Discrete
 
 
 # Returns the performance of the agent on the environment for a particular number of episodes.
@@ -135,3 +138,71 @@ def batch_evaluate(agent, env_name, seed, episodes, return_obss_actions=False):
             logs["actions_per_episode"].extend(actions)
 
     return logs
+
+
+# Returns the performance of a policy (e.g. an ACModel) on a curriculum env, playing many episodes at once.
+def batch_evaluate_policy(policy, env, seed, episodes, obs_preprocessor, teacher_dict, show_instrs=True,
+                          stochastic=True, temperature=1, num_envs=64):
+    """
+    Episodes are played on copies of env which are stepped together, so the policy runs one batched forward pass per
+    step. Episode i is played on the task the env samples after env.seed(seed + i). Nothing is rendered.
+    :return: logs with one entry per episode
+    """
+    discrete = type(env.action_space) is Discrete
+    num_envs = min(num_envs, episodes)
+    env_copies = [copy.deepcopy(env) for _ in range(num_envs)]
+    policy.eval()
+
+    logs = {
+        "seed_per_episode": [],
+        "success_per_episode": [],
+        "return_per_episode": [],
+        "num_frames_per_episode": [],
+        "stoch_correct_per_episode": [],
+        "det_correct_per_episode": [],
+    }
+
+    for start in range(seed, seed + episodes, num_envs):
+        seeds = range(start, min(start + num_envs, seed + episodes))
+        many_envs = ManyEnvs(env_copies[:len(seeds)])
+        many_envs.seed(seeds)
+        for e in many_envs.envs:
+            e.set_task()
+        many_obs = many_envs.reset()
+        policy.reset(dones=[True] * len(seeds))
+
+        num_frames = np.zeros((len(seeds),), dtype='int64')
+        returns = np.zeros((len(seeds),))
+        success = np.zeros((len(seeds),), dtype='bool')
+        stoch_correct = np.zeros((len(seeds),), dtype='int64')
+        det_correct = np.zeros((len(seeds),), dtype='int64')
+        already_done = np.zeros((len(seeds),), dtype='bool')
+        while not already_done.all():
+            obs = obs_preprocessor(many_obs, teacher_dict, show_instrs=show_instrs)
+            stoch_action, agent_info = policy.get_actions_t(obs, temp=temperature)
+            if discrete:
+                det_action = np.argmax(agent_info.probs, axis=1)
+            else:
+                det_action = agent_info.argmax_action
+            action = stoch_action if stochastic else det_action
+            many_obs, reward, done, env_info = many_envs.step(action)
+            # Envs which were already done only repeat their last step
+            for i in np.flatnonzero(~already_done):
+                info = env_info[i]
+                num_frames[i] += 1
+                returns[i] += reward[i]
+                success[i] = info.get('timestep_success', info['success'])
+                if discrete:
+                    teacher_action = np.array(info['teacher_action']).item()
+                    stoch_correct[i] += teacher_action == stoch_action[i]
+                    det_correct[i] += teacher_action == det_action[i]
+            already_done |= np.array(done, dtype='bool')
+
+        logs["seed_per_episode"].extend(list(seeds))
+        logs["success_per_episode"].extend(list(success))
+        logs["return_per_episode"].extend(list(returns))
+        logs["num_frames_per_episode"].extend(list(num_frames))
+        logs["stoch_correct_per_episode"].extend(list(stoch_correct))
+        logs["det_correct_per_episode"].extend(list(det_correct))
+
+    return logs
@@ -1,16 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import multiprocessing
+import pickle as pkl
+import random
 from meta_mb.utils.serializable import Serializable
 from babyai.levels.iclr19_levels import *
+from babyai.levels.task_pool import TaskPool
 from envs.d4rl_envs import PointMassEnv, AntEnv, PointMassEnvSimple, PointMassEnvSimpleDiscrete
-import copy
+import os
 NULL_SEED = 1000
 
+# Level specs of each curriculum: the level of index i is built from the i-th entry.
+# Point mass and ant: (gym env name, extra arguments). {reward_env_name} is '' for sparse rewards, '-dense' otherwise.
+POINT_MASS_LEVELS = [
+    ('maze2d-open{reward_env_name}-v0', {}),  # 0
+    ('maze2d-umaze{reward_env_name}-v1', {}),  # 1
+    ('maze2d-medium{reward_env_name}-v1', {}),  # 2
+    ('maze2d-large{reward_env_name}-v1', {}),  # 3
+    ('maze2d-randommaze-v0', {}),  # 4
+    ('maze2d-umaze{reward_env_name}-v1', {'reset_target': False}),  # 5
+    ('maze2d-medium{reward_env_name}-v1', {'reset_target': False}),  # 6
+    ('maze2d-large{reward_env_name}-v1', {'reset_target': False}),  # 7
+    ('maze2d-umaze{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 8
+    ('maze2d-medium{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 9
+    ('maze2d-large{reward_env_name}-v1', {'reset_target': False, 'reset_start': False}),  # 10
+    ('maze2d-randommaze-7x7-v0', {}),  # 11
+    ('maze2d-randommaze-8x8-v0', {}),  # 12
+    ('maze2d-12x12-v0', {}),  # 13
+    ('maze2d-15x15-v0', {}),  # 14
+]
+
+ANT_LEVELS = [
+    ('antmaze-umaze-v0', {}),  # 0
+    ('antmaze-umaze-diverse-v0', {}),  # 1
+    ('antmaze-medium-diverse-v0', {}),  # 2
+    ('antmaze-large-diverse-v0', {}),  # 3
+    ('antmaze-open-v0', {}),  # 4
+    ('antmaze-umaze-easy-v0', {}),  # 5
+    ('antmaze-randommaze-v0', {}),  # 6
+    ('antmaze-randommaze-small-v0', {}),  # 7
+    ('antmaze-randommaze-medium-v0', {}),  # 8
+    ('antmaze-randommaze-large-v0', {}),  # 9
+    ('antmaze-randommaze-huge-v0', {}),  # 10
+    ('antmaze-6x6-v0', {}),  # 11
+] + [(f'antmaze-fixed{i}-6x6-v0', {}) for i in range(10)]  # 12 - 21
+
+BABYAI_LEVELS = [
+    # Easy levels
+    Level_GoToRedBallNoDists,  # 0 --> intro L, R, Forward PreAction, Explore and GoNextTo subgoals
+    Level_GoToRedBallGrey,  # 1 --> first level with distractors
+    Level_GoToRedBall,  # 2 --> first level with colored distractors
+    Level_GoToObjS5,  # 3 --> first level where the goal is something other than a red ball
+    Level_GoToLocalS5N2,  # 4 --> first level where the task means something
+    Level_PickupLocalS5N2,  # 5 --> intro Pickup subgoal and pickup PreAction
+    Level_PutNextLocalS5N2,  # 6 --> intro Drop subgoal and drop PreAction
+    Level_OpenLocalS5N2,  # 7 --> intro Open subgoal and open PreAction
+    # Medium levels (here we introduce the harder teacher; no new tasks, just larger sizes)
+    Level_GoToObjS7,  # 8
+    Level_GoToLocalS7N4,  # 9
+    Level_PickupLocalS7N4,  # 10
+    Level_PutNextLocalS7N4,  # 11
+    Level_OpenLocalS7N4,  # 12
+    # Hard levels (bigger sizes, some new tasks)
+    Level_GoToObj,  # 13
+    Level_GoToLocal,  # 14
+    Level_PickupLocal,  # 15
+    Level_PutNextLocal,  # 16
+    Level_OpenLocal,  # 17
+    # Biggest levels (larger grid)
+    Level_GoToObjMazeOpen,  # 18
+    Level_GoToOpen,  # 19
+    Level_GoToObjMazeS4R2,  # 20
+    Level_GoToObjMazeS5,  # 21
+    Level_Open,  # 22
+    Level_GoTo,  # 23
+    Level_Pickup,  # 24
+    Level_PutNext,  # 25
+    # Larger sizes than we've seen before
+    Level_PickupObjBigger,  # 26 test0
+    # More distractors than we've seen before
+    Level_GoToObjDistractors,  # 27 test1
+    # New object
+    Level_GoToHeldout,  # 28 test2
+    # Task we've seen before, but new instructions
+    Level_GoToGreenBox,  # 29 test3
+    Level_PutNextSameColor,  # 30 test4
+    # New object
+    Level_Unlock,  # 31 test5 ("unlock" is a completely new instruction)
+    Level_GoToImpUnlock,  # 32 test6
+    Level_UnblockPickup,  # 33 test7 (known task, but now there's the extra step of unblocking)
+    Level_Seek,  # 34 test8
+    # Easier heldout levels
+    Level_GoToGreenBoxLocal,  # 35 test9
+    Level_PutNextSameColorLocal,  # 36 test10
+    Level_UnlockLocal,  # 37 test11 ("unlock" is a completely new instruction)
+    Level_GoToImpUnlockLocal,  # 38 test12
+    Level_SeekLocal,  # 39 test13
+    Level_GoToObjDistractorsLocal,  # 40 test14
+    Level_GoToSmall2by2,  # 41 test15
+    Level_GoToSmall3by3,  # 42 test16
+    Level_SeekSmall2by2,  # 43 test17
+    Level_SeekSmall3by3,  # 44 test18
+    Level_GoToObjDistractorsLocalBig,  # 45 test19
+    Level_OpenSmall2by2,  # 46 test20
+    Level_OpenSmall3by3,  # 47 test21
+    Level_SeekL0,  # 48 test22
+]
+
+
+def make_level(env, index, reward_type='dense', **kwargs):
+    """
+    Build the level of index index of the env curriculum. Not seeded.
+    :param env: 'point_mass', 'ant' or 'babyai'
+    :param kwargs: arguments for the level
+    """
+    reward_env_name = '' if reward_type == 'sparse' else '-dense'
+    if env == 'point_mass':
+        levels, level_class = POINT_MASS_LEVELS, PointMassEnv
+    elif env == 'ant':
+        levels, level_class = ANT_LEVELS, AntEnv
+    elif env == 'babyai':
+        if not 0 <= index < len(BABYAI_LEVELS):
+            raise NotImplementedError(index)
+        return BABYAI_LEVELS[index](**kwargs)
+    else:
+        raise NotImplementedError(env)
+    if not 0 <= index < len(levels):
+        raise NotImplementedError(index)
+    env_name, level_kwargs = levels[index]
+    return level_class(env_name.format(reward_env_name=reward_env_name), reward_type=reward_type, **level_kwargs,
+                       **kwargs)
+
+
+@contextmanager
+def seeded_global_random(seed):
+    """
+    Seed the global np.random and random states for the block, and put the caller's states back after it
+    """
+    np_state, random_state = np.random.get_state(), random.getstate()
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(random_state)
+
+
+def build_level(env, index, build_seed, reward_type='dense', task_pool_dir=None, **kwargs):
+    """
+    make_level, plus the task pool of the level in task_pool_dir, if there is one (babyai only).
+    Some levels draw from the global np.random and random while they are built (e.g. the point mass random mazes).
+    They draw from states seeded with build_seed instead, and the caller's states are put back afterwards, so a level
+    is the same whichever process builds it, and building it doesn't change what the caller draws next.
+    """
+    with seeded_global_random(build_seed):
+        level = make_level(env, index, reward_type=reward_type, **kwargs)
+        if env == 'babyai' and task_pool_dir is not None:
+            pool_path = os.path.join(task_pool_dir, f'{type(level).__name__}.pkl')
+            if os.path.exists(pool_path):
+                task_pool = TaskPool.load(pool_path)
+                mismatch = task_pool.mismatch(level)
+                if mismatch is None:
+                    level.set_task_pool(task_pool)
+                else:
+                    print(f"Not using {pool_path}: {mismatch}")
+    return level
+
+
+def load_level(blob, build_seed):
+    """
+    Unpickle a level from build_pickled_level, under the global states it was built with: some envs (e.g. the d4rl
+    ones, which are EzPickle) are rebuilt when they are unpickled.
+    """
+    with seeded_global_random(build_seed):
+        return pkl.loads(blob)
+
+
+def build_pickled_level(*args, **kwargs):
+    """
+    build_level, pickled to be sent back from warm_level's process
+    """
+    return pkl.dumps(build_level(*args, **kwargs), protocol=pkl.HIGHEST_PROTOCOL)
+
+
 class Curriculum(Serializable):
-    def __init__(self, advance_curriculum_func, env, start_index=0, curriculum_type=0, reward_type='dense', **kwargs):
+    def __init__(self, advance_curriculum_func, env, start_index=0, curriculum_type=0, reward_type='dense',
+                 task_pool_dir=None, warm_next_level=False, **kwargs):
         """
 
         :param advance_curriculum_func: Either 'one_hot' or 'smooth' depending on whether you want each level of the
         curriculum to be a single environment or a distribution over past environments
         :param start_index: what index of the curriculum to start on
+        :param task_pool_dir: directory of pre-generated task pools (<level class name>.pkl, see
+        scripts/make_task_pools.py). The babyai levels which have a pool there serve their tasks from it.
+        :param warm_next_level: build the level after the current one in a background process, so that advancing the
+        curriculum doesn't stall on building it. A process rather than a thread, so that the build doesn't draw from
+        the global random states while training does; levels come out the same either way (see build_level). Copies
+        of the curriculum in daemonic env workers don't warm levels.
         :param kwargs: arguments for the environment
         """
         Serializable.quick_init(self, locals())
@@ -20,12 +207,19 @@ class Curriculum(Serializable):
         self.kwargs = kwargs
         self.reward_type = reward_type
         self.reward_env_name = reward_env_name
+        self.task_pool_dir = task_pool_dir
+        # Levels are built on first use; until then the entry of a level is its seed
         if env == 'point_mass':
-            self.levels_list = {k: NULL_SEED for k in range(15)}
+            self.levels_list = {k: NULL_SEED for k in range(len(POINT_MASS_LEVELS))}
         elif env == 'ant':
-            self.levels_list = {k: NULL_SEED for k in range(12 + 10)}
+            self.levels_list = {k: NULL_SEED for k in range(len(ANT_LEVELS))}
         elif env == 'babyai':
-            self.levels_list = {k: NULL_SEED for k in range(49)}
+            self.levels_list = {k: NULL_SEED for k in range(len(BABYAI_LEVELS))}
+        self.warm_next_level = warm_next_level
+        # index -> future of the level being built in the background (see warm_level)
+        self.warm_levels = {}
+        self.warm_executor = None
+        self.warm_pid = None
         # If start index isn't specified, start from the beginning (if we're using the pre-levels), or start
         # from the end of the pre-levels.
         if self.advance_curriculum_func == 'four_levels':
@@ -54,202 +248,51 @@ class Curriculum(Serializable):
         # class_name, class_args = self.levels_list[start_index]  # TODO: double check this doesn't do horrible things with the babyai levels
         self.set_wrapped_env(start_index)
         self.index = start_index
+        self.warm_level(start_index + 1)
+
+    def build_seed(self, index):
+        """
+        Seed of the global random states while level index is built (see build_level)
+        """
+        return int((self.kwargs.get('seed') or 0) * len(self.levels_list) + index)
+
+    def build_level(self, index):
+        return build_level(self.env, index, self.build_seed(index), reward_type=self.reward_type,
+                           task_pool_dir=self.task_pool_dir, **self.kwargs)
+
+    def warm_level(self, index):
+        """
+        If warm_next_level is set, start building level index in a background process. set_wrapped_env picks it up.
+        """
+        if not self.warm_next_level or index not in self.levels_list or not type(self.levels_list[index]) is int \
+                or index in self.warm_levels:
+            return
+        # Daemonic processes (e.g. the env workers) can't start the process, so they build their levels when needed
+        if multiprocessing.current_process().daemon:
+            return
+        # The executor belongs to the process which started it, so the workers which got a copy of the curriculum
+        # start their own
+        if self.warm_executor is None or self.warm_pid != os.getpid():
+            self.warm_executor = ProcessPoolExecutor(max_workers=1)
+            self.warm_levels = {}
+            self.warm_pid = os.getpid()
+        self.warm_levels[index] = self.warm_executor.submit(
+            build_pickled_level, self.env, index, self.build_seed(index), reward_type=self.reward_type,
+            task_pool_dir=self.task_pool_dir, **self.kwargs)
 
     def set_wrapped_env(self, index):
         if not type(self.levels_list[index]) is int:
             self._wrapped_env = self.levels_list[index]
             return
-        kwargs = self.kwargs
-        reward_env_name = self.reward_env_name
-        reward_type = self.reward_type
         seed = self.levels_list[index]
-        if self.env == 'point_mass':
-            if index == 0:
-                level = PointMassEnv(f'maze2d-open{reward_env_name}-v0', reward_type=reward_type, **kwargs)  # 0
-            elif index == 1:
-                level = PointMassEnv(f'maze2d-umaze{reward_env_name}-v1', reward_type=reward_type, **kwargs)  # 1
-            elif index == 2:
-                level = PointMassEnv(f'maze2d-medium{reward_env_name}-v1', reward_type=reward_type, **kwargs)  # 2
-            elif index == 3:
-                level = PointMassEnv(f'maze2d-large{reward_env_name}-v1', reward_type=reward_type, **kwargs)  # 3
-            elif index == 4:
-                level = PointMassEnv('maze2d-randommaze-v0', reward_type=reward_type, **kwargs)  # 4
-            elif index == 5:
-                level = PointMassEnv(f'maze2d-umaze{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 5
-                             **kwargs)
-            elif index == 6:
-                level = PointMassEnv(f'maze2d-medium{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 6
-                             **kwargs)
-            elif index == 7:
-                level = PointMassEnv(f'maze2d-large{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 7
-                             **kwargs)
-            elif index == 8:
-                level = PointMassEnv(f'maze2d-umaze{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 8
-                             reset_start=False, **kwargs)
-            elif index == 9:
-                level = PointMassEnv(f'maze2d-medium{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 9
-                             reset_start=False, **kwargs)
-            elif index == 10:
-                level = PointMassEnv(f'maze2d-large{reward_env_name}-v1', reward_type=reward_type, reset_target=False,  # 10
-                             reset_start=False, **kwargs)
-            elif index == 11:
-                level = PointMassEnv('maze2d-randommaze-7x7-v0', reward_type=reward_type, **kwargs)  # 11
-            elif index == 12:
-                level = PointMassEnv('maze2d-randommaze-8x8-v0', reward_type=reward_type, **kwargs)  # 12
-            elif index == 13:
-                level = PointMassEnv('maze2d-12x12-v0', reward_type=reward_type, **kwargs)  # 13
-            elif index == 14:
-                level = PointMassEnv('maze2d-15x15-v0', reward_type=reward_type, **kwargs)  # 14
-            else:
-                raise NotImplementedError(index)
-            self.levels_list[index] = level
-        elif self.env == 'ant':
-            if index == 0:
-                level = AntEnv(f'antmaze-umaze-v0', reward_type=reward_type, **kwargs)  # 0
-            elif index == 1:
-                level = AntEnv(f'antmaze-umaze-diverse-v0', reward_type=reward_type, **kwargs)  # 1
-            elif index == 2:
-                level = AntEnv(f'antmaze-medium-diverse-v0', reward_type=reward_type, **kwargs)  # 2
-            elif index == 3:
-                level = AntEnv(f'antmaze-large-diverse-v0', reward_type=reward_type, **kwargs)  # 3
-            elif index == 4:
-                level = AntEnv(f'antmaze-open-v0', reward_type=reward_type, **kwargs)  # 4
-            elif index == 5:
-                level = AntEnv(f'antmaze-umaze-easy-v0', reward_type=reward_type, **kwargs)  # 5
-            elif index == 6:
-                level = AntEnv('antmaze-randommaze-v0', reward_type=reward_type, **kwargs)  # 6
-            elif index == 7:
-                level = AntEnv('antmaze-randommaze-small-v0', reward_type=reward_type, **kwargs)  # 7
-            elif index == 8:
-                level = AntEnv('antmaze-randommaze-medium-v0', reward_type=reward_type, **kwargs)  # 8
-            elif index == 9:
-                level = AntEnv('antmaze-randommaze-large-v0', reward_type=reward_type, **kwargs)  # 9
-            elif index == 10:
-                level = AntEnv('antmaze-randommaze-huge-v0', reward_type=reward_type, **kwargs)  # 10
-            elif index == 11:
-                level = AntEnv('antmaze-6x6-v0', reward_type=reward_type, **kwargs)  # 11
-            elif index >= 12 and index < 22:
-                i = index - 12
-                level = AntEnv(f'antmaze-fixed{i}-6x6-v0', reward_type=reward_type, **kwargs)
-            else:
-                raise NotImplementedError(index)
-            level.seed(seed)
-            self.levels_list[index] = level
-        elif self.env == 'babyai':
-            # Easy levels
-            if index == 0:
-                level = Level_GoToRedBallNoDists(**kwargs) # 0 --> intro L, R, Forward PreAction, Explore and GoNextTo subgoals
-            elif index == 1:
-                level = Level_GoToRedBallGrey(**kwargs)  # 1 --> first level with distractors
-            elif index == 2:
-                level = Level_GoToRedBall(**kwargs)  # 2 --> first level with colored distractors
-            elif index == 3:
-                level = Level_GoToObjS5(**kwargs)  # 3 --> first level where the goal is something other than a red ball
-            elif index == 4:
-                level = Level_GoToLocalS5N2(**kwargs)  # 4 --> first level where the task means something
-            elif index == 5:
-                level = Level_PickupLocalS5N2(**kwargs)  # 5 --> intro Pickup subgoal and pickup PreAction
-            elif index == 6:
-                level = Level_PutNextLocalS5N2(**kwargs)  # 6 --> intro Drop subgoal and drop PreAction
-            elif index == 7:
-                level = Level_OpenLocalS5N2(**kwargs)  # 7 --> intro Open subgoal and open PreAction
-            # Medium levels (here we introduce the harder teacher; no new tasks, just larger sizes)
-            elif index == 8:
-                level = Level_GoToObjS7(**kwargs)  # 8
-            elif index == 9:
-                level = Level_GoToLocalS7N4(**kwargs)  # 9
-            elif index == 10:
-                level = Level_PickupLocalS7N4(**kwargs)  # 10
-            elif index == 11:
-                level = Level_PutNextLocalS7N4(**kwargs)  # 11
-            elif index == 12:
-                level = Level_OpenLocalS7N4(**kwargs)  # 12
-            # Hard levels (bigger sizes, some new tasks)
-            elif index == 13:
-                level = Level_GoToObj(**kwargs)  # 13
-            elif index == 14:
-                level = Level_GoToLocal(**kwargs)  # 14
-            elif index == 15:
-                level = Level_PickupLocal(**kwargs)  # 15
-            elif index == 16:
-                level = Level_PutNextLocal(**kwargs)  # 16
-            elif index == 17:
-                level = Level_OpenLocal(**kwargs)  # 17
-            # Biggest levels (larger grid)
-            elif index == 18:
-                level = Level_GoToObjMazeOpen(**kwargs)  # 18
-            elif index == 19:
-                level = Level_GoToOpen(**kwargs)  # 19
-            elif index == 20:
-                level = Level_GoToObjMazeS4R2(**kwargs)  # 20
-            elif index == 21:
-                level = Level_GoToObjMazeS5(**kwargs)  # 21
-            elif index == 22:
-                level = Level_Open(**kwargs)  # 22
-            elif index == 23:
-                level = Level_GoTo(**kwargs)  # 23
-            elif index == 24:
-                level = Level_Pickup(**kwargs)  # 24
-            elif index == 25:
-                level = Level_PutNext(**kwargs)  # 25
-            elif index == 26:
-                # Larger sizes than we've seen before
-                level = Level_PickupObjBigger(**kwargs)  # 26 test0
-            elif index == 27:
-                # More distractors than we've seen before
-                level = Level_GoToObjDistractors(**kwargs)  # 27 test1
-            elif index == 28:
-                # New object
-                level = Level_GoToHeldout(**kwargs)  # 28 test2
-            elif index == 29:
-                # Task we've seen before, but new instructions
-                level = Level_GoToGreenBox(**kwargs)  # 29 test3
-            elif index == 30:
-                level = Level_PutNextSameColor(**kwargs)  # 30 test4
-            elif index == 31:
-                # New object
-                level = Level_Unlock(**kwargs)  # 31 test5 ("unlock" is a completely new instruction)
-            elif index == 32:
-                level = Level_GoToImpUnlock(**kwargs)  # 32 test6
-            elif index == 33:
-                level = Level_UnblockPickup(**kwargs)  # 33 test7 (known task, but now there's the extra step of unblocking)
-            elif index == 34:
-                level = Level_Seek(**kwargs)  # 34 test8
-            elif index == 35:
-                # Easier heldout levels
-                level = Level_GoToGreenBoxLocal(**kwargs)  # 35 test9
-            elif index == 36:
-                level = Level_PutNextSameColorLocal(**kwargs)  # 36 test10
-            elif index == 37:
-                level = Level_UnlockLocal(**kwargs)  # 37 test11 ("unlock" is a completely new instruction)
-            elif index == 38:
-                level = Level_GoToImpUnlockLocal(**kwargs)  # 38 test12
-            elif index == 39:
-                level = Level_SeekLocal(**kwargs)  # 39 test13
-            elif index == 40:
-                level = Level_GoToObjDistractorsLocal(**kwargs)  # 40 test14
-            elif index == 41:
-                level = Level_GoToSmall2by2(**kwargs)  # 41 test15
-            elif index == 42:
-                level = Level_GoToSmall3by3(**kwargs)  # 42 test16
-            elif index == 43:
-                level = Level_SeekSmall2by2(**kwargs)  # 43 test17
-            elif index == 44:
-                level = Level_SeekSmall3by3(**kwargs)  # 44 test18
-            elif index == 45:
-                level = Level_GoToObjDistractorsLocalBig(**kwargs)  # 45 test19
-            elif index == 46:
-                level = Level_OpenSmall2by2(**kwargs)  # 46 test20
-            elif index == 47:
-                level = Level_OpenSmall3by3(**kwargs)  # 47 test21
-            elif index == 48:
-                level = Level_SeekL0(**kwargs)  # 48 test22
-            else:
-                raise NotImplementedError(index)
-            level.seed(seed)
-            self.levels_list[index] = level
+        future = self.warm_levels.pop(index, None)
+        if future is not None and self.warm_pid == os.getpid():
+            level = load_level(future.result(), self.build_seed(index))
         else:
-            raise NotImplementedError(self.env)
+            level = self.build_level(index)
+        if self.env != 'point_mass':
+            level.seed(seed)
+        self.levels_list[index] = level
         self._wrapped_env = level
 
     def __getattr__(self, attr):
@@ -326,6 +369,7 @@ class Curriculum(Serializable):
         else:
             raise ValueError('invalid curriculum type' + str(self.advance_curriculum_func))
         self.index = index
+        self.warm_level(index + 1)
         print("updated curriculum", self.index, type(self.levels_list[self.index]))
 
     def set_level(self, index):
@@ -348,6 +392,17 @@ class Curriculum(Serializable):
             self.distribution[index] = 1
         self.index = index
 
+    def get_curriculum_state(self):
+        """
+        Where the curriculum is: its level and level distribution. Enough to bring a copy of the curriculum (with the
+        same arguments) to the same place with set_curriculum_state.
+        """
+        return {'index': self.index, 'distribution': self.distribution.copy()}
+
+    def set_curriculum_state(self, state):
+        self.set_level_distribution(state['index'], copy_distribution=state['distribution'].copy())
+        self.warm_level(state['index'] + 1)
+
     def seed(self, i):
         levels_list = self.levels_list if type(self.levels_list) is list else self.levels_list.values()
         if type(self.levels_list) is list:
@@ -370,10 +425,45 @@ class Curriculum(Serializable):
         return self._wrapped_env.set_task(args)
 
     def copy(self, index=None):
-        env = copy.deepcopy(self)
+        """
+        A new curriculum with the same arguments, set to the same level distribution. Only the levels it uses are
+        built (the level specs and arguments are shared with this curriculum).
+        """
         if index is None:
             index = self.index
+        env = Serializable.clone(self, start_index=index)
         env.set_level_distribution(index=index, copy_distribution=self.distribution.copy())
         env.set_task()
         env.reset()
         return env
+
+
+def test(num_levels=6):
+    """
+    Check that warming the next level changes nothing: the same levels come out, and the draws of the caller (e.g.
+    training, while the next level is built) from the global random states are the same as without warming.
+    """
+    from babyai.arguments import ArgumentParser
+
+    arguments = dict(start_loc='all', include_holdout_obj=True, persist_goal=True, persist_objs=True, persist_agent=True,
+                     feedback_type=['OFFSparseRandom'], feedback_freq=[1], cartesian_steps=[3], num_meta_tasks=2,
+                     intermediate_reward=False, reward_type='sparse', fully_observed=False, padding=False,
+                     args=ArgumentParser().parse_args([]), seed=0, static_env=False)
+    runs = []
+    for warm_next_level in [False, True]:
+        print('Curriculum with warm_next_level=%s' % warm_next_level)
+        np.random.seed(0)
+        random.seed(0)
+        curriculum = Curriculum('one_hot', env='babyai', start_index=0, warm_next_level=warm_next_level, **arguments)
+        run = []
+        for index in range(1, num_levels):
+            draws = np.random.randint(1 << 30, size=3).tolist(), random.random()
+            curriculum.advance_curriculum(index)
+            assert (index in curriculum.warm_levels) == warm_next_level
+            curriculum.seed(index)
+            curriculum.set_task()
+            obs = curriculum.reset()
+            run.append((draws, type(curriculum._wrapped_env).__name__, curriculum.mission,
+                        curriculum.grid.encode().tobytes(), {k: np.asarray(v).tobytes() for k, v in obs.items()}))
+        runs.append(run)
+    assert runs[0] == runs[1]
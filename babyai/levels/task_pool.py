@@ -0,0 +1,147 @@
+import pathlib
+import pickle as pkl
+from multiprocessing import Pool
+
+import numpy as np
+
+# Settings of a level which change the tasks it samples. A pool is only served to levels with the same settings.
+TASK_SETTINGS = ('width', 'height', 'num_dists', 'start_loc', 'include_holdout_obj', 'persist_goal', 'persist_agent',
+                 'persist_objs')
+
+
+def task_settings(env):
+    """
+    :return: dict of the TASK_SETTINGS of env (None for the ones its level doesn't have)
+    """
+    return {key: getattr(env, key, None) for key in TASK_SETTINGS}
+
+
+def _sample_tasks(env, seeds):
+    """
+    Sample the task of each seed with a copy of env. Runs in the pool's worker processes.
+    :return: list of pickled tasks
+    """
+    blobs = []
+    for seed in seeds:
+        env.seed(int(seed))
+        blobs.append(pkl.dumps(env.sample_task(), protocol=pkl.HIGHEST_PROTOCOL))
+    return blobs
+
+
+class TaskPool:
+    """
+    Pre-generated tasks of a level, one per seed of a seed range.
+
+    The task of seed s is the one sample_task() returns right after env.seed(s), so a pool replays the tasks of the
+    seeds it covers. Tasks are kept pickled: serving one only unpickles it, which also gives the env its own copy of
+    the objects and instructions, like a freshly sampled task.
+    """
+
+    def __init__(self, level, start_seed, blobs, settings=None):
+        """
+        :param level: name of the level class the tasks were sampled from
+        :param start_seed: seed of the first task
+        :param blobs: list of pickled tasks, for seeds start_seed, start_seed + 1, ...
+        :param settings: task_settings() of the level the tasks were sampled from
+        """
+        self.level = level
+        self.start_seed = start_seed
+        self.blobs = blobs
+        self.settings = settings
+
+    def __len__(self):
+        return len(self.blobs)
+
+    @classmethod
+    def generate(cls, env, start_seed, num_tasks, num_workers=4, chunk_size=100):
+        """
+        Sample the tasks of seeds start_seed, ..., start_seed + num_tasks - 1 in background worker processes.
+        Rejection sampling happens here, so that set_task() doesn't stall on levels which reject many placements.
+        :param env: a Level_TeachableRobot; each worker gets a copy of it
+        :param num_workers: number of worker processes. With 0, the tasks are sampled in this process.
+        :param chunk_size: number of seeds sent to a worker at once
+        """
+        seeds = np.arange(start_seed, start_seed + num_tasks)
+        chunks = [seeds[i:i + chunk_size] for i in range(0, num_tasks, chunk_size)]
+        if num_workers == 0:
+            results = [_sample_tasks(env, chunk) for chunk in chunks]
+        else:
+            with Pool(num_workers) as pool:
+                results = pool.starmap(_sample_tasks, [(env, chunk) for chunk in chunks])
+        blobs = [blob for result in results for blob in result]
+        return cls(type(env).__name__, start_seed, blobs, task_settings(env))
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            pkl.dump({'level': self.level, 'start_seed': self.start_seed, 'blobs': self.blobs,
+                      'settings': self.settings}, f, protocol=pkl.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pkl.load(f)
+        # Pools saved before the settings were stored don't have them, and don't match any level
+        return cls(data['level'], data['start_seed'], data['blobs'], data.get('settings'))
+
+    def mismatch(self, env):
+        """
+        :return: why the tasks of the pool are not tasks env would sample, or None if they are
+        """
+        if self.level != type(env).__name__:
+            return f"task pool of {self.level} given to {type(env).__name__}"
+        settings = task_settings(env)
+        if self.settings != settings:
+            return f"task pool of {self.level} sampled with {self.settings}, but the level has {settings}"
+        return None
+
+    def covers(self, seed):
+        return seed is not None and self.start_seed <= seed < self.start_seed + len(self.blobs)
+
+    def get(self, seed):
+        """
+        :return: a new copy of the task of seed
+        """
+        return pkl.loads(self.blobs[seed - self.start_seed])
+
+    def sample(self, rng):
+        """
+        :param rng: np.random.RandomState used to pick the task
+        :return: a new copy of a random task of the pool
+        """
+        return pkl.loads(self.blobs[rng.randint(len(self.blobs))])
+
+
+def test(num_tasks=20):
+    """
+    Check that with a pool, set_task() after seed(s) replays the task sample_task() gives after seed(s), on seeded
+    levels. The tasks are compared on the env they produce after a reset.
+    """
+    from babyai.levels.iclr19_levels import Level_GoToRedBallGrey, Level_PickupLocalS5N2, Level_OpenLocalS5N2, \
+        Level_GoToObjMazeS4, Level_PutNextLocal
+
+    def state(env):
+        return env.mission, env.grid.encode().tobytes(), tuple(env.agent_pos), env.agent_dir
+
+    start_seed = 5
+    for level in [Level_GoToRedBallGrey, Level_PickupLocalS5N2, Level_OpenLocalS5N2, Level_GoToObjMazeS4,
+                  Level_PutNextLocal]:
+        print('TaskPool on %s' % level.__name__)
+        env, pooled_env = level(seed=0), level(seed=0)
+        pooled_env.set_task_pool(TaskPool.generate(level(seed=0), start_seed, num_tasks, num_workers=0))
+
+        pooled_states = set()
+        for seed in range(start_seed, start_seed + num_tasks):
+            for e in [env, pooled_env]:
+                e.seed(seed)
+                e.set_task()
+                e.reset()
+            assert state(pooled_env) == state(env)
+            pooled_states.add(state(pooled_env))
+        # Seeds the pool doesn't cover get one of its tasks
+        for seed in range(start_seed + num_tasks, start_seed + num_tasks + 5):
+            pooled_env.seed(seed)
+            pooled_env.set_task()
+            pooled_env.reset()
+            assert state(pooled_env) in pooled_states
@@ -31,6 +31,50 @@ from babyai.oracle.batch_teacher import BatchTeacher
 from babyai.oracle.dummy_advice import DummyAdvice
 from babyai.bot import Bot
 from vis_mask_grid import VisMaskGrid
+from array_grid import ArrayGrid, VERSIONS
+
+
+class EnvSnapshot:
+    """
+    State of a Level_TeachableRobot env, as returned by Level_TeachableRobot.snapshot().
+    The grid is stored as a tuple of references to the world objects, which are shared with the live env; only the
+    small attribute dicts of the (non-wall) objects and of the verifier nodes are copied.
+    """
+    # Env attributes which env.step() can change
+    ATTRS = ('agent_pos', 'agent_dir', 'carrying', 'step_count', 'done', 'teacher')
+
+    def __init__(self, grid_cells, grid_array, grid_doors, obj_states, instr_states, attrs, np_random_state,
+                 versions, view):
+        self.grid_cells = grid_cells
+        self.grid_array = grid_array
+        self.grid_doors = grid_doors
+        self.versions = versions
+        self.view = view
+        self.obj_states = obj_states
+        self.instr_states = instr_states
+        self.attrs = attrs
+        self.np_random_state = np_random_state
+
+
+def _verifier_nodes(instr):
+    """
+    Iterate over the instruction and object description nodes of an instruction tree.
+    """
+    nodes = [instr]
+    while nodes:
+        node = nodes.pop()
+        yield node
+        for attr in ('instr_a', 'instr_b', 'desc', 'desc_move', 'desc_fixed'):
+            child = node.__dict__.get(attr)
+            if child is not None:
+                nodes.append(child)
+
+
+def _copy_state(state):
+    """
+    Copy an attribute dict, also copying lists (e.g. ObjDesc.obj_set) so they can't be changed in place.
+    """
+    return {k: list(v) if type(v) is list else v for k, v in state.items()}
 
 
 class Level_TeachableRobot(RoomGridLevel, MetaEnv):
@@ -73,6 +117,8 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
         if feedback_type is not None:
             rng = np.random.RandomState()
             self.oracle = {}
+            # The teachers' oracles observe the same views, so they share their visibility mask
+            vis_mask = None
             teachers = {}
             if type(cartesian_steps) is int:
                 cartesian_steps = [cartesian_steps]
@@ -181,12 +227,102 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
                 else:
                     raise NotImplementedError(ft)
                 teachers[ft] = teacher
-                self.oracle[ft] = Bot(self, rng=copy.deepcopy(rng), fully_observed=fully_observed)
+                self.oracle[ft] = Bot(self, rng=copy.deepcopy(rng), fully_observed=fully_observed, vis_mask=vis_mask)
+                vis_mask = self.oracle[ft].vis_mask
             teacher = BatchTeacher(teachers)
         else:
             teacher = None
         self.teacher = teacher
 
+    # Version of the agent pose and carried object, changed whenever they are set (see ArrayGrid.version)
+    state_version = -1
+    # Last (versions, grid, vis_mask, image) computed by gen_obs_view()
+    view = None
+
+    @property
+    def agent_pos(self):
+        return self._agent_pos
+
+    @agent_pos.setter
+    def agent_pos(self, agent_pos):
+        self._agent_pos = agent_pos
+        self.state_version = next(VERSIONS)
+
+    @property
+    def agent_dir(self):
+        return self._agent_dir
+
+    @agent_dir.setter
+    def agent_dir(self, agent_dir):
+        self._agent_dir = agent_dir
+        self.state_version = next(VERSIONS)
+
+    @property
+    def carrying(self):
+        return self._carrying
+
+    @carrying.setter
+    def carrying(self, carrying):
+        self._carrying = carrying
+        self.state_version = next(VERSIONS)
+
+    @property
+    def grid(self):
+        return self._grid
+
+    @grid.setter
+    def grid(self, grid):
+        # RoomGrid._gen_grid() creates a plain Grid; keep an ArrayGrid instead, so the observations are array operations
+        if grid is not None and not isinstance(grid, ArrayGrid):
+            grid = ArrayGrid.from_grid(grid)
+        self._grid = grid
+
+    def __getstate__(self):
+        # The versions keying the memoized view come from a per-process counter, so the view isn't pickled
+        state = self.__dict__.copy()
+        state.pop('view', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.state_version = next(VERSIONS)
+
+    def gen_obs_view(self):
+        """
+        The agent's view of the current state: the output of gen_obs_grid() and its encoding. It is computed once
+        per state, and shared by everything which looks at it in the meantime (the env's observation, the bots of all
+        the teachers, ...), so it mustn't be modified.
+        :return: (grid, vis_mask, image)
+        """
+        versions = (self.state_version, self.grid.version)
+        if self.view is None or self.view[0] != versions:
+            grid, vis_mask = self.compute_obs_grid()
+            self.view = (versions, grid, vis_mask, grid.encode(vis_mask))
+        return self.view[1:]
+
+    def gen_obs_grid(self):
+        grid, vis_mask, _ = self.gen_obs_view()
+        return grid, vis_mask
+
+    def compute_obs_grid(self):
+        """
+        Generate the sub-grid observed by the agent, and the mask of the cells the agent can actually see.
+        Same as MiniGridEnv.gen_obs_grid(), but the view is one slice of the grid array, rotated in one go.
+        """
+        topX, topY, _, _ = self.get_view_exts()
+        grid = self.grid.slice(topX, topY, self.agent_view_size, self.agent_view_size)
+        grid = grid.rotate_left(self.agent_dir + 1)
+
+        agent_pos = grid.width // 2, grid.height - 1
+        if not self.see_through_walls:
+            vis_mask = grid.process_vis(agent_pos=agent_pos)
+        else:
+            vis_mask = np.ones(shape=(grid.width, grid.height), dtype=bool)
+
+        # The agent sees what it's carrying in its own cell
+        grid.set(*agent_pos, self.carrying)
+        return grid, vis_mask
+
     def get_full_observation(self):
         env = self.unwrapped
         full_grid = env.grid.encode()
@@ -197,6 +333,55 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
         ])
         return full_grid
 
+    def snapshot(self):
+        """
+        Capture the state which env.step() can change (grid cells, agent pose, carried object, verifier state, RNG),
+        so lookahead teachers can step the env and then roll it back with restore().
+        :return: EnvSnapshot
+        """
+        objs = [obj for obj in self.grid.grid if obj is not None and obj.type != 'wall']
+        if self.carrying is not None:
+            objs.append(self.carrying)
+        # Objects hidden inside boxes appear in the grid when the box is opened
+        # (prevent_teacher_errors makes boxes contain themselves)
+        for obj in objs:
+            contains = getattr(obj, 'contains', None)
+            if contains is not None and not any(contains is other for other in objs):
+                objs.append(contains)
+        attrs = {k: getattr(self, k) for k in EnvSnapshot.ATTRS if hasattr(self, k)}
+        attrs['agent_pos'] = copy.copy(attrs['agent_pos'])
+        return EnvSnapshot(grid_cells=tuple(self.grid.grid),
+                           grid_array=self.grid.array.copy(),
+                           grid_doors=dict(self.grid.doors),
+                           obj_states=[(obj, dict(obj.__dict__)) for obj in objs],
+                           instr_states=[(node, _copy_state(node.__dict__)) for node in _verifier_nodes(self.instrs)],
+                           attrs=attrs,
+                           np_random_state=self.np_random.get_state(),
+                           versions=(self.state_version, self.grid.version),
+                           view=self.view)
+
+    def restore(self, snapshot):
+        """
+        Roll the env back to a state captured with snapshot(). A snapshot can be restored several times.
+        :param snapshot: EnvSnapshot
+        """
+        self.grid.grid = list(snapshot.grid_cells)
+        self.grid.array[:] = snapshot.grid_array
+        self.grid.doors = dict(snapshot.grid_doors)
+        for obj, state in snapshot.obj_states:
+            obj.__dict__.clear()
+            obj.__dict__.update(state)
+        for node, state in snapshot.instr_states:
+            node.__dict__.clear()
+            node.__dict__.update(_copy_state(state))
+        for k, v in snapshot.attrs.items():
+            setattr(self, k, v)
+        self.agent_pos = copy.copy(snapshot.attrs['agent_pos'])
+        self.np_random.set_state(snapshot.np_random_state)
+        # Back to the same state, so the view computed for it is still valid
+        self.state_version, self.grid.version = snapshot.versions
+        self.view = snapshot.view
+
     def sample_object(self):
         """
         Choose a random object (not a door).  If specified, hold out the color grey and type box.
@@ -273,13 +458,39 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
             break
         return task
 
+    # Pre-generated tasks (see babyai.levels.task_pool.TaskPool) served by set_task() instead of sampling them
+    task_pool = None
+    # Seed given to the last seed() call, if no task was set since then
+    task_seed = None
+
+    def seed(self, seed=1337):
+        self.task_seed = seed
+        return super().seed(seed)
+
+    def set_task_pool(self, task_pool):
+        """
+        Serve the tasks of set_task() from a pool of pre-generated tasks.
+        :param task_pool: TaskPool of this level, or None to sample the tasks again
+        """
+        mismatch = None if task_pool is None else task_pool.mismatch(self)
+        assert mismatch is None, mismatch
+        self.task_pool = task_pool
+
     # Functions fo RL2
     def set_task(self, _=None):
         """
         Sets task dictionary. The parameter is a dummy passed in for compatibility with the normal RL2 set task function
+        With a task pool, the task of the seed the env was just seeded with is replayed if the pool has it;
+        otherwise a random task of the pool is used.
         """
         if not self.static_env:
-            self.task = self.sample_task()
+            if self.task_pool is None:
+                self.task = self.sample_task()
+            elif self.task_pool.covers(self.task_seed):
+                self.task = self.task_pool.get(self.task_seed)
+            else:
+                self.task = self.task_pool.sample(self.np_random)
+        self.task_seed = None
         self.itr = 0
 
     def get_task(self):
@@ -374,6 +585,11 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
             if obj.type == 'box':
                 obj.contains = obj
 
+    def _gen_grid(self, width, height):
+        super()._gen_grid(width, height)
+        # Missions recolor some objects after placing them, which set() didn't see
+        self.grid.refresh()
+
     def gen_mission(self):
         """
         Generate the mission for a single meta-task.  Any environment setup elements in the self.task dictionary
@@ -508,9 +724,8 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
         elif self.fully_observed:
             image = self.get_full_observation()
         else:
-            grid, vis_mask = self.gen_obs_grid()
             # Encode the partially observable view into a numpy array
-            image = grid.encode(vis_mask)
+            image = self.gen_obs_view()[2].copy()
 
         assert hasattr(self, 'mission'), "environments must define a textual mission string"
 
@@ -553,6 +768,8 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
         else:
             give_reward = False
 
+        # Toggling a door changes it in place, which the grid version doesn't track
+        self.state_version = next(VERSIONS)
         obs, rew, done, info = super().step(action)
         info['agent_pos'] = self.agent_pos
         info['agent_dir'] = self.agent_dir
@@ -573,7 +790,9 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
             info['teacher_action'] = np.array(first_teacher.next_action, dtype=np.int32)
             if hasattr(first_teacher, 'num_steps'):
                 info['num_steps'] = first_teacher.num_steps
-            original_oracle = pkl.loads(pkl.dumps(self.oracle))
+            # Feedback is computed from the oracles' state before the teacher replans. Forking a bot shares this
+            # env, so it is much cheaper than pickling the oracles (which also copied the env).
+            original_oracle = {k: v.fork() for k, v in self.oracle.items()}
             self.oracle = self.teacher.step(action, self.oracle)
             for k, v in self.teacher.success_check(obs['obs'], action, self.oracle).items():
                 info[f'followed_{k}'] = v
@@ -625,7 +844,9 @@ class Level_TeachableRobot(RoomGridLevel, MetaEnv):
             self.seed(0)
         super().reset()
         if hasattr(self, 'teacher') and self.teacher is not None:
-            self.oracle = self.teacher.reset(self.oracle)
+            # The teachers' oracles observe the same views, so they share one visibility mask, with nothing explored
+            vis_mask = np.full((self.width, self.height), self.fully_observed, dtype=bool)
+            self.oracle = self.teacher.reset(self.oracle, vis_mask=vis_mask)
 
         self.teacher_action = self.get_teacher_action()
         obs = self.gen_obs(generate_feedback=True, past_action=-1)
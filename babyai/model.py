@@ -3,12 +3,27 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions.categorical import Categorical
 from torch.distributions.normal import Normal
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 import babyai.rl
 from babyai.rl.utils.supervised_losses import required_heads
 import numpy as np
 from babyai.rl.utils.dictlist import DictList
 
+class AgentInfos(DictList):
+    """
+    The infos of a batch of envs, as arrays. Indexing or iterating gives the info dict of each env, which is only
+    built when it is asked for.
+    """
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return {key: value[index] for key, value in dict.items(self)}
+        return AgentInfos(DictList.__getitem__(self, index))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
 # From https://github.com/ikostrikov/pytorch-a2c-ppo-acktr/blob/master/model.py
 def initialize_parameters(m):
     classname = m.__class__.__name__
@@ -212,6 +227,13 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
             if self.lang_model == 'attgru':
                 self.memory2key = nn.Linear(self.memory_size, self.instr_dim)
 
+            if self.lang_model in ['gru', 'bigru', 'attgru']:
+                # Embeddings of the instructions seen without gradients (e.g. during rollouts), keyed by their tokens.
+                # They only depend on the parameters of the instruction encoder, so the cache is emptied when these
+                # change.
+                self.instr_cache = {}
+                self.instr_cache_version = None
+
             self.controllers = []
             for ni in range(self.num_modules):
                 mod = FiLM(
@@ -326,6 +348,14 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
         except Exception:
             raise ValueError('Could not add extra heads')
 
+    def __getstate__(self):
+        # Don't save or copy the cached instruction embeddings
+        state = self.__dict__.copy()
+        if 'instr_cache' in state:
+            state['instr_cache'] = {}
+            state['instr_cache_version'] = None
+        return state
+
     @property
     def memory_size(self):
         return 2 * self.semi_memory_size
@@ -356,51 +386,55 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
         actions = np.array(action_list)
         return actions, info_list
 
-    def get_actions_t(self, obs, training=False, temp=1):  # TODO: this feels like a good place for a DictList
+    def get_actions_t(self, obs, training=False, temp=1):
+        """
+        Sample an action for each env of the batch. Discrete actions are sampled on the model's device from the
+        temperature softmax of the policy.
+        :return: actions and an AgentInfos, which holds the infos of the batch as arrays
+        """
         if training:
             self.train()
         else:
             self.eval()
-        dist, info = self(obs, self.memory)
-        self.memory = info['memory']
-        info_list = []
-        # Temperature softmax
-        if self.discrete:
-            probs = np.exp(dist.logits.detach().cpu().numpy() / temp)
-            probs = probs / np.sum(probs, axis=1, keepdims=True)
-            actions = np.stack([np.random.choice(len(p), p=p) for p in probs])
-            actions_torch = torch.LongTensor(actions).to(self.device)
-        else:
-            actions_torch = dist.rsample()
-            actions = actions_torch.detach().cpu().numpy()
-            argmax_actions = dist.mean.detach().cpu().numpy()
-        log_probs = dist.log_prob(actions_torch).detach().cpu().numpy()
-        values = info['value'].detach().cpu().numpy()
-        memory = info['memory'].detach().cpu().numpy()
-
-        for i in range(len(memory)):
-            info_dict = {
-                "memory": memory[i],
-                "value": values[i],
-                "log_prob": log_probs[i],
-            }
+        # Only numpy arrays come out of here, so there is no need to build the graph
+        with torch.no_grad():
+            dist, info = self(obs, self.memory)
+            self.memory = info['memory']
             if self.discrete:
-                info_dict['probs'] = probs[i]
+                # Temperature softmax
+                probs = F.softmax(dist.logits / temp, dim=1)
+                actions_torch = torch.multinomial(probs, 1).squeeze(1)
             else:
-                info_dict['argmax_action'] = argmax_actions[i]
-
-            info_list.append(info_dict)
-        return actions, info_list
+                actions_torch = dist.rsample()
+            infos = AgentInfos({
+                "memory": info['memory'].cpu().numpy(),
+                "value": info['value'].cpu().numpy(),
+                "log_prob": dist.log_prob(actions_torch).cpu().numpy(),
+            })
+            if self.discrete:
+                infos.probs = probs.cpu().numpy()
+            else:
+                infos.argmax_action = dist.mean.cpu().numpy()
+        return actions_torch.cpu().numpy(), infos
 
     def forward(self, obs, memory=None, instr_embedding=None):
-        if self.advice_size > 0:
-            advice_vector = obs.advice
-            advice_embedding = self._get_advice_embedding(advice_vector)
+        trunk = self.forward_trunk(obs, memory, instr_embedding)
+        return self.forward_heads(trunk, obs.advice if self.advice_size > 0 else None)
+
+    def forward_trunk(self, obs, memory=None, instr_embedding=None):
+        """
+        Runs the part of the model which doesn't depend on the advice (image conv, FiLM, instruction encoder, memory).
+        Its output can be passed to forward_heads with several advice vectors.
+        """
         img_vector = obs.obs
         if self.use_instr:
             instruction_vector = obs.instr.long()
             if instr_embedding is None:
-                instr_embedding = self._get_instr_embedding(instruction_vector)
+                # Models saved before the cache existed don't have it
+                if torch.is_grad_enabled() or not hasattr(self, 'instr_cache'):
+                    instr_embedding = self._get_instr_embedding(instruction_vector)
+                else:
+                    instr_embedding = self._get_cached_instr_embedding(instruction_vector)
         else:
             instr_embedding = torch.zeros(len(img_vector), 1).to(img_vector.device)
         if self.use_instr and self.lang_model == "attgru":
@@ -447,9 +481,18 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
             memory = torch.cat(hidden, dim=1)
         else:
             embedding = x
+        return {"embedding": embedding, "memory": memory}
+
+    def forward_heads(self, trunk, advice_vector=None):
+        """
+        Runs the advice embedding and the actor and critic heads on the output of forward_trunk.
+        """
+        embedding = trunk['embedding']
+        memory = trunk['memory']
         reconstruction_embedding = embedding
 
         if self.advice_size > 0:
+            advice_embedding = self._get_advice_embedding(advice_vector)
             embedding = torch.cat([embedding, advice_embedding], dim=1)
 
         if self.info_bot:
@@ -497,6 +540,31 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
 
         return dist, info
 
+    def _get_cached_instr_embedding(self, instr):
+        """
+        Same as _get_instr_embedding, but only computes the embeddings of the instructions which aren't cached yet.
+        Must not be used when gradients are needed.
+        """
+        encoder_parameters = [self.word_embedding.weight, *self.instr_rnn.parameters()]
+        # The optimizer and load_state_dict update the parameters in place, which bumps their versions
+        version = tuple(p._version for p in encoder_parameters) + tuple(p.data_ptr() for p in encoder_parameters)
+        if version != self.instr_cache_version or len(self.instr_cache) > 10000:
+            self.instr_cache = {}
+            self.instr_cache_version = version
+        keys = [tuple(row) for row in instr.cpu().tolist()]
+        new_keys = list(dict.fromkeys(key for key in keys if key not in self.instr_cache))
+        if new_keys:
+            new_instr = torch.tensor(new_keys, dtype=instr.dtype, device=instr.device)
+            embeddings = self._get_instr_embedding(new_instr)
+            if self.lang_model == 'attgru':
+                # Keep only the outputs of the actual words, the batch decides how much they are padded
+                lengths = (new_instr != 0).sum(1).tolist()
+                embeddings = [embedding[:length] for embedding, length in zip(embeddings, lengths)]
+            self.instr_cache.update(zip(new_keys, embeddings))
+        if self.lang_model == 'attgru':
+            return pad_sequence([self.instr_cache[key] for key in keys], batch_first=True)
+        return torch.stack([self.instr_cache[key] for key in keys])
+
     def _get_instr_embedding(self, instr):
         lengths = (instr != 0).sum(1).long()
         if self.lang_model == 'gru':
@@ -509,10 +577,8 @@ class ACModel(nn.Module, babyai.rl.RecurrentACModel):
 
             if lengths.shape[0] > 1:
                 seq_lengths, perm_idx = lengths.sort(0, descending=True)
-                iperm_idx = torch.LongTensor(perm_idx.shape).fill_(0)
-                if instr.is_cuda: iperm_idx = iperm_idx.cuda()
-                for i, v in enumerate(perm_idx):
-                    iperm_idx[v.data] = i
+                iperm_idx = torch.empty_like(perm_idx)
+                iperm_idx[perm_idx] = torch.arange(len(perm_idx), device=perm_idx.device)
 
                 inputs = self.word_embedding(instr.long())
                 inputs = inputs[perm_idx]
@@ -52,10 +52,10 @@ class BatchTeacher:
             return_dict[k] = v.set_feedback_type(feedback_type)
         return return_dict
 
-    def reset(self, oracle):
+    def reset(self, oracle, vis_mask=None):
         return_dict = {}
         for k, v in self.teachers.items():
-            return_dict[k] = v.reset(oracle[k])
+            return_dict[k] = v.reset(oracle[k], vis_mask=vis_mask)
         return return_dict
 
     def get_last_step_error(self):
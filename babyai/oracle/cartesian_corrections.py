@@ -1,5 +1,4 @@
 import numpy as np
-import pickle as pkl
 from babyai.oracle.teacher import Teacher
 
 
@@ -24,9 +23,12 @@ class CartesianCorrections(Teacher):
         """
         Return the expert action from the previous timestep.
         """
-        # Copy so we don't mess up the state of the real oracle
-        oracle_copy = pkl.loads(pkl.dumps(oracle))
-        self.step_ahead(oracle_copy, last_action=last_action)
+        # Step ahead with a copy of the oracle, then roll the env back so we don't mess up the real state
+        env_snapshot = oracle.mission.snapshot()
+        try:
+            self.step_ahead(oracle.fork(), last_action=last_action)
+        finally:
+            oracle.mission.restore(env_snapshot)
         return np.array(self.next_state).flatten()
 
     def success_check(self, state, action, oracle):
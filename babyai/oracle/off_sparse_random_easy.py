@@ -1,5 +1,4 @@
 import numpy as np
-import pickle as pkl
 from babyai.oracle.teacher import Teacher
 
 
@@ -39,9 +38,12 @@ class OSREasy(Teacher):
         """
         Return the expert action from the previous timestep.
         """
-        # Copy so we don't mess up the state of the real oracle
-        oracle_copy = pkl.loads(pkl.dumps(oracle))
-        self.step_ahead(oracle_copy, last_action=last_action)
+        # Step ahead with a copy of the oracle, then roll the env back so we don't mess up the real state
+        env_snapshot = oracle.mission.snapshot()
+        try:
+            self.step_ahead(oracle.fork(), last_action=last_action)
+        finally:
+            oracle.mission.restore(env_snapshot)
         env = oracle.mission
         return self.generic_feedback(env)
 
@@ -96,7 +98,6 @@ class OSREasy(Teacher):
         :param state: Agent's current observation as a dictionary
         :return: Same dictionary with feedback in the "feedback" key of the dictionary
         """
-        oracle = pkl.loads(pkl.dumps(oracle))
         env = oracle.mission
         if self.feedback_condition(env, last_action):
             feedback = self.compute_feedback(oracle, last_action)
@@ -1,5 +1,4 @@
 import numpy as np
-import pickle as pkl
 from babyai.oracle.teacher import Teacher
 
 
@@ -25,9 +24,12 @@ class OFFSparse(Teacher):
         """
         Return the expert action from the previous timestep.
         """
-        # Copy so we don't mess up the state of the real oracle
-        oracle_copy = pkl.loads(pkl.dumps(oracle))
-        self.step_ahead(oracle_copy, last_action=last_action)
+        # Step ahead with a copy of the oracle, then roll the env back so we don't mess up the real state
+        env_snapshot = oracle.mission.snapshot()
+        try:
+            self.step_ahead(oracle.fork(), last_action=last_action)
+        finally:
+            oracle.mission.restore(env_snapshot)
         env = oracle.mission
         return np.concatenate([self.next_state_coords, (env.agent_pos - 12) / 12, [env.agent_dir / 3],
                                self.get_last_feedback_indicator()])
@@ -1,5 +1,4 @@
 import numpy as np
-import pickle as pkl
 from babyai.oracle.off_sparse_random_easy import OSREasy
 
 
@@ -12,9 +11,12 @@ class OSRMistaken(OSREasy):
         """
         Return the expert action from the previous timestep.
         """
-        # Copy so we don't mess up the state of the real oracle
-        oracle_copy = pkl.loads(pkl.dumps(oracle))
-        self.step_ahead(oracle_copy, last_action=last_action)
+        # Step ahead with a copy of the oracle, then roll the env back so we don't mess up the real state
+        env_snapshot = oracle.mission.snapshot()
+        try:
+            self.step_ahead(oracle.fork(), last_action=last_action)
+        finally:
+            oracle.mission.restore(env_snapshot)
         env = oracle.mission
         feedback = self.generic_feedback(env, offset=self.feedback_active)
         return np.concatenate([[int(self.feedback_active)], feedback])
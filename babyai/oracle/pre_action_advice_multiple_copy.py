@@ -1,5 +1,4 @@
 import numpy as np
-import pickle as pkl
 from babyai.oracle.teacher import Teacher
 import copy
 
@@ -27,9 +26,12 @@ class PreActionAdviceMultipleCopy(Teacher):
         """
         Return the expert action from the previous timestep.
         """
-        # Copy so we don't mess up the state of the real oracle
-        oracle_copy = pkl.loads(pkl.dumps(oracle))
-        self.step_ahead(oracle_copy, last_action=last_action)
+        # Step ahead with a copy of the oracle, then roll the env back so we don't mess up the real state
+        env_snapshot = oracle.mission.snapshot()
+        try:
+            self.step_ahead(oracle.fork(), last_action=last_action)
+        finally:
+            oracle.mission.restore(env_snapshot)
         action = -1 if self.steps_since_lastfeedback in [-1, None] else self.action_list[self.steps_since_lastfeedback]
         return np.concatenate([self.one_hotify(action), np.array([self.steps_since_lastfeedback])])
 
@@ -70,20 +70,18 @@ class Teacher:
 
     def replan(self, oracle, last_action):
         env = oracle.mission
-        # Generally we create a fresh oracle each time to prevent the teacher from getting stuck telling the agent
+        # Generally we restart the oracle's plan each time to prevent the teacher from getting stuck telling the agent
         # trying to undo old actions rather than correcting it from where it starts.
-        # However, when we're dropping an object off to unblock a path we need to keep the existing oracle
+        # However, when we're dropping an object off to unblock a path we need to keep the existing plan
         # so the agent doesn't lose track of why it's doing this and where it wants to drop it.
         drop_off = len(oracle.stack) > 0 and env.carrying and oracle.stack[-1].reason == 'DropOff' and \
                    (not last_action == env.actions.toggle)
         if drop_off or self.next_action == last_action:
             replan_output = oracle.replan(last_action)
         else:
-            new_oracle = self.botclass(env, rng=copy.deepcopy(oracle.rng), fully_observed=self.fully_observed)
-            new_oracle.vis_mask = oracle.vis_mask.copy()
-            new_oracle.step = oracle.step
-            replan_output = new_oracle.replan(-1)
-            oracle = new_oracle
+            # Same as replanning with a new oracle, which keeps the explored cells, but without rebuilding it
+            oracle.reset_plan()
+            replan_output = oracle.replan(-1)
         return oracle, replan_output
 
     def step_away_state(self, oracle, steps, last_action=-1):
@@ -158,8 +156,13 @@ class Teacher:
         else:
             return False
 
-    def reset(self, oracle):
-        oracle = self.botclass(oracle.mission, rng=copy.deepcopy(oracle.rng), fully_observed=self.fully_observed)
+    def reset(self, oracle, vis_mask=None):
+        """
+        :param vis_mask: visibility mask of the new oracle, with nothing explored yet (the level shares one between the
+            oracles of its teachers, which are reset with the same view). By default the oracle gets its own.
+        """
+        oracle = self.botclass(oracle.mission, rng=copy.deepcopy(oracle.rng), fully_observed=self.fully_observed,
+                               vis_mask=vis_mask)
         self.next_action, self.next_subgoal = oracle.replan()
         self.last_action = -1
         self.steps_since_lastfeedback = 0
@@ -0,0 +1,252 @@
+from collections import OrderedDict, deque
+import weakref
+
+from gym_minigrid.minigrid import OBJECT_TO_IDX, STATE_TO_IDX
+
+EMPTY = OBJECT_TO_IDX['empty']
+WALL = OBJECT_TO_IDX['wall']
+DOOR = OBJECT_TO_IDX['door']
+STATE_OPEN = STATE_TO_IDX['open']
+
+
+class PathPlanner:
+    """
+    Breadth first searches of the Bot, over flat cell indices (i * height + j).
+
+    Whether the search may go on from a cell (the cell is not a wall, a closed door or a blocker, and has been seen) is
+    computed for the whole grid at once by passable(). Searches towards a given position only depend on that mask, so
+    they are answered from a distance field to the position (computed once by a reverse search, then kept until the
+    mask changes, e.g. when a door is opened or new cells are seen). The planner is shared by all the bots of an env,
+    see for_env().
+
+    The searches return the same paths as the textbook BFS they replace: neighbors are queued in the same order (going
+    straight first), and the acceptance condition is checked before the cell is expanded.
+    """
+
+    # Distance fields kept by each planner
+    max_cached_fields = 256
+    # Planner of each env
+    planners = weakref.WeakKeyDictionary()
+    # Neighbors of each flat index, by grid shape
+    neighbor_tables = {}
+
+    def __init__(self):
+        # (shape, target index, passable mask bytes) -> distance of each cell to the target (-1 if unreachable)
+        self.fields = OrderedDict()
+
+    @classmethod
+    def for_env(cls, env):
+        if env not in cls.planners:
+            cls.planners[env] = cls()
+        return cls.planners[env]
+
+    @classmethod
+    def neighbors(cls, shape):
+        if shape not in cls.neighbor_tables:
+            width, height = shape
+            table = []
+            for i in range(width):
+                for j in range(height):
+                    table.append([k * height + l for k, l in [(i + 1, j), (i, j + 1), (i, j - 1), (i - 1, j)]
+                                  if 0 <= k < width and 0 <= l < height])
+            cls.neighbor_tables[shape] = table
+        return cls.neighbor_tables[shape]
+
+    @staticmethod
+    def passable(grid, vis_mask=None, ignore_blockers=False, plan_through_doors=False):
+        """
+        Cells from which a search can go on to the neighbors.
+        :param grid: grid of the env
+        :param vis_mask: cells seen by the bot, or None if the search is not restricted to them
+        :return: (width, height) bool array
+        """
+        array = grid.encode()
+        types = array[..., 0]
+        mask = types == EMPTY
+        if plan_through_doors:
+            mask |= types == DOOR
+        else:
+            mask |= (types == DOOR) & (array[..., 2] == STATE_OPEN)
+        if ignore_blockers:
+            mask |= (types != WALL) & (types != DOOR)
+        if vis_mask is not None:
+            mask &= vis_mask
+        return mask
+
+    def distances(self, passable, target):
+        """
+        Number of steps from each cell to the target, going only through passable cells (the target itself doesn't
+        need to be passable). Returns the field and whether it had to be computed.
+        """
+        shape = passable.shape
+        target = target[0] * shape[1] + target[1]
+        key = (shape, target, passable.tobytes())
+        if key in self.fields:
+            self.fields.move_to_end(key)
+            return self.fields[key], False
+
+        neighbors = self.neighbors(shape)
+        is_passable = passable.ravel().tolist()
+        distance = [-1] * len(is_passable)
+        distance[target] = 0
+        queue = deque([target])
+        while queue:
+            index = queue.popleft()
+            next_distance = distance[index] + 1
+            for neighbor in neighbors[index]:
+                if distance[neighbor] < 0 and is_passable[neighbor]:
+                    distance[neighbor] = next_distance
+                    queue.append(neighbor)
+
+        self.fields[key] = distance
+        if len(self.fields) > self.max_cached_fields:
+            self.fields.popitem(last=False)
+        return distance, True
+
+    @staticmethod
+    def next_step(distance, shape, pos, dir_vec):
+        """
+        First cell of the path found by a BFS from pos (facing dir_vec) to the target of a distance field, and the
+        length of that path. The BFS reaches each cell first through the earliest queued neighbor of pos from which
+        it is the closest, so the first cell is the earliest neighbor one step closer to the target.
+        :return: (next cell or None if pos is the target or can't reach it, path length or None)
+        """
+        width, height = shape
+        i, j = pos
+        remaining = distance[i * height + j]
+        if remaining < 0:
+            return None, None
+        if remaining == 0:
+            return None, 0
+        di, dj = dir_vec
+        for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
+            if 0 <= i + k < width and 0 <= j + l < height and distance[(i + k) * height + j + l] == remaining - 1:
+                return (i + k, j + l), remaining
+        raise AssertionError('inconsistent distance field')
+
+    @staticmethod
+    def search(grid, passable, initial_states, accept_fn):
+        """
+        BFS from the initial states (i, j, di, dj) to the first cell satisfying accept_fn(pos, cell).
+        :return: (path from the cell back to its initial state or None, cell or None,
+                  dict of the previous cell of each visited cell, number of visited cells)
+        """
+        height = passable.shape[1]
+        is_passable = passable.ravel().tolist()
+        queue = deque((state, None) for state in initial_states)
+        previous_pos = dict()
+
+        while queue:
+            (i, j, di, dj), prev_pos = queue.popleft()
+            if (i, j) in previous_pos:
+                continue
+            previous_pos[(i, j)] = prev_pos
+
+            # If we reached a position satisfying the acceptance condition
+            if accept_fn((i, j), grid.get(i, j)):
+                path = []
+                pos = (i, j)
+                while pos:
+                    path.append(pos)
+                    pos = previous_pos[pos]
+                return path, (i, j), previous_pos, len(previous_pos)
+
+            if not is_passable[i * height + j]:
+                continue
+
+            # Location to which the bot can get without turning
+            # are put in the queue first
+            for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
+                queue.append(((i + k, j + l, k, l), (i, j)))
+
+        # Path not found
+        return None, None, previous_pos, len(previous_pos)
+
+
+def test(num_steps=100):
+    """
+    Check the searches and distance fields of PathPlanner against the textbook BFS of the Bot, on seeded levels as
+    they change under random actions
+    """
+    import random
+    from babyai.bot import Bot
+    from babyai.levels.iclr19_levels import Level_GoToLocalS5N2, Level_PutNextLocalS5N2, Level_OpenLocalS5N2, \
+        Level_GoToObjMazeS4, Level_GoToObjMaze
+
+    def reference_search(grid, vis_mask, initial_states, accept_fn, ignore_blockers, plan_through_doors):
+        queue = [(state, None) for state in initial_states]
+        previous_pos = dict()
+        while len(queue) > 0:
+            state, prev_pos = queue[0]
+            queue = queue[1:]
+            i, j, di, dj = state
+            if (i, j) in previous_pos:
+                continue
+            cell = grid.get(i, j)
+            previous_pos[(i, j)] = prev_pos
+            if accept_fn((i, j), cell):
+                path = []
+                pos = (i, j)
+                while pos:
+                    path.append(pos)
+                    pos = previous_pos[pos]
+                return path, (i, j), previous_pos
+            if vis_mask is not None and not vis_mask[i, j]:
+                continue
+            if cell:
+                if cell.type == 'wall':
+                    continue
+                elif cell.type == 'door':
+                    if not plan_through_doors and not cell.is_open:
+                        continue
+                elif not ignore_blockers:
+                    continue
+            for k, l in [(di, dj), (dj, di), (-dj, -di), (-di, -dj)]:
+                queue.append(((i + k, j + l, k, l), (i, j)))
+        return None, None, previous_pos
+
+    for level in [Level_GoToLocalS5N2, Level_PutNextLocalS5N2, Level_OpenLocalS5N2, Level_GoToObjMazeS4,
+                  Level_GoToObjMaze]:
+        print('PathPlanner on %s' % level.__name__)
+        rng = random.Random(0)
+        env = level(seed=0)
+        env.reset()
+        bot = Bot(env)
+        for _ in range(num_steps):
+            bot._process_obs()
+            grid = env.grid
+            planner = PathPlanner.for_env(env)
+            initial_states = [(*env.agent_pos, *env.dir_vec)]
+            # The objects, and the agent's own cell (empty path)
+            targets = [tuple(env.agent_pos)] + [(i, j) for i in range(grid.width) for j in range(grid.height)
+                                                if grid.get(i, j) is not None and grid.get(i, j).type != 'wall']
+            for target in targets:
+                accept_fn = lambda pos, cell: pos == target
+                for vis_mask in [bot.vis_mask, None]:
+                    for plan_through_doors in [False, True]:
+                        for ignore_blockers in [False, True]:
+                            passable = planner.passable(grid, vis_mask, ignore_blockers, plan_through_doors)
+                            path, finish, previous_pos, num_visited = planner.search(
+                                grid, passable, initial_states, accept_fn)
+                            expected = reference_search(
+                                grid, vis_mask, initial_states, accept_fn, ignore_blockers, plan_through_doors)
+                            assert (path, finish, previous_pos) == expected
+                            assert num_visited == len(expected[2])
+
+                        # Distance fields, as used by Bot._shortest_path_to()
+                        passable = planner.passable(grid, vis_mask, plan_through_doors=plan_through_doors)
+                        distance, _ = planner.distances(passable, target)
+                        next_cell, length = planner.next_step(distance, passable.shape, env.agent_pos, env.dir_vec)
+                        path, _, _ = reference_search(grid, vis_mask, initial_states, accept_fn, False,
+                                                      plan_through_doors)
+                        if path is None:
+                            assert (next_cell, length) == (None, None)
+                        else:
+                            path = path[::-1][1:]
+                            assert next_cell == (path[0] if path else None)
+                            assert length == len(path)
+
+            _, _, done, _ = env.step(rng.randint(0, env.action_space.n - 1))
+            if done:
+                env.reset()
+                bot = Bot(env)
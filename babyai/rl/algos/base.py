@@ -5,9 +5,8 @@ from meta_mb.logger import logger
 import time
 
 from babyai.rl.format import default_preprocess_obss
-from babyai.rl.utils import DictList, ParallelEnv, SequentialEnv
+from babyai.rl.utils import DictList, ParallelEnv, SequentialEnv, BatchedRoomGridEnv
 from babyai.rl.utils.supervised_losses import ExtraInfoCollector
-from babyai.rl.utils.dictlist import merge_dictlists
 
 
 class BaseAlgo(ABC):
@@ -15,7 +14,8 @@ class BaseAlgo(ABC):
 
     def __init__(self, envs, acmodel, num_frames_per_proc, discount, lr, gae_lambda, entropy_coef,
                  value_loss_coef, max_grad_norm, recurrence, preprocess_obss, reshape_reward, aux_info, parallel,
-                 rollouts_per_meta_task=1, instr_dropout_prob=.5, repeated_seed=None, reset_each_batch=False):
+                 rollouts_per_meta_task=1, instr_dropout_prob=.5, repeated_seed=None, reset_each_batch=False,
+                 batched_env=False, shared_memory_env=False, pipelined_collection=False, inline_first_env=True):
         """
         Initializes a `BaseAlgo` instance.
 
@@ -51,14 +51,41 @@ class BaseAlgo(ABC):
         aux_info : list
             a list of strings corresponding to the name of the extra information
             retrieved from the environment for supervised auxiliary losses
+        batched_env : bool
+            if True, step all the environments at once with a BatchedRoomGridEnv
+        shared_memory_env : bool
+            if True (and parallel), the env workers send observations back through shared memory
+        pipelined_collection : bool
+            if True (and parallel), split the environments into two groups and compute the actions
+            of one group while the other one is stepping
+        inline_first_env : bool
+            if False (and parallel), run the first environment in its own worker instead of the main process
 
         """
         # Store parameters
 
-        if parallel:
-            self.env = ParallelEnv(envs, rollouts_per_meta_task, repeated_seed=repeated_seed)
+        if batched_env:
+            reason = BatchedRoomGridEnv.unsupported_reason(envs)
+            if reason is not None:
+                print(f"Can't batch these envs ({reason}), stepping them separately instead")
+                batched_env = False
+        if batched_env:
+            self.env = BatchedRoomGridEnv(envs, rollouts_per_meta_task, repeated_seed=repeated_seed)
+        elif parallel:
+            # The ring must keep every observation of a rollout, plus the last one, valid
+            self.env = ParallelEnv(envs, rollouts_per_meta_task, repeated_seed=repeated_seed,
+                                   shared_memory=shared_memory_env, ring_size=num_frames_per_proc + 2,
+                                   inline_first_env=inline_first_env)
         else:
             self.env = SequentialEnv(envs, rollouts_per_meta_task, repeated_seed=repeated_seed)
+        if pipelined_collection and not (isinstance(self.env, ParallelEnv) and len(envs) > 1 and not aux_info):
+            print("Pipelined collection needs a ParallelEnv with at least 2 envs and no aux_info, "
+                  "collecting all the envs in lock-step instead")
+            pipelined_collection = False
+        self.pipelined_collection = pipelined_collection
+        # The two groups of envs which alternate between inference and stepping. They are contiguous, so the
+        # experience tensors of a group can be written through a slice
+        self.env_groups = [range(len(envs) // 2), range(len(envs) // 2, len(envs))]
         self.policy_dict = acmodel
         for policy in self.policy_dict.values():
             policy.train()
@@ -171,113 +198,39 @@ class BaseAlgo(ABC):
             self.obs = self.env.reset()
 
         # TODO: Make this handle the case where the meta_rollout length > 1
-        for i in range(self.num_frames_per_proc):
-            # Do one agent-environment interaction
-            instr_dropout_prob = self.instr_dropout_prob
-            preprocessed_obs = [self.preprocess_obss([o], teacher_dict,
-                                                     show_instrs=np.random.uniform() > instr_dropout_prob)
-                for o in self.obs]
-            preprocessed_obs = merge_dictlists(preprocessed_obs)
-
-            with torch.no_grad():
-                dist, model_results = acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1))
-                value = model_results['value']
-                memory = model_results['memory']
-                extra_predictions = None
-
-            action = dist.sample()
-            action_to_take = action.cpu().numpy()
-
-            if collect_with_oracle:
-                action_to_take = self.env.get_teacher_action()
-            elif use_dagger:
-                with torch.no_grad():
-                    dagger_obs = self.preprocess_obss(self.obs, dagger_dict,
-                                                     show_instrs=np.random.uniform() > instr_dropout_prob)
-                    dagger_teachers = [k for k, v in teacher_dict.items() if v]
-                    assert len(dagger_teachers) < 2
-                    teacher = 'none' if len(active_teachers) == 0 else active_teachers[0]
-                    dagger_model = self.policy_dict[teacher]
-                    dagger_dist, dagger_model_results = dagger_model(dagger_obs,
-                                                                     self.dagger_memory * self.mask.unsqueeze(1))
-                    self.dagger_memory = dagger_model_results['memory']
-                    action_to_take = dagger_dist.sample().cpu().numpy()
-
-            obs, reward, done, env_info = self.env.step(action_to_take)
-            if not collect_reward:
-                reward = [np.nan for _ in reward]
-
-            # Update experiences values
-
-            self.env_infos[i] = env_info
-            self.obss[i] = self.obs
-            self.obs = obs
-            try:
-                self.teacher_actions[i] = torch.FloatTensor([ei['teacher_action'] for ei in env_info]).to(self.device)
-            except:
-                self.teacher_actions[i] = self.teacher_actions[i] * 0 - 1  # TODO: compute teacher action for new envs
-
-            self.memories[i] = self.memory
-            self.memory = memory
-
-            self.masks[i] = self.mask
-            done_tensor = torch.FloatTensor(done).to(self.device)
-            self.done_index = done_tensor + self.done_index
-
-            done_meta = self.done_index == self.rollouts_per_meta_task
-            self.done_index = torch.remainder(self.done_index, self.rollouts_per_meta_task)
-            self.dones[i] = done_tensor
-            self.mask = 1 - done_meta.to(torch.int32)
-            self.actions[i] = action
-            if self.discrete:
-                probs = dist.probs
-                self.action_probs[i] = probs
-            else:
-                self.argmax_action[i] = dist.mean
-            self.values[i] = value
-            if self.reshape_reward is not None:
-                self.rewards[i] = torch.tensor([
-                    self.reshape_reward(obs_, action_, reward_, done_)
-                    for obs_, action_, reward_, done_ in zip(obs, action, reward, done)
-                ], device=self.device)
-            else:
-                self.rewards[i] = torch.tensor(reward, device=self.device)
-            log_prob = dist.log_prob(action)
-            # take log prob from the univariate normal, sum it to get multivariate normal
-            if len(log_prob.shape) == 2:
-                log_prob = log_prob.sum(axis=-1)
-            self.log_probs[i] = log_prob
-
-            if self.aux_info:
-                self.aux_info_collector.fill_dictionaries(i, env_info, extra_predictions)
-
-            # Update log values
-
-            self.log_episode_return += torch.tensor(reward, device=self.device, dtype=torch.float)
-            self.log_episode_success += torch.tensor([e['success'] for e in env_info], device=self.device, dtype=torch.float)
-            self.log_episode_reshaped_return += self.rewards[i]
-            self.log_episode_num_frames += torch.ones(self.num_procs, device=self.device)
-
-            for i, done_ in enumerate(done):
-                if done_:
-                    self.log_done_counter += 1
-                    self.log_return.append(self.log_episode_return[i].item())
-                    self.log_success.append(self.log_episode_success[i].item())
-                    if 'dist_to_goal' in env_info[i]:
-                        self.log_dist_to_goal.append(env_info[i]['dist_to_goal'].item())
-                    self.log_reshaped_return.append(self.log_episode_reshaped_return[i].item())
-                    self.log_num_frames.append(self.log_episode_num_frames[i].item())
-
-            self.mask = self.mask.float()
-            self.log_episode_return *= self.mask
-            self.log_episode_success *= self.mask
-            self.log_episode_reshaped_return *= self.mask
-            self.log_episode_num_frames *= self.mask
+        if self.pipelined_collection:
+            # Double-buffered collection: while one group of envs steps in the workers, compute the actions of the
+            # other one. Each group is always handled in the same order, so the random draws (and so the rollouts)
+            # only depend on the seeds, not on which workers finish first.
+            self.obs = list(self.obs)
+            self.obss = [[None] * self.num_procs for _ in range(self.num_frames_per_proc)]
+            self.env_infos = [[None] * self.num_procs for _ in range(self.num_frames_per_proc)]
+            actions = []
+            for idx in self.env_groups:
+                action, action_to_take = self.act(0, idx, acmodel, teacher_dict, use_dagger, dagger_dict,
+                                                  collect_with_oracle)
+                self.env.step_async(action_to_take, idx)
+                actions.append(action)
+            for i in range(self.num_frames_per_proc):
+                for g, idx in enumerate(self.env_groups):
+                    obs, reward, done, env_info = self.env.step_wait(idx)
+                    self.record(i, idx, actions[g], obs, reward, done, env_info, collect_reward)
+                    if i + 1 < self.num_frames_per_proc:
+                        actions[g], action_to_take = self.act(i + 1, idx, acmodel, teacher_dict, use_dagger,
+                                                              dagger_dict, collect_with_oracle)
+                        self.env.step_async(action_to_take, idx)
+        else:
+            for i in range(self.num_frames_per_proc):
+                # Do one agent-environment interaction
+                action, action_to_take = self.act(i, None, acmodel, teacher_dict, use_dagger, dagger_dict,
+                                                  collect_with_oracle)
+                obs, reward, done, env_info = self.env.step(action_to_take)
+                self.record(i, None, action, obs, reward, done, env_info, collect_reward)
 
         # Add advantage and return to experiences
 
         preprocessed_obs = self.preprocess_obss(self.obs, teacher_dict,
-                                                     show_instrs=np.random.uniform() > instr_dropout_prob)
+                                                show_instrs=np.random.uniform() > self.instr_dropout_prob)
         with torch.no_grad():
             next_value = acmodel(preprocessed_obs, self.memory * self.mask.unsqueeze(1))[1]['value']
 
@@ -296,8 +249,8 @@ class BaseAlgo(ABC):
         exps.obs = [self.obss[i][j]
                     for j in range(self.num_procs)
                     for i in range(self.num_frames_per_proc)]
-        keys = list(env_info[0].keys())
-        batch = len(env_info)
+        keys = list(self.env_infos[-1][0].keys())
+        batch = self.num_procs
         timesteps = len(self.env_infos)
         env_info_dict = {}
         for k in keys:
@@ -384,6 +337,124 @@ class BaseAlgo(ABC):
                 log[key] = np.sum(getattr(exps.env_infos, key))
         return exps, log
 
+    def act(self, i, idx, acmodel, teacher_dict, use_dagger, dagger_dict, collect_with_oracle):
+        """
+        Computes the actions of the envs in the range idx (all of them if None) for step i, and stores the model outputs.
+
+        Returns the sampled actions and the actions to take in the envs.
+        """
+        sel = slice(None) if idx is None else slice(idx.start, idx.stop)
+        obs = self.obs if idx is None else [self.obs[j] for j in idx]
+        instr_dropout_prob = self.instr_dropout_prob
+        # Drop the instructions independently for each env
+        show_instrs = np.random.uniform(size=len(obs)) > instr_dropout_prob
+        preprocessed_obs = self.preprocess_obss(obs, teacher_dict, show_instrs=show_instrs)
+
+        with torch.no_grad():
+            dist, model_results = acmodel(preprocessed_obs, self.memory[sel] * self.mask[sel].unsqueeze(1))
+            value = model_results['value']
+            memory = model_results['memory']
+
+        action = dist.sample()
+        action_to_take = action.cpu().numpy()
+
+        if collect_with_oracle:
+            action_to_take = self.env.get_teacher_action() if idx is None else self.env.get_teacher_action(idx)
+        elif use_dagger:
+            with torch.no_grad():
+                dagger_obs = self.preprocess_obss(obs, dagger_dict,
+                                                  show_instrs=np.random.uniform() > instr_dropout_prob)
+                dagger_teachers = [k for k, v in teacher_dict.items() if v]
+                assert len(dagger_teachers) < 2
+                teacher = 'none' if len(dagger_teachers) == 0 else dagger_teachers[0]
+                dagger_model = self.policy_dict[teacher]
+                dagger_dist, dagger_model_results = dagger_model(dagger_obs,
+                                                                 self.dagger_memory[sel] * self.mask[sel].unsqueeze(1))
+                self.dagger_memory[sel] = dagger_model_results['memory']
+                action_to_take = dagger_dist.sample().cpu().numpy()
+
+        self.memories[i, sel] = self.memory[sel]
+        self.memory[sel] = memory
+        self.masks[i, sel] = self.mask[sel]
+        self.actions[i, sel] = action
+        if self.discrete:
+            self.action_probs[i, sel] = dist.probs
+        else:
+            self.argmax_action[i, sel] = dist.mean
+        self.values[i, sel] = value
+        log_prob = dist.log_prob(action)
+        # take log prob from the univariate normal, sum it to get multivariate normal
+        if len(log_prob.shape) == 2:
+            log_prob = log_prob.sum(axis=-1)
+        self.log_probs[i, sel] = log_prob
+        return action, action_to_take
+
+    def record(self, i, idx, action, obs, reward, done, env_info, collect_reward):
+        """
+        Stores the results of step i of the envs in the range idx (all of them if None), taken with the actions from act().
+        """
+        sel = slice(None) if idx is None else slice(idx.start, idx.stop)
+        if not collect_reward:
+            reward = [np.nan for _ in reward]
+
+        # Update experiences values
+
+        if idx is None:
+            self.env_infos[i] = env_info
+            self.obss[i] = self.obs
+            self.obs = obs
+        else:
+            for j, obs_, env_info_ in zip(idx, obs, env_info):
+                self.env_infos[i][j] = env_info_
+                self.obss[i][j] = self.obs[j]
+                self.obs[j] = obs_
+        try:
+            self.teacher_actions[i, sel] = torch.FloatTensor([ei['teacher_action'] for ei in env_info]).to(self.device)
+        except:
+            self.teacher_actions[i, sel] = self.teacher_actions[i, sel] * 0 - 1  # TODO: compute teacher action for new envs
+
+        done_tensor = torch.FloatTensor(done).to(self.device)
+        self.done_index[sel] = done_tensor + self.done_index[sel]
+
+        done_meta = self.done_index[sel] == self.rollouts_per_meta_task
+        self.done_index[sel] = torch.remainder(self.done_index[sel], self.rollouts_per_meta_task)
+        self.dones[i, sel] = done_tensor
+        self.mask[sel] = 1 - done_meta.float()
+        if self.reshape_reward is not None:
+            self.rewards[i, sel] = torch.tensor([
+                self.reshape_reward(obs_, action_, reward_, done_)
+                for obs_, action_, reward_, done_ in zip(obs, action, reward, done)
+            ], device=self.device)
+        else:
+            self.rewards[i, sel] = torch.tensor(reward, device=self.device)
+
+        if self.aux_info:
+            self.aux_info_collector.fill_dictionaries(i, env_info, None)
+
+        # Update log values
+
+        self.log_episode_return[sel] += torch.tensor(reward, device=self.device, dtype=torch.float)
+        self.log_episode_success[sel] += torch.tensor([e['success'] for e in env_info], device=self.device,
+                                                      dtype=torch.float)
+        self.log_episode_reshaped_return[sel] += self.rewards[i, sel]
+        self.log_episode_num_frames[sel] += 1
+
+        env_ids = range(self.num_procs) if idx is None else idx
+        for k, (j, done_) in enumerate(zip(env_ids, done)):
+            if done_:
+                self.log_done_counter += 1
+                self.log_return.append(self.log_episode_return[j].item())
+                self.log_success.append(self.log_episode_success[j].item())
+                if 'dist_to_goal' in env_info[k]:
+                    self.log_dist_to_goal.append(env_info[k]['dist_to_goal'].item())
+                self.log_reshaped_return.append(self.log_episode_reshaped_return[j].item())
+                self.log_num_frames.append(self.log_episode_num_frames[j].item())
+
+        self.log_episode_return[sel] *= self.mask[sel]
+        self.log_episode_success[sel] *= self.mask[sel]
+        self.log_episode_reshaped_return[sel] *= self.mask[sel]
+        self.log_episode_num_frames[sel] *= self.mask[sel]
+
     @abstractmethod
     def update_parameters(self):
         pass
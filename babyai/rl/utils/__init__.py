@@ -1,2 +1,3 @@
 from babyai.rl.utils.dictlist import DictList
 from babyai.rl.utils.penv import ParallelEnv, SequentialEnv
+from babyai.rl.utils.benv import BatchedRoomGridEnv
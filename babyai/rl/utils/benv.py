@@ -0,0 +1,447 @@
+import gym
+import numpy as np
+from gym_minigrid.minigrid import OBJECT_TO_IDX, COLOR_TO_IDX, DIR_TO_VEC
+
+from babyai.levels.verifier import GoToInstr, OpenInstr, PickupInstr, PutNextInstr
+
+# Door states, as in Door.encode()
+STATE_OPEN = 0
+STATE_CLOSED = 1
+STATE_LOCKED = 2
+
+EMPTY = OBJECT_TO_IDX['empty']
+WALL = OBJECT_TO_IDX['wall']
+DOOR = OBJECT_TO_IDX['door']
+KEY = OBJECT_TO_IDX['key']
+BALL = OBJECT_TO_IDX['ball']
+BOX = OBJECT_TO_IDX['box']
+GOAL = OBJECT_TO_IDX['goal']
+LAVA = OBJECT_TO_IDX['lava']
+WALL_ENCODING = (WALL, COLOR_TO_IDX['grey'], 0)
+
+# Mission kinds understood by the batched verifier
+GOTO, OPEN, PICKUP, PUTNEXT = range(4)
+SUPPORTED_INSTRS = (GoToInstr, OpenInstr, PickupInstr, PutNextInstr)
+
+
+def unsupported_reason(env):
+    """
+    Why BatchedRoomGridEnv can't simulate env in its current task, or None if it can.
+    """
+    if getattr(env, 'grid', None) is None or not hasattr(env, 'instrs'):
+        return f"{type(env).__name__} is not a BabyAI level"
+    if getattr(env, 'teacher', None) is not None:
+        return "teachers are not simulated"
+    if getattr(env, 'padding', False):
+        return "padded observations are not supported"
+    if not isinstance(env.instrs, SUPPORTED_INSTRS):
+        return f"{type(env.instrs).__name__} missions are not supported"
+    # Opening a box replaces it by its contents. Level_TeachableRobot.prevent_teacher_errors() makes boxes
+    # contain themselves, so that they don't disappear.
+    boxes = [obj for obj in env.grid.grid if obj is not None and obj.type == 'box']
+    keep_boxes = [box.contains is box for box in boxes]
+    if any(box.contains is not None and box.contains is not box for box in boxes) or \
+            (any(keep_boxes) and not all(keep_boxes)):
+        return "objects inside boxes are not supported"
+    return None
+
+
+def view_offsets(view_size):
+    """
+    Offsets from the agent position of every cell of the egocentric view, for each of the 4 agent directions.
+    The agent is at (view_size // 2, view_size - 1) in the view, looking towards decreasing j (as in gen_obs_grid).
+    :return: int array of shape (4, view_size, view_size, 2)
+    """
+    vi, vj = np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij')
+    offsets = np.zeros((4, view_size, view_size, 2), dtype=np.int64)
+    for agent_dir, (dx, dy) in enumerate(DIR_TO_VEC):
+        f_vec = np.array([dx, dy])
+        r_vec = np.array([-dy, dx])
+        offsets[agent_dir] = f_vec * (view_size - 1 - vj)[..., None] + r_vec * (vi - view_size // 2)[..., None]
+    return offsets
+
+
+class BatchedRoomGridEnv(gym.Env):
+    """
+    Steps N BabyAI envs at once, storing their grids as one stacked array of (type, color, state) planes and the agent
+    poses as arrays, so that moving, turning, picking up, dropping, toggling, verifying the mission and generating the
+    egocentric views are array operations over all envs.
+
+    The original envs are only used to generate a new task when an env is reset; their grid is then loaded into the
+    arrays and is not updated while the batched env is stepped. Only single-clause missions (go to, open, pick up,
+    put next) of envs without a teacher are supported; use unsupported_reason() to check envs before batching them.
+    """
+
+    def __init__(self, envs, rollouts_per_meta_task, repeated_seed=None):
+        assert len(envs) >= 1, "No environment given."
+        reason = self.unsupported_reason(envs)
+        if reason is not None:
+            raise ValueError(f"BatchedRoomGridEnv can't step these envs: {reason}")
+
+        self.envs = envs
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.rollouts_per_meta_task = rollouts_per_meta_task
+        self.repeated_seed = repeated_seed
+        assert repeated_seed is None or len(repeated_seed) == len(envs), \
+            f"repeated seed has length {len(repeated_seed)} but should have length {len(envs)}"
+
+        self.num_envs = len(envs)
+        self.view_size = self.envs[0].agent_view_size
+        self.pad = self.view_size
+        self.offsets = view_offsets(self.view_size)
+        self.dir_vec = np.array(DIR_TO_VEC)
+        self.actions = self.envs[0].actions
+        self.env_index = np.arange(self.num_envs)
+        self.grid = None
+        self._allocate(1, 1)
+
+        n = self.num_envs
+        self.agent_pos = np.zeros((n, 2), dtype=np.int64)
+        self.agent_dir = np.zeros(n, dtype=np.int64)
+        self.carrying = np.zeros((n, 3), dtype=np.uint8)
+        self.carrying_id = np.zeros(n, dtype=np.int64)
+        self.step_count = np.zeros(n, dtype=np.int64)
+        self.max_steps = np.zeros(n, dtype=np.int64)
+        self.see_through_walls = np.zeros(n, dtype=bool)
+        self.fully_observed = np.zeros(n, dtype=bool)
+        self.keep_boxes = np.zeros(n, dtype=bool)
+        self.kind = np.zeros(n, dtype=np.int64)
+        self.strict = np.zeros(n, dtype=bool)
+        self.instr = [None] * n
+        self.itr = np.zeros(n, dtype=np.int64)
+
+    @staticmethod
+    def unsupported_reason(envs):
+        """
+        Why these envs can't be batched (judging from their current task), or None if they can.
+        """
+        for i, env in enumerate(envs):
+            reason = unsupported_reason(env)
+            if reason is not None:
+                return f"env {i}: {reason}"
+        return None
+
+    def _allocate(self, width, height):
+        """
+        (Re)allocate the grid arrays so they fit width x height grids, keeping the grids already loaded.
+        Cells outside of an env's grid are walls, like the cells outside of the grid in Grid.slice().
+        """
+        if self.grid is not None and width <= self.width and height <= self.height:
+            return
+        if self.grid is not None:
+            width, height = max(width, self.width), max(height, self.height)
+        n, p = self.num_envs, self.pad
+        grid = np.empty((n, width + 2 * p, height + 2 * p, 3), dtype=np.uint8)
+        grid[:] = WALL_ENCODING
+        # Object identities, used to track the objects the mission refers to (0 means no object)
+        obj_id = np.zeros((n, width + 2 * p, height + 2 * p), dtype=np.int64)
+        desc_pos = np.zeros((n, width + 2 * p, height + 2 * p), dtype=bool)
+        fixed_pos = np.zeros((n, width + 2 * p, height + 2 * p), dtype=bool)
+        desc_ids = np.zeros((n, (width + 2 * p) * (height + 2 * p) + 1), dtype=bool)
+        fixed_ids = np.zeros_like(desc_ids)
+        if self.grid is not None:
+            w, h = self.grid.shape[1:3]
+            grid[:, :w, :h] = self.grid
+            obj_id[:, :w, :h] = self.obj_id
+            desc_pos[:, :w, :h] = self.desc_pos
+            fixed_pos[:, :w, :h] = self.fixed_pos
+            desc_ids[:, :self.desc_ids.shape[1]] = self.desc_ids
+            fixed_ids[:, :self.fixed_ids.shape[1]] = self.fixed_ids
+        self.width, self.height = width, height
+        self.grid, self.obj_id = grid, obj_id
+        self.desc_pos, self.fixed_pos = desc_pos, fixed_pos
+        self.desc_ids, self.fixed_ids = desc_ids, fixed_ids
+
+    def _load(self, i):
+        """
+        Copy the state of self.envs[i], which was just reset, into the arrays.
+        """
+        env = self.envs[i]
+        # Levels can generate missions the batched env doesn't support after it was created
+        reason = unsupported_reason(env)
+        if reason is not None:
+            raise NotImplementedError(f"BatchedRoomGridEnv can't step env {i} any more ({reason}), run without "
+                                      f"--batched_env")
+        p = self.pad
+        width, height = env.grid.width, env.grid.height
+        self._allocate(width, height)
+
+        self.grid[i] = WALL_ENCODING
+        self.grid[i, p:p + width, p:p + height] = env.grid.encode()
+        self.obj_id[i] = 0
+        ids = {}
+        boxes = []
+        for k, obj in enumerate(env.grid.grid):
+            if obj is None or obj.type == 'wall':
+                continue
+            if obj.type == 'box':
+                boxes.append(obj)
+            x, y = k % width, k // width
+            ids[id(obj)] = len(ids) + 1
+            self.obj_id[i, p + x, p + y] = ids[id(obj)]
+
+        # Boxes which contain themselves stay in the grid when they are opened
+        self.keep_boxes[i] = any(box.contains is box for box in boxes)
+
+        self.agent_pos[i] = np.array(env.agent_pos) + p
+        self.agent_dir[i] = env.agent_dir
+        self.carrying[i] = env.carrying.encode() if env.carrying is not None else (0, 0, 0)
+        if env.carrying is not None:
+            ids[id(env.carrying)] = len(ids) + 1
+        self.carrying_id[i] = ids[id(env.carrying)] if env.carrying is not None else 0
+        self.step_count[i] = env.step_count
+        self.max_steps[i] = env.max_steps
+        self.see_through_walls[i] = env.see_through_walls
+        self.fully_observed[i] = getattr(env, 'fully_observed', False)
+        self.itr[i] = getattr(env, 'itr', 0)
+
+        instrs = env.instrs
+        self.strict[i] = getattr(instrs, 'strict', False)
+        if isinstance(instrs, GoToInstr):
+            self.kind[i], desc, fixed = GOTO, instrs.desc, None
+        elif isinstance(instrs, OpenInstr):
+            self.kind[i], desc, fixed = OPEN, instrs.desc, None
+        elif isinstance(instrs, PickupInstr):
+            self.kind[i], desc, fixed = PICKUP, instrs.desc, None
+        else:
+            self.kind[i], desc, fixed = PUTNEXT, instrs.desc_move, instrs.desc_fixed
+        self.desc_ids[i] = False
+        self.desc_ids[i, [ids[id(obj)] for obj in desc.obj_set]] = True
+        self.fixed_ids[i] = False
+        if fixed is not None:
+            self.fixed_ids[i, [ids[id(obj)] for obj in fixed.obj_set]] = True
+        self._update_objs_poss(np.array([i]))
+
+        self.instr[i] = np.array(env.to_vocab_index(env.mission, pad_length=15))
+
+    def _update_objs_poss(self, idx):
+        """
+        Positions of the tracked objects which are still in the grid (ObjDesc.find_matching_objs(use_location=False))
+        """
+        self.desc_pos[idx] = self.desc_ids[idx[:, None, None], self.obj_id[idx]]
+        self.fixed_pos[idx] = self.fixed_ids[idx[:, None, None], self.obj_id[idx]]
+
+    def _reset_env(self, i):
+        env = self.envs[i]
+        if self.repeated_seed is not None:
+            env.seed(self.repeated_seed[i])
+        env.set_task(None)
+        env.reset()
+        self._load(i)
+
+    def gen_obs(self, idx=None):
+        """
+        Generate the observation dicts of the given envs, as Level_TeachableRobot.gen_obs() would.
+        """
+        if idx is None:
+            idx = self.env_index
+        image = self.gen_obs_image(idx)
+        results = []
+        for k, i in enumerate(idx):
+            results.append({
+                'obs': image[k],
+                'instr': self.instr[i],
+                'extra': np.concatenate([[self.agent_dir[i]], self.agent_pos[i] - self.pad]),
+            })
+        return results
+
+    def gen_obs_image(self, idx):
+        """
+        Egocentric, partially observable views of the given envs, equivalent to grid.encode(vis_mask) applied to
+        the output of gen_obs_grid().
+        :return: uint8 array of shape (len(idx), view_size, view_size, 3)
+        """
+        v = self.view_size
+        pos = self.agent_pos[idx][:, None, None, :] + self.offsets[self.agent_dir[idx]]
+        image = self.grid[idx[:, None, None], pos[..., 0], pos[..., 1]]
+
+        # Occlusion, as in Grid.process_vis(), vectorized over the envs
+        see_behind = (image[..., 0] != WALL) & ~((image[..., 0] == DOOR) & (image[..., 2] != STATE_OPEN))
+        vis_mask = np.zeros(image.shape[:3], dtype=bool)
+        vis_mask[:, v // 2, v - 1] = True
+        for j in reversed(range(v)):
+            for i in range(v - 1):
+                spread = vis_mask[:, i, j] & see_behind[:, i, j]
+                vis_mask[:, i + 1, j] |= spread
+                if j > 0:
+                    vis_mask[:, i + 1, j - 1] |= spread
+                    vis_mask[:, i, j - 1] |= spread
+            for i in reversed(range(1, v)):
+                spread = vis_mask[:, i, j] & see_behind[:, i, j]
+                vis_mask[:, i - 1, j] |= spread
+                if j > 0:
+                    vis_mask[:, i - 1, j - 1] |= spread
+                    vis_mask[:, i, j - 1] |= spread
+        vis_mask[self.see_through_walls[idx]] = True
+
+        # The agent sees what it is carrying in its own cell
+        carrying = self.carrying[idx]
+        image[:, v // 2, v - 1] = np.where(self.carrying_id[idx, None] > 0, carrying, (EMPTY, 0, 0))
+        image *= vis_mask[..., None]
+
+        fully_observed = np.nonzero(self.fully_observed[idx])[0]
+        if len(fully_observed) > 0:
+            image = list(image)
+            for k in fully_observed:
+                image[k] = self.get_full_observation(idx[k])
+        return image
+
+    def get_full_observation(self, i):
+        env = self.envs[i]
+        p = self.pad
+        full_grid = self.grid[i, p:p + env.grid.width, p:p + env.grid.height].copy()
+        x, y = self.agent_pos[i] - p
+        full_grid[x, y] = (OBJECT_TO_IDX['agent'], COLOR_TO_IDX['red'], self.agent_dir[i])
+        return full_grid
+
+    def reset(self):
+        for i in range(self.num_envs):
+            self._reset_env(i)
+        return self.gen_obs()
+
+    def advance_curriculum(self):
+        return [env.advance_curriculum() for env in self.envs]
+
+    def update_tasks(self):
+        for env in self.envs:
+            env.set_task(None)
+
+    def step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs)
+        n = self.env_index
+        self.step_count += 1
+
+        fwd_pos = self.agent_pos + self.dir_vec[self.agent_dir]
+        fwd_cell = self.grid[n, fwd_pos[:, 0], fwd_pos[:, 1]]
+        fwd_type = fwd_cell[:, 0]
+        fwd_id = self.obj_id[n, fwd_pos[:, 0], fwd_pos[:, 1]]
+        was_carrying = self.carrying_id > 0
+        pre_carrying_id = self.carrying_id.copy()
+
+        # Rotate
+        self.agent_dir = np.where(actions == self.actions.left, (self.agent_dir - 1) % 4, self.agent_dir)
+        self.agent_dir = np.where(actions == self.actions.right, (self.agent_dir + 1) % 4, self.agent_dir)
+
+        # Move forward onto cells that can be overlapped
+        can_overlap = np.isin(fwd_type, (EMPTY, OBJECT_TO_IDX['floor'], GOAL, LAVA)) | \
+                      ((fwd_type == DOOR) & (fwd_cell[:, 2] == STATE_OPEN))
+        forward = (actions == self.actions.forward) & can_overlap
+        self.agent_pos[forward] = fwd_pos[forward]
+        reached_goal = forward & (fwd_type == GOAL)
+        in_lava = forward & (fwd_type == LAVA)
+
+        # Pick up
+        pickup = (actions == self.actions.pickup) & ~was_carrying & np.isin(fwd_type, (KEY, BALL, BOX))
+        idx = np.nonzero(pickup)[0]
+        self.carrying[idx] = fwd_cell[idx]
+        self.carrying_id[idx] = fwd_id[idx]
+        self.grid[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = (EMPTY, 0, 0)
+        self.obj_id[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = 0
+
+        # Drop
+        drop = (actions == self.actions.drop) & was_carrying & (fwd_type == EMPTY)
+        idx = np.nonzero(drop)[0]
+        self.grid[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = self.carrying[idx]
+        self.obj_id[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = self.carrying_id[idx]
+        self.carrying[idx] = 0
+        self.carrying_id[idx] = 0
+
+        # Toggle doors (unlocking requires carrying a key of the same color) and open boxes, which disappear
+        toggle = actions == self.actions.toggle
+        door_state = fwd_cell[:, 2]
+        has_key = (self.carrying[:, 0] == KEY) & (self.carrying[:, 1] == fwd_cell[:, 1])
+        new_state = np.where(door_state == STATE_LOCKED, np.where(has_key, STATE_OPEN, STATE_LOCKED),
+                             np.where(door_state == STATE_OPEN, STATE_CLOSED, STATE_OPEN))
+        idx = np.nonzero(toggle & (fwd_type == DOOR))[0]
+        self.grid[idx, fwd_pos[idx, 0], fwd_pos[idx, 1], 2] = new_state[idx]
+        idx = np.nonzero(toggle & (fwd_type == BOX) & ~self.keep_boxes)[0]
+        self.grid[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = (EMPTY, 0, 0)
+        self.obj_id[idx, fwd_pos[idx, 0], fwd_pos[idx, 1]] = 0
+
+        # Verify the missions (see the verify_action methods in babyai.levels.verifier)
+        idx = np.nonzero(actions == self.actions.drop)[0]
+        self._update_objs_poss(idx)
+        front_pos = self.agent_pos + self.dir_vec[self.agent_dir]
+        front_state = self.grid[n, front_pos[:, 0], front_pos[:, 1], 2]
+        front_id = self.obj_id[n, front_pos[:, 0], front_pos[:, 1]]
+        next_to_fixed = np.zeros(self.num_envs, dtype=bool)
+        for dx, dy in DIR_TO_VEC:
+            next_to_fixed |= self.fixed_pos[n, fwd_pos[:, 0] + dx, fwd_pos[:, 1] + dy]
+
+        goto_success = self.desc_pos[n, front_pos[:, 0], front_pos[:, 1]]
+        open_success = toggle & self.desc_ids[n, front_id] & (front_id > 0) & (front_state == STATE_OPEN)
+        pickup_success = pickup & self.desc_ids[n, self.carrying_id]
+        putnext_success = drop & self.desc_ids[n, pre_carrying_id] & next_to_fixed
+        success = np.choose(self.kind, [goto_success, open_success, pickup_success, putnext_success])
+
+        carrying = self.carrying_id > 0
+        open_failure = toggle & (fwd_type == DOOR)
+        pickup_failure = (actions == self.actions.pickup) & carrying
+        failure = self.strict & ~success & np.choose(self.kind, [np.zeros_like(success), open_failure,
+                                                                 pickup_failure, pickup_failure])
+
+        done = success | failure | reached_goal | in_lava | (self.step_count >= self.max_steps)
+        reward = np.where(success | reached_goal, 1 - 0.9 * (self.step_count / self.max_steps), 0)
+
+        infos = []
+        for i in range(self.num_envs):
+            infos.append({
+                'agent_pos': self.agent_pos[i] - self.pad,
+                'agent_dir': self.agent_dir[i],
+                'step': self.itr[i],
+                'success': int(success[i]),
+                'episode_length': self.step_count[i],
+                'teacher_action': np.array(self.action_space.n, dtype=np.int32),
+                'gave_reward': int(done[i]),
+            })
+
+        for i in np.nonzero(done)[0]:
+            self._reset_env(i)
+        obs = self.gen_obs()
+        return obs, list(reward), list(done), infos
+
+    def render(self):
+        raise NotImplementedError("Render the original envs instead")
+
+    def get_teacher_action(self):
+        # Envs without a teacher don't have a teacher action
+        return [None] * self.num_envs
+
+
+def test(num_steps=300):
+    """
+    Step a BatchedRoomGridEnv and the levels it batches side by side with the same scripted actions, and check that
+    they give the same observations, rewards and dones.
+    """
+    from babyai.levels.iclr19_levels import Level_GoToRedBallGrey, Level_GoToLocalS5N2, \
+        Level_PickupLocalS5N2, Level_PutNextLocalS5N2, Level_OpenLocalS5N2
+
+    for level in [Level_GoToRedBallGrey, Level_GoToLocalS5N2, Level_PickupLocalS5N2, Level_PutNextLocalS5N2,
+                  Level_OpenLocalS5N2]:
+        print('Batched env, level %s' % level.__name__)
+        seeds = [0, 1, 2]
+        envs = BatchedRoomGridEnv([level(seed=seed) for seed in seeds], 1, repeated_seed=seeds)
+        refs = [level(seed=seed) for seed in seeds]
+        obs = envs.reset()
+        ref_obs = []
+        for ref, seed in zip(refs, seeds):
+            ref.seed(seed)
+            ref.set_task(None)
+            ref_obs.append(ref.reset())
+        rng = np.random.RandomState(0)
+        for step in range(num_steps):
+            for i, ref in enumerate(refs):
+                for key in ['obs', 'instr', 'extra']:
+                    assert np.array_equal(obs[i][key], ref_obs[i][key]), (level.__name__, step, i, key)
+            actions = rng.randint(0, envs.action_space.n, size=len(refs))
+            obs, rewards, dones, _ = envs.step(actions)
+            ref_obs = []
+            for i, (ref, seed, action) in enumerate(zip(refs, seeds, actions)):
+                o, reward, done, _ = ref.step(action)
+                assert done == dones[i] and np.isclose(reward, rewards[i]), (level.__name__, step, i)
+                if done:
+                    ref.seed(seed)
+                    ref.set_task(None)
+                    o = ref.reset()
+                ref_obs.append(o)
@@ -1,10 +1,101 @@
 from multiprocessing import Process, Pipe
+from multiprocessing.shared_memory import SharedMemory
+import sys
+import numpy as np
 import gym
 
+
+class SharedObsLayout:
+    """
+    Layout of one slot of the shared-memory ring used by ParallelEnv(shared_memory=True).
+    A slot holds every field of one observation dict, plus the reward and done flag of the step which produced it.
+    """
+
+    def __init__(self, obs):
+        self.fields = []
+        offset = 0
+        for key, value in list(obs.items()) + [('_reward', 0.), ('_done', False)]:
+            value = np.asarray(value)
+            assert value.dtype != object, f"Can't store {key} in shared memory"
+            # Keep every field aligned so the views can be used directly
+            offset = -(-offset // 8) * 8
+            self.fields.append((key, value.shape, value.dtype, offset))
+            offset += value.nbytes
+        self.slot_size = -(-offset // 8) * 8
+        self.shapes = {key: shape for key, shape, _, _ in self.fields[:-2]}
+
+    def views(self, buf, slot):
+        """
+        Numpy views of the fields of a slot of the ring
+        """
+        base = slot * self.slot_size
+        return {key: np.ndarray(shape, dtype=dtype, buffer=buf, offset=base + offset)
+                for key, shape, dtype, offset in self.fields}
+
+    def fits(self, obs):
+        return obs.keys() == self.shapes.keys() and all(np.shape(v) == self.shapes[k] for k, v in obs.items())
+
+
+class SharedObsWriter:
+    """
+    Worker side of the shared-memory ring: writes observations into the slots owned by one worker.
+    """
+
+    def __init__(self, name, layout, slots):
+        if sys.version_info >= (3, 13):
+            # The parent owns the memory, so the worker doesn't track it
+            self.shm = SharedMemory(name=name, track=False)
+        else:
+            # The workers share the parent's resource tracker, so this registers the name again, which is a no-op.
+            # Unregistering it here would drop the parent's registration.
+            self.shm = SharedMemory(name=name)
+        self.layout = layout
+        self.slots = [layout.views(self.shm.buf, slot) for slot in slots]
+
+    def write(self, index, obs, reward=0., done=False):
+        """
+        Write obs into the index-th slot of the worker. Returns False if obs doesn't fit the layout, in which case
+        it must be sent through the pipe instead.
+        """
+        if not self.layout.fits(obs):
+            return False
+        views = self.slots[index]
+        for key, value in obs.items():
+            views[key][...] = value
+        views['_reward'][...] = reward
+        views['_done'][...] = done
+        return True
+
+
+def shared_worker_step(writer, env, data, seed):
+    action, index = data
+    obs, reward, done, info = env.step(action)
+    if done:
+        if seed is not None:
+            env.seed(seed)
+        env.set_task(None)
+        obs = env.reset()
+    if writer.write(index, obs, reward, done):
+        return info, None, None, None
+    return info, obs, reward, done
+
+
 def worker(conn, env, rollouts_per_meta_task, seed):
+    writer = None
     while True:
         cmd, data = conn.recv()
-        if cmd == "step":
+        if cmd == "step_shared":
+            conn.send(shared_worker_step(writer, env, data, seed))
+        elif cmd == "reset_shared":
+            if seed is not None:
+                env.seed(seed)
+            env.set_task(None)
+            obs = env.reset()
+            conn.send(None if writer.write(data, obs) else obs)
+        elif cmd == "attach_shared":
+            writer = SharedObsWriter(*data)
+            conn.send(None)
+        elif cmd == "step":
             obs, reward, done, info = env.step(data)
             if done:
                 # if env.itr == rollouts_per_meta_task:  # TODO: make this handle point_mass
@@ -35,10 +126,22 @@ def worker(conn, env, rollouts_per_meta_task, seed):
             raise NotImplementedError
 
 class ParallelEnv(gym.Env):
-    """A concurrent execution of environments in multiple processes."""
+    """A concurrent execution of environments in multiple processes.
 
-    def __init__(self, envs, rollouts_per_meta_task, repeated_seed=None):
+    By default the first env runs in the main process; with inline_first_env=False every env gets its own worker.
+
+    With shared_memory=True, the workers write their observations, rewards and dones into a ring of slots in shared
+    memory, and only the actions and the (small) info dicts go through the pipes. The observations returned by reset()
+    and step() are then numpy views into the ring, which stay valid for ring_size - 1 further steps of the same env.
+
+    step_async() and step_wait() step a subset of the envs, so the caller can do other work (e.g. compute the actions
+    of the other envs) while these envs are stepping.
+    """
+
+    def __init__(self, envs, rollouts_per_meta_task, repeated_seed=None, shared_memory=False, ring_size=2,
+                 inline_first_env=True):
         assert len(envs) >= 1, "No environment given."
+        assert ring_size >= 2, "The ring needs at least 2 slots so the previous observation stays valid"
 
         self.envs = envs
         self.observation_space = self.envs[0].observation_space
@@ -46,15 +149,26 @@ class ParallelEnv(gym.Env):
         self.locals = []
         self.rollouts_per_meta_task = rollouts_per_meta_task
         self.repeated_seed = repeated_seed
+        self.shared_memory = shared_memory
+        self.ring_size = ring_size
+        self.inline_first_env = inline_first_env
+        # Number of envs run in the main process (they come first)
+        self.num_inline = 1 if inline_first_env else 0
+        self.shm = None
         self.reset_processes()
 
     def reset_processes(self):
+        # The new workers are attached to a new ring with the same layout
+        layout = self.layout if self.shm is not None else None
         if len(self.locals) > 0:
             self.end_processes()
+        self.release_shared()
         self.locals = []
         self.processes = []
+        self.layout = None
+        self.inline_result = None
         repeated_seed = self.repeated_seed if self.repeated_seed is not None else [None] * len(self.envs)
-        for env, seed in zip(self.envs[1:], repeated_seed[1:]):
+        for env, seed in zip(self.envs[self.num_inline:], repeated_seed[self.num_inline:]):
             local, remote = Pipe()
             self.locals.append(local)
             p = Process(target=worker, args=(remote, env, self.rollouts_per_meta_task, seed))
@@ -62,34 +176,124 @@ class ParallelEnv(gym.Env):
             p.start()
             remote.close()
             self.processes.append(p)
+        self.ring_index = [0] * len(self.locals)
+        if layout is not None:
+            self.allocate_shared(layout)
 
-    def reset(self):
-        for local in self.locals:
-            local.send(("reset", None))
+    def reset_inline(self):
         if self.repeated_seed is not None:
             self.envs[0].seed(self.repeated_seed[0])
         self.envs[0].set_task(None)
-        results = [self.envs[0].reset()] + [local.recv() for local in self.locals]
+        return self.envs[0].reset()
+
+    def step_inline(self, action):
+        obs, reward, done, info = self.envs[0].step(action)
+        if done:
+            obs = self.reset_inline()
+        return obs, reward, done, info
+
+    def reset(self):
+        if self.shm is not None:
+            return self.reset_shared()
+        for local in self.locals:
+            local.send(("reset", None))
+        results = ([self.reset_inline()] if self.num_inline else []) + [local.recv() for local in self.locals]
+        if self.shared_memory and len(self.locals) > 0:
+            self.attach_shared(results[self.num_inline])
+        return results
+
+    def attach_shared(self, obs):
+        """
+        Allocate the shared-memory ring, laid out after an example observation, and attach the workers to it.
+        Worker w owns slots [w * ring_size, (w + 1) * ring_size).
+        """
+        try:
+            layout = SharedObsLayout(obs)
+        except (AssertionError, ValueError, AttributeError) as e:
+            print("Can't send these observations through shared memory, using pipes instead:", e)
+            return
+        self.allocate_shared(layout)
+
+    def allocate_shared(self, layout):
+        self.layout = layout
+        self.shm = SharedMemory(create=True, size=self.layout.slot_size * self.ring_size * len(self.locals))
+        self.views = [[self.layout.views(self.shm.buf, w * self.ring_size + i) for i in range(self.ring_size)]
+                      for w in range(len(self.locals))]
+        for w, local in enumerate(self.locals):
+            slots = range(w * self.ring_size, (w + 1) * self.ring_size)
+            local.send(("attach_shared", (self.shm.name, self.layout, slots)))
+        for local in self.locals:
+            local.recv()
+
+    def next_ring_index(self, w):
+        self.ring_index[w] = (self.ring_index[w] + 1) % self.ring_size
+        return self.ring_index[w]
+
+    def read_shared(self, w):
+        views = self.views[w][self.ring_index[w]]
+        obs = {key: views[key] for key in self.layout.shapes}
+        return obs, views['_reward'].item(), views['_done'].item()
+
+    def reset_shared(self):
+        for w, local in enumerate(self.locals):
+            local.send(("reset_shared", self.next_ring_index(w)))
+        results = [self.reset_inline()] if self.num_inline else []
+        for w, local in enumerate(self.locals):
+            obs = local.recv()
+            results.append(self.read_shared(w)[0] if obs is None else obs)
         return results
 
     def advance_curriculum(self):
         for local in self.locals:
             local.send(("advance_curriculum", None))
-        results = [self.envs[0].advance_curriculum()] + [local.recv() for local in self.locals]
+        results = (([self.envs[0].advance_curriculum()] if self.num_inline else []) +
+                   [local.recv() for local in self.locals])
         return results
 
+    def step_async(self, actions, idx=None):
+        """
+        Start stepping the envs with indices idx (all envs by default) with the given actions.
+        The results must be collected with step_wait(idx) before these envs are used again.
+        """
+        if idx is None:
+            idx = range(len(self.envs))
+        for j, action in zip(idx, actions):
+            if j < self.num_inline:
+                continue
+            w = j - self.num_inline
+            if self.shm is not None:
+                self.locals[w].send(("step_shared", (action, self.next_ring_index(w))))
+            else:
+                self.locals[w].send(("step", action))  # TODO: does this reset?
+        # The inline env is stepped last, so it runs while the workers are stepping
+        for j, action in zip(idx, actions):
+            if j < self.num_inline:
+                self.inline_result = self.step_inline(action)
+
+    def step_wait(self, idx=None):
+        """
+        Collect the (obs, reward, done, info) of the envs with indices idx stepped with step_async(actions, idx).
+        """
+        if idx is None:
+            idx = range(len(self.envs))
+        results = []
+        for j in idx:
+            if j < self.num_inline:
+                results.append(self.inline_result)
+                continue
+            w = j - self.num_inline
+            if self.shm is None:
+                results.append(self.locals[w].recv())
+                continue
+            info, obs, reward, done = self.locals[w].recv()
+            if obs is None:
+                obs, reward, done = self.read_shared(w)
+            results.append((obs, reward, done, info))
+        return list(zip(*results))
+
     def step(self, actions):
-        for local, action in zip(self.locals, actions[1:]):
-            local.send(("step", action))  # TODO: does this reset?
-        obs, reward, done, info = self.envs[0].step(actions[0])
-        if done:
-            if self.repeated_seed is not None:
-                self.envs[0].seed(self.repeated_seed[0])
-            self.envs[0].set_task(None)
-            obs = self.envs[0].reset()
-        results = zip(*[(obs, reward, done, info)] + [local.recv() for local in self.locals])
-        results = list(results)
-        return results
+        self.step_async(actions)
+        return self.step_wait()
 
     def update_tasks(self):
         for env in self.envs:
@@ -99,14 +303,18 @@ class ParallelEnv(gym.Env):
     def render(self):
         for local in self.locals:
             local.send(("render", None))
-        results = [self.envs[0].render(mode='rgb_array')] + [local.recv() for local in self.locals]
+        results = (([self.envs[0].render(mode='rgb_array')] if self.num_inline else []) +
+                   [local.recv() for local in self.locals])
         return results
 
-    def get_teacher_action(self):
-        for local in self.locals:
-            local.send(("get_teacher_action", None))
-        results = [self.envs[0].get_teacher_action()] + [local.recv() for local in self.locals]
-        return results
+    def get_teacher_action(self, idx=None):
+        if idx is None:
+            idx = range(len(self.envs))
+        for j in idx:
+            if j >= self.num_inline:
+                self.locals[j - self.num_inline].send(("get_teacher_action", None))
+        return [self.envs[0].get_teacher_action() if j < self.num_inline else self.locals[j - self.num_inline].recv()
+                for j in idx]
 
     def __del__(self):
         self.end_processes()
@@ -114,6 +322,19 @@ class ParallelEnv(gym.Env):
     def end_processes(self):
         for p in self.processes:
             p.terminate()
+        self.release_shared()
+
+    def release_shared(self):
+        if self.shm is not None:
+            # Drop our views before closing the buffer they point to
+            self.views = None
+            try:
+                self.shm.close()
+            except BufferError:
+                # Observations returned to the caller still point into the ring; the memory is freed with them
+                pass
+            self.shm.unlink()
+            self.shm = None
 
 
 class SequentialEnv(gym.Env):
@@ -5,7 +5,7 @@ import pathlib
 import pickle as pkl
 import torch
 
-from babyai.rl.utils.dictlist import merge_dictlists, DictList
+from babyai.rl.utils.dictlist import DictList
 from babyai.utils.obs_preprocessor import obss_preprocessor_distill
 
 def trim_batch(batch):
@@ -29,8 +29,20 @@ def trim_batch(batch):
 
 # TODO: Currently we assume each batch comes from a single level. WE may need to change that assumption someday.
 class Buffer:
+    """
+    Replay buffer of trajectories, stored column by column.
+
+    For each level and split there is one preallocated array per column (action, followed_teacher, ...) and one per
+    observation key (obs, instr, each teacher's advice, gave_* flags, ...). The arrays are np.memmaps backed by .npy
+    files in the buffer directory, so adding data only writes the new rows, and a buffer can be reopened later.
+    """
+    # Columns kept from the (trimmed) batches
+    COLUMNS = ['obs', 'action', 'followed_teacher', 'advice_count']
+    # Observation keys whose values are (img, x, y) tuples (padded egocentric views) get one column per part
+    OBS_TUPLE_PARTS = ['img', 'img_shape', 'x', 'y']
+
     def __init__(self, path, buffer_capacity, prob_current, val_prob, buffer_name='buffer', augmenter=None,
-                 successful_only=False):
+                 successful_only=False, prioritized=False, priority_alpha=.6):
         self.train_buffer_capacity = buffer_capacity
         self.augmenter = augmenter
         # We don't need that many val samples
@@ -43,9 +55,22 @@ class Buffer:
         self.counts_val = {}
         self.trajs_train = {}
         self.trajs_val = {}
+        # For each level, the spec of each column: key -> (kind, dtype, shape), where kind is 'obs' for the
+        # observation keys, 'obs_tuple' for the parts of tuple observations, 'torch' for columns which were tensors
+        # and 'numpy' for the others
+        self.specs = {}
+        # Level of the last batch added, which sample() draws a fraction prob_current of the frames from
+        self.current_level = None
+        # Prioritized sampling: within a level, frames are sampled with probability proportional to
+        # priority ** priority_alpha. New frames get the highest priority so far.
+        self.prioritized = prioritized
+        self.priority_alpha = priority_alpha
+        self.priorities_train = {}
+        self.priorities_val = {}
         self.buffer_path = pathlib.Path(path).joinpath(buffer_name)
         self.successful_only = successful_only
         self.num_feedback = 0
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # If the buffer already exists, load it
         if self.buffer_path.exists():
             self.load_buffer()
@@ -55,88 +80,173 @@ class Buffer:
         self.added_count = 0
         self.total_count = 0
 
+    def column_path(self, split, level, key):
+        return self.buffer_path.joinpath(f'{split}_{level}_{key}.npy')
+
+    def open_columns(self, level, mode):
+        for split, capacity, trajs in [('train', self.train_buffer_capacity, self.trajs_train),
+                                       ('val', self.val_buffer_capacity, self.trajs_val)]:
+            getattr(self, f'priorities_{split}')[level] = np.ones(capacity)
+            columns = {}
+            obs_columns = {}
+            for key, (kind, dtype, shape) in self.specs[level].items():
+                path = self.column_path(split, level, key)
+                if mode == 'w+':
+                    arr = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(capacity, *shape))
+                else:
+                    arr = np.load(path, mmap_mode='r+')
+                if kind in ['obs', 'obs_tuple']:
+                    obs_columns[key[len('obs.'):]] = arr
+                else:
+                    columns[key] = arr
+            columns['obs'] = DictList(obs_columns)
+            trajs[level] = DictList(columns)
+
     def load_buffer(self):
-        train_path = self.buffer_path.joinpath(f'train_buffer.pkl')
-        if train_path.exists():
-            with open(train_path, 'rb') as f:
-                self.trajs_train, self.index_train, self.counts_train = pkl.load(f)
-        val_path = self.buffer_path.joinpath(f'val_buffer.pkl')
-        if val_path.exists():
-            with open(self.buffer_path.joinpath(f'val_buffer.pkl'), 'rb') as f:
-                self.trajs_val, self.index_val, self.counts_val = pkl.load(f)
+        specs_path = self.buffer_path.joinpath('columns.pkl')
+        if specs_path.exists():
+            with open(specs_path, 'rb') as f:
+                self.specs = pkl.load(f)
+            with open(self.buffer_path.joinpath('buffer_stats.pkl'), 'rb') as f:
+                self.counts_train, self.index_train, self.counts_val, self.index_val, self.num_feedback = pkl.load(f)
+            for level in self.specs:
+                self.open_columns(level, 'r+')
+            return
+        # Buffers saved before the columnar format: copy their contents into columns
+        for split in ['train', 'val']:
+            path = self.buffer_path.joinpath(f'{split}_buffer.pkl')
+            if not path.exists():
+                continue
+            with open(path, 'rb') as f:
+                trajs, index, counts = pkl.load(f)
+            for level, value in trajs.items():
+                if not level in self.specs:
+                    self.index_train[level] = self.index_val[level] = 0
+                    self.counts_train[level] = self.counts_val[level] = 0
+                    self.create_blank_buffer(value[:1], level)
+                count = min(counts[level], self.get_capacity(split))
+                self.write_rows(value, np.arange(count), level, split)
+                getattr(self, f'index_{split}')[level] = index[level] % self.get_capacity(split)
+                getattr(self, f'counts_{split}')[level] = count
+        self.save_buffer()
+
+    def get_capacity(self, split):
+        return self.train_buffer_capacity if split == 'train' else self.val_buffer_capacity
 
     def create_blank_buffer(self, batch, label):
-        train_dict = {}
-        val_dict = {}
+        spec = {}
         # for key in ['obs', 'action', 'action_probs', 'teacher_action', 'followed_teacher', 'advice_count']:
-        for key in ['obs', 'action', 'followed_teacher', 'advice_count']:
+        for key in self.COLUMNS:
             # if not hasattr(batch, key):
             #     continue
             try:
                 value = getattr(batch, key)
                 if type(value) is list:
-                    train_dict[key] = [None] * self.train_buffer_capacity
-                    val_dict[key] = [None] * self.val_buffer_capacity
+                    for obs_key, obs_value in value[0].items():
+                        if type(obs_value) is tuple:
+                            spec.update(self.tuple_specs(obs_key, obs_value))
+                            continue
+                        obs_value = np.asarray(obs_value)
+                        if obs_value.dtype == object:
+                            raise NotImplementedError((key, obs_key, type(value[0][obs_key])))
+                        spec['obs.' + obs_key] = ('obs', obs_value.dtype, obs_value.shape)
                 elif type(value) is torch.Tensor:
-                    shape = value.shape
-                    tensor_class = torch.IntTensor if value.dtype is torch.int32 else torch.FloatTensor
-                    device = value.device
-                    train_dict[key] = tensor_class(size=(self.train_buffer_capacity, *shape[1:])).to(device)
-                    val_dict[key] = tensor_class(size=(self.val_buffer_capacity, *shape[1:])).to(device)
+                    dtype = np.int32 if value.dtype is torch.int32 else np.float32
+                    spec[key] = ('torch', np.dtype(dtype), tuple(value.shape[1:]))
                 elif type(value) is np.ndarray:
-                    shape = value.shape
-                    dtype = value.dtype
-                    train_dict[key] = np.zeros(shape=(self.train_buffer_capacity, *shape[1:]), dtype=dtype)
-                    val_dict[key] = np.zeros(shape=(self.val_buffer_capacity, *shape[1:]), dtype=dtype)
+                    spec[key] = ('numpy', value.dtype, value.shape[1:])
                 else:
                     raise NotImplementedError((key, type(value)))
-            except:
+            except AttributeError:
                 print("?", key)
-        self.trajs_train[label] = DictList(train_dict)
-        self.trajs_val[label] = DictList(val_dict)
+        self.specs[label] = spec
+        self.open_columns(label, 'w+')
+        with open(self.buffer_path.joinpath('columns.pkl'), 'wb') as f:
+            pkl.dump(self.specs, f)
 
-        pass
+    def tuple_specs(self, obs_key, obs_value):
+        """
+        Specs of the columns of a padded egocentric view (img, x, y). The img is the full grid rotated with the agent,
+        so its height and width swap: the img column is square, and img_shape keeps the actual shape of each img.
+        """
+        img, x, y = obs_value
+        img = np.asarray(img)
+        size = max(img.shape[:2])
+        specs = {'img': (img.dtype, (size, size) + img.shape[2:]), 'img_shape': (np.dtype(np.int64), (2,)),
+                 'x': (np.asarray(x).dtype, ()), 'y': (np.asarray(y).dtype, ())}
+        return {f'obs.{obs_key}.{part}': ('obs_tuple',) + specs[part] for part in self.OBS_TUPLE_PARTS}
 
     def to_numpy(self, t):
         return t.detach().cpu().numpy()
 
     def split_batch(self, batch):
-        # The batch is a series of trajectories concatenated. Here, we split it into individual batches.
+        # The batch is a series of trajectories concatenated. Here, we find the (start, end) of each of them.
         trajs = []
         end_idxs = self.to_numpy(torch.where(batch.full_done == 1)[0]) + 1
         start_idxs = np.concatenate([[0], end_idxs[:-1]])
+        success = batch.success
         for start, end in zip(start_idxs, end_idxs):
-            traj = batch[start: end]
-            if (not self.successful_only) or traj.success[-1].item():
-                trajs.append(traj)
+            if (not self.successful_only) or success[end - 1].item():
+                trajs.append((start, end))
                 self.added_count += 1
         self.total_count += 1
         print("Buffer Counts", self.added_count, self.total_count, self.added_count/self.total_count)
         return trajs
 
-    def save_traj(self, traj, level, index, split):
+    def write_rows(self, batch, rows, level, split):
+        """
+        Write rows of the batch at the current index of the level's columns, wrapping around when the buffer is full.
+        Only the new rows are written.
+        :return: number of rows written, which is at most the capacity
+        """
         if split == 'train':
             value = self.trajs_train[level]
+            index = self.index_train[level]
         elif split == 'val':
             value = self.trajs_val[level]
-        max_val = min(len(traj), len(value) - index)
-        # We can fit the entire traj in
-        for k in value:
-            arr = getattr(value, k)
-            arr[index:index + max_val] = getattr(traj, k)[:max_val]
-
-        # Uh oh, overfilling the buffer. Let's wrap around.
-        remainder = min(len(traj) - max_val, len(arr))
-        if remainder > 0:
-            for k in value:
-                arr = getattr(value, k)
-                arr[:remainder] = getattr(traj, k)[-remainder:]
+            index = self.index_val[level]
+        capacity = self.get_capacity(split)
+        # Rows which would be overwritten in this same write are skipped
+        rows = rows[-capacity:]
+        if len(rows) == 0:
+            return 0
+        positions = (index + np.arange(len(rows))) % capacity
+        priorities = getattr(self, f'priorities_{split}')[level]
+        priorities[positions] = priorities.max()
+        for key, (kind, _, _) in self.specs[level].items():
+            if kind == 'obs':
+                obs_key = key[len('obs.'):]
+                arr = getattr(value.obs, obs_key)
+                arr[positions] = np.stack([batch.obs[r][obs_key] for r in rows])
+            elif kind == 'obs_tuple':
+                obs_key, part = key[len('obs.'):].rsplit('.', 1)
+                arr = getattr(value.obs, f'{obs_key}.{part}')
+                views = [batch.obs[r][obs_key] for r in rows]
+                if part == 'img':
+                    for position, (img, _, _) in zip(positions, views):
+                        arr[position] = 0
+                        arr[position, :img.shape[0], :img.shape[1]] = img
+                elif part == 'img_shape':
+                    arr[positions] = [np.shape(img)[:2] for img, _, _ in views]
+                else:
+                    arr[positions] = [view[1 if part == 'x' else 2] for view in views]
+            else:
+                arr = getattr(value, key)
+                new_value = getattr(batch, key)
+                if type(new_value) is torch.Tensor:
+                    new_value = self.to_numpy(new_value)
+                arr[positions] = new_value[rows]
+        return len(rows)
 
     def save_buffer(self):
-        with open(self.buffer_path.joinpath(f'train_buffer.pkl'), 'wb') as f:
-            pkl.dump((self.trajs_train, self.index_train, self.counts_train), f)
-        with open(self.buffer_path.joinpath(f'val_buffer.pkl'), 'wb') as f:
-            pkl.dump((self.trajs_val, self.index_val, self.counts_val), f)
+        # Only the small bookkeeping is pickled; the data itself is already in the memory-mapped columns
+        for trajs in [self.trajs_train, self.trajs_val]:
+            for value in trajs.values():
+                for arr in list(value.obs.values()) + [v for k, v in value.items() if k != 'obs']:
+                    arr.flush()
+        buffer_stats = self.counts_train, self.index_train, self.counts_val, self.index_val, self.num_feedback
+        with open(self.buffer_path.joinpath('buffer_stats.pkl'), 'wb') as f:
+            pkl.dump(buffer_stats, f)
 
     def add_trajs(self, batch, level, trim=True):
         if trim:
@@ -147,15 +257,16 @@ class Buffer:
         # Make sure we get at least one of each
         if split == 0 and len(trajs) > 1:
             split = 1
-        for traj in trajs[:split]:
-            self.save_traj(traj, level, self.index_val[level], 'val')
-            self.index_val[level] = (self.index_val[level] + len(traj)) % self.val_buffer_capacity
-            self.counts_val[level] = min(self.val_buffer_capacity, self.counts_val[level] + len(traj))
-        for traj in trajs[split:]:
-            self.save_traj(traj, level, self.index_train[level], 'train')
-            self.index_train[level] = (self.index_train[level] + len(traj)) % self.train_buffer_capacity
-            self.counts_train[level] = min(self.train_buffer_capacity, self.counts_train[level] + len(traj))
-        self.save_buffer()
+        val_rows = [np.arange(start, end) for start, end in trajs[:split]]
+        train_rows = [np.arange(start, end) for start, end in trajs[split:]]
+        val_rows = np.concatenate(val_rows) if len(val_rows) > 0 else np.zeros(0, dtype=int)
+        train_rows = np.concatenate(train_rows) if len(train_rows) > 0 else np.zeros(0, dtype=int)
+        num_val = self.write_rows(batch, val_rows, level, 'val')
+        self.index_val[level] = (self.index_val[level] + num_val) % self.val_buffer_capacity
+        self.counts_val[level] = min(self.val_buffer_capacity, self.counts_val[level] + num_val)
+        num_train = self.write_rows(batch, train_rows, level, 'train')
+        self.index_train[level] = (self.index_train[level] + num_train) % self.train_buffer_capacity
+        self.counts_train[level] = min(self.train_buffer_capacity, self.counts_train[level] + num_train)
         print("COUNTS", self.counts_train[level], self.counts_val[level], self.index_train[level], self.index_val[level])
 
     def add_batch(self, batch, level, trim=True):
@@ -166,35 +277,102 @@ class Buffer:
             self.counts_val[level] = 0
             self.counts_train[level] = 0
             self.create_blank_buffer(trim_batch(batch), level)
+        self.current_level = level
         self.add_trajs(batch, level, trim)
         self.update_stats(batch)
+        self.save_buffer()
 
     def update_stats(self, batch):
         for k in batch.obs[0].keys():
             if 'gave' in k:
                 self.num_feedback += np.sum([o[k] for o in batch.obs])
-        buffer_stats = self.counts_train, self.index_train, self.counts_val, self.index_val, self.num_feedback
-        with open(self.buffer_path.joinpath('buffer_stats.pkl'), 'wb') as f:
-            pkl.dump(buffer_stats, f)
 
+    def update_priorities(self, levels, indices, priorities, split='train'):
+        """
+        Set the priorities of sampled frames (e.g. to their loss), for a prioritized buffer.
+        :param levels: level of each frame, as returned in the `level` column of a prioritized sample
+        :param indices: index of each frame in its level, as returned in the `index` column of a prioritized sample
+        """
+        all_priorities = getattr(self, f'priorities_{split}')
+        priorities = np.asarray(priorities, dtype=np.float64)
+        for level in set(levels):
+            mask = np.asarray(levels) == level
+            # Keep priorities > 0 so every frame can still be sampled
+            all_priorities[level][np.asarray(indices)[mask]] = np.maximum(priorities[mask], 1e-6)
+
+    def sample_indices(self, level, num_samples, count, split, rng=np.random):
+        if not self.prioritized:
+            return rng.randint(0, count, size=num_samples)
+        weights = getattr(self, f'priorities_{split}')[level][:count] ** self.priority_alpha
+        return rng.choice(count, size=num_samples, p=weights / weights.sum())
+
+    def sample(self, total_num_samples=None, total_num_trajs=None, split='train', teacher_dict=None,
+               obs_preprocessor=None, show_instrs=True, pin_memory=False, rng=np.random):
+        """
+        Sample frames from the buffer.
 
-    def sample(self, total_num_samples=None, total_num_trajs=None, split='train'):
+        A fraction prob_current of the frames comes from the current level (the one of the last batch added), the rest
+        from the other levels, chosen uniformly. Each column is gathered with one fancy-index per level.
+        :param obs_preprocessor: if given, the observations are returned already preprocessed by it, for teacher_dict
+        :param pin_memory: if True, return the tensors in pinned CPU memory so they can be copied to the GPU
+            asynchronously, instead of on the default device
+        :param rng: random state used for sampling (e.g. a RandomState owned by a background thread)
+        :return: DictList of the sampled columns. obs is a DictList with one stacked array per observation key, or the
+            output of obs_preprocessor. With a prioritized buffer, it also has the level and index of each frame.
+        """
         if split == 'train':
-            index = self.index_train
             counts = self.counts_train
             trajs = self.trajs_train
         else:
-            index = self.index_val
             counts = self.counts_val
             trajs = self.trajs_val
             # Early in training we may not have any val trajs yet
             if sum(counts.values()) == 0:
-                index = self.index_train
+                split = 'train'
                 counts = self.counts_train
                 trajs = self.trajs_train
-        # Half from the latest level, otherwise choose uniformly from other levels  # TODO: later!!!
-        possible_levels = list(index.keys())
-        level = np.random.choice(possible_levels)
-        indices = np.random.randint(0, counts[level], size=total_num_samples)
-        data = merge_dictlists([trajs[level][i:i+1] for i in indices])
-        return data
+        possible_levels = [level for level in counts if counts[level] > 0]
+        current_level = self.current_level if self.current_level in possible_levels else possible_levels[-1]
+        other_levels = [level for level in possible_levels if level != current_level]
+        if len(other_levels) == 0:
+            num_current = total_num_samples
+        else:
+            num_current = rng.binomial(total_num_samples, self.prob_current)
+        num_samples = {current_level: num_current}
+        other_counts = np.bincount(rng.randint(0, max(1, len(other_levels)), size=total_num_samples - num_current),
+                                   minlength=len(other_levels))
+        num_samples.update({level: n for level, n in zip(other_levels, other_counts)})
+        levels = [level for level in possible_levels if num_samples[level] > 0]
+        indices = {level: self.sample_indices(level, num_samples[level], counts[level], split, rng) for level in levels}
+
+        # Only the columns all the sampled levels have
+        keys = [k for k in self.specs[levels[0]] if all(k in self.specs[level] for level in levels)]
+        data = {}
+        obs_columns = {}
+        for key in keys:
+            kind = self.specs[levels[0]][key][0]
+            if kind in ['obs', 'obs_tuple']:
+                obs_key = key[len('obs.'):]
+                obs_columns[obs_key] = np.concatenate([getattr(trajs[level].obs, obs_key)[indices[level]]
+                                                       for level in levels])
+            else:
+                column = np.concatenate([getattr(trajs[level], key)[indices[level]] for level in levels])
+                if kind == 'torch':
+                    column = torch.from_numpy(column)
+                    column = column.pin_memory() if pin_memory and torch.cuda.is_available() else column.to(self.device)
+                data[key] = column
+        # Put the tuple observations back together, as a list of (img, x, y)
+        tuple_keys = {key[len('obs.'):].rsplit('.', 1)[0] for key in keys if self.specs[levels[0]][key][0] == 'obs_tuple'}
+        for obs_key in tuple_keys:
+            img, img_shape, x, y = [obs_columns.pop(f'{obs_key}.{part}') for part in self.OBS_TUPLE_PARTS]
+            obs_columns[obs_key] = [(img[i, :h, :w], x[i], y[i]) for i, (h, w) in enumerate(img_shape)]
+        obs = DictList(obs_columns)
+        if obs_preprocessor is not None:
+            obs = obs_preprocessor(obs, teacher_dict, show_instrs=show_instrs)
+            if pin_memory and torch.cuda.is_available():
+                obs = DictList({k: v.pin_memory() if v.device.type == 'cpu' else v for k, v in obs.items()})
+        data['obs'] = obs
+        if self.prioritized:
+            data['level'] = np.concatenate([[level] * len(indices[level]) for level in levels])
+            data['index'] = np.concatenate([indices[level] for level in levels])
+        return DictList(data)
@@ -1,72 +1,156 @@
+import threading
 import torch
 import numpy as np
 from babyai.rl.utils.dictlist import DictList
 
 def make_obs_preprocessor(teacher_null_dict, device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
                           include_zeros=True, pad_size=51):
-    def obss_preprocessor(obs, teacher_dict, show_instrs=True, show_feedback=1.0, show_obs=1.0):
-        obs_output = {}
-        assert not 'advice' in obs[0].keys(), "Appears to already be preprocessed"
+    device = torch.device(device)
+    # Pinned staging buffers, reused across calls, for the host -> GPU copies. They are per thread, so batches can
+    # be preprocessed in a background thread at the same time.
+    pinned_buffers = threading.local()
 
-        # Populate dictionary with an empty dict
-        for k in obs[0].keys():
-            # Don't have individual elements for the advice, since we concat these together
-            # We might consider changing this if we process diff advice types differently (e.g. cartesian with a conv net)
-            if not k in teacher_dict:
-                obs_output[k] = []
-        if len(teacher_dict) > 0:
-            obs_output['advice'] = []
-            obs_output['full_advice'] = []
-            obs_output['full_advice_mask'] = []
-
-        instr_mask = int(show_instrs)
-        feedback_mask = int((not show_instrs) or np.random.uniform() < show_feedback)
-        obs_mask = ((not show_instrs) or (not feedback_mask) or np.random.uniform() < show_obs)
-        for o in obs:
-            advice_list = []
-            full_advice_list = []
-            full_advice_mask = []
-            for k, v in o.items():
-                if k == 'extra':
-                    continue
-                if k in teacher_dict:
-                    full_advice_list.append(v)
-                    full_advice_mask.append(np.array([int(teacher_dict[k])]))
-                    # Mask out particular teachers
-                    if not teacher_dict[k]:
-                        if not include_zeros:  # If we're not including 0's, filter out all teachers we aren't giving
-                            continue
-                        v = teacher_null_dict[k]
-                    advice_list.append(v * feedback_mask)
-                elif k == 'instr':
-                    obs_output[k].append(np.array(v) * instr_mask)
-                elif k == 'obs':
-                    if type(v) is tuple:  # Padding for egocentric view
-                        obs_output[k].append((v[0] * obs_mask, v[1], v[2]))
-                    else:
-                        obs_output[k].append(v * obs_mask)
-                else:
-                    continue
-            if len(advice_list) > 0:
-                obs_output['advice'].append(np.concatenate(advice_list))
-            # if len(full_advice_list) > 0:
-            #     obs_output['full_advice'].append(np.concatenate(full_advice_list))
-            #     obs_output['full_advice_mask'].append(np.concatenate(full_advice_mask))
+    def get_buffer(key, shape):
+        if device.type == 'cpu':
+            # The output tensors are handed to the caller, so they can't be reused
+            return torch.empty(shape)
+        buffers = pinned_buffers.__dict__
+        buf = buffers.get(key)
+        if buf is None or tuple(buf.shape) != shape:
+            buf = torch.empty(shape, pin_memory=True)
+            buffers[key] = buf
+        return buf
 
-        obs_final = {}
-        for k, v in obs_output.items():
-            if len(v) == 0:
+    def get_masks(n, show_instrs, show_feedback, show_obs):
+        if np.ndim(show_instrs) == 0:
+            instr_mask = int(show_instrs)
+            feedback_mask = int((not show_instrs) or np.random.uniform() < show_feedback)
+            obs_mask = ((not show_instrs) or (not feedback_mask) or np.random.uniform() < show_obs)
+            return np.full(n, instr_mask), np.full(n, feedback_mask), np.full(n, int(obs_mask))
+        # One mask per observation. Nothing is drawn for what is always shown, so callers who pass their own
+        # instruction mask (e.g. from a background thread) don't touch the global random state.
+        instr_mask = np.asarray(show_instrs, dtype=bool)
+        feedback_mask = (~instr_mask) | (show_feedback >= 1 or np.random.uniform(size=n) < show_feedback)
+        obs_mask = (~instr_mask) | (~feedback_mask) | (show_obs >= 1 or np.random.uniform(size=n) < show_obs)
+        return instr_mask.astype(int), feedback_mask.astype(int), obs_mask.astype(int)
+
+    def fill_padded_obs(out, obs, obs_mask):
+        # Scatter each egocentric view so the agent is in the middle; views with the same shape are scattered at once
+        out.fill(0)
+        middle = int(pad_size / 2)
+        # (img, x, y) of each observation; stacked observations (e.g. sampled from the Buffer) hold a list of them
+        views = dict.__getitem__(obs, 'obs') if isinstance(obs, dict) else [o['obs'] for o in obs]
+        by_shape = {}
+        for i, view in enumerate(views):
+            by_shape.setdefault(view[0].shape, []).append(i)
+        for (h, w, _), ids in by_shape.items():
+            ids = np.array(ids)
+            imgs = np.stack([views[i][0] for i in ids]) * obs_mask[ids, None, None, None]
+            x_start = middle - np.array([views[i][1] for i in ids])
+            y_start = middle - np.array([views[i][2] for i in ids])
+            rows = x_start[:, None] + np.arange(h)
+            cols = y_start[:, None] + np.arange(w)
+            out[ids[:, None, None], rows[:, :, None], cols[:, None, :]] = imgs
+
+    def advice_variants(first, stack, n, feedback_mask, teacher_dicts):
+        # Stack the advice of every teacher any of the dicts mentions once, then build each dict's advice on the device
+        # by masking that tensor
+        keys = [k for k in first.keys() if any(k in teacher_dict for teacher_dict in teacher_dicts)]
+        sizes = [np.size(first[k]) for k in keys]
+        starts = np.cumsum([0] + sizes)
+        full = get_buffer('advice', (n, starts[-1]))
+        stack_out = full.numpy()
+        null = np.zeros(starts[-1], dtype=np.float32)
+        for k, start, end in zip(keys, starts[:-1], starts[1:]):
+            stack(k, stack_out[:, start:end])
+            null[start:end] = np.reshape(teacher_null_dict[k], -1) if k in teacher_null_dict else 0
+        feedback = torch.tensor(feedback_mask, dtype=torch.float32, device=device)[:, None]
+        full = full.to(device) * feedback
+        null = torch.tensor(null, device=device)[None] * feedback
+        variants = []
+        for teacher_dict in teacher_dicts:
+            shown = np.zeros(starts[-1], dtype=bool)
+            columns = []
+            for k, start, end in zip(keys, starts[:-1], starts[1:]):
+                if k in teacher_dict and (teacher_dict[k] or include_zeros):
+                    shown[start:end] = teacher_dict[k]
+                    columns.extend(range(start, end))
+            if len(columns) == 0:
+                variants.append(None)
                 continue
-            if k == 'obs' and type(v[0]) is tuple:  # Padding for egocentric view
-                obs_final[k] = np.zeros((len(v), pad_size, pad_size, 3))
-                middle = int(pad_size / 2)
-                for i, (img, x, y) in enumerate(v):
-                    y_start = middle - y
-                    x_start = middle - x
-                    obs_final[k][i][x_start:x_start + len(img), y_start:y_start + len(img[0])] = img
-                obs_final[k] = torch.FloatTensor(obs_final[k]).to(device)
+            advice = torch.where(torch.tensor(shown, device=device)[None], full, null)
+            if len(columns) < starts[-1]:
+                advice = advice[:, torch.tensor(columns, device=device)]
+            variants.append(advice)
+        return variants
+
+    def obss_preprocessor(obs, teacher_dict, show_instrs=True, show_feedback=1.0, show_obs=1.0, teacher_dicts=None):
+        """
+        Preprocesses a batch of observations into tensors.
+        :param obs: list of observation dicts, or a DictList with one stacked array per observation key
+        :param teacher_dict: dict mapping each teacher to whether its advice is shown
+        :param show_instrs: either a bool for the whole batch or an array with one bool per observation
+        :param teacher_dicts: optionally, a list of teacher dicts to preprocess the batch for at once (teacher_dict is
+            then ignored). The advice is stacked once and masked for each dict, and the obs and instr are shared.
+        :return: DictList with the batched obs, instr and (concatenated) advice, or a list of them with teacher_dicts
+        """
+        if isinstance(obs, dict):  # Already stacked, e.g. sampled from the Buffer
+            n = len(obs)
+            first = {k: v[0] for k, v in dict.items(obs)}
+        else:
+            n = len(obs)
+            first = obs[0]
+        assert not 'advice' in first.keys(), "Appears to already be preprocessed"
+        instr_mask, feedback_mask, obs_mask = get_masks(n, show_instrs, show_feedback, show_obs)
+        obs_final = {}
+
+        def stack(key, out):
+            if isinstance(obs, dict):
+                np.copyto(out, np.reshape(getattr(obs, key), out.shape), casting='unsafe')
+            else:
+                np.stack([np.reshape(o[key], out.shape[1:]) for o in obs], out=out)
+
+        if 'instr' in first:
+            buf = get_buffer('instr', (n,) + np.shape(first['instr']))
+            out = buf.numpy()
+            stack('instr', out)
+            out *= instr_mask.reshape((n,) + (1,) * (out.ndim - 1))
+            obs_final['instr'] = buf.to(device)
+
+        if 'obs' in first:
+            if type(first['obs']) is tuple:  # Padding for egocentric view
+                buf = get_buffer('obs', (n, pad_size, pad_size, 3))
+                fill_padded_obs(buf.numpy(), obs, obs_mask)
             else:
-                obs_final[k] = torch.FloatTensor(v).to(device)
+                buf = get_buffer('obs', (n,) + np.shape(first['obs']))
+                out = buf.numpy()
+                stack('obs', out)
+                out *= obs_mask.reshape((n,) + (1,) * (out.ndim - 1))
+            obs_final['obs'] = buf.to(device)
+
+        if teacher_dicts is not None:
+            results = []
+            for advice in advice_variants(first, stack, n, feedback_mask, teacher_dicts):
+                results.append(DictList(obs_final if advice is None else dict(obs_final, advice=advice)))
+            return results
+
+        # Advice from the teachers is concatenated, in the order the teachers appear in the observation
+        advice_keys = []
+        for k in first.keys():
+            if k in teacher_dict and (teacher_dict[k] or include_zeros):
+                advice_keys.append((k, np.size(first[k] if teacher_dict[k] else teacher_null_dict[k])))
+        if len(advice_keys) > 0:
+            buf = get_buffer('advice', (n, sum(size for _, size in advice_keys)))
+            out = buf.numpy()
+            start = 0
+            for k, size in advice_keys:
+                if teacher_dict[k]:
+                    stack(k, out[:, start:start + size])
+                else:  # Mask out particular teachers
+                    out[:, start:start + size] = np.reshape(teacher_null_dict[k], -1)
+                start += size
+            out *= feedback_mask[:, None]
+            obs_final['advice'] = buf.to(device)
         return DictList(obs_final)
 
     return obss_preprocessor
@@ -0,0 +1,69 @@
+import queue
+import threading
+import time
+
+from meta_mb.logger import logger
+
+
+class BatchPrefetcher:
+    """
+    Produces a fixed number of batches in a background thread, keeping up to queue_size of them ready.
+
+    The batches are produced in order by a single thread, so as long as sample_fn and preprocess_fn only use their own
+    random state (and the data they read doesn't change meanwhile), the sequence of batches only depends on the seeds.
+    """
+
+    def __init__(self, sample_fn, preprocess_fn, num_batches, queue_size=4):
+        """
+        :param sample_fn: function returning a new batch
+        :param preprocess_fn: function applied to each batch in the background thread; its result is what get() returns
+        :param num_batches: number of batches to produce
+        :param queue_size: maximum number of batches kept ready
+        """
+        self.sample_fn = sample_fn
+        self.preprocess_fn = preprocess_fn
+        self.num_batches = num_batches
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        # Starvation stats: how often, and how long, get() had to wait for the background thread
+        self.num_gets = 0
+        self.num_starved = 0
+        self.wait_time = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for _ in range(self.num_batches):
+                item = (None, self.preprocess_fn(self.sample_fn()))
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(item, timeout=.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stop_event.is_set():
+                    return
+        except Exception as e:
+            # Raised again in the main thread by get()
+            self.queue.put((e, None))
+
+    def get(self):
+        self.num_gets += 1
+        if self.queue.empty():
+            self.num_starved += 1
+        start = time.time()
+        error, item = self.queue.get()
+        self.wait_time += time.time() - start
+        if error is not None:
+            raise error
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def log_stats(self, prefix=''):
+        logger.logkv(f'{prefix}PrefetchStarvedFrac', self.num_starved / max(1, self.num_gets))
+        logger.logkv(f'{prefix}PrefetchWaitTime', self.wait_time)
+        logger.logkv(f'{prefix}PrefetchQueueSize', self.queue.qsize())
@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 from d4rl_content.pointmaze import q_iteration
 from d4rl_content.pointmaze.gridcraft import grid_env
@@ -17,6 +19,8 @@ class WaypointController(object):
         self.solve_thresh = solve_thresh
         self.vel_thresh = 0.1
         self.waypoints = []
+        # Length of the path through the waypoints, from the last start position given to new_target
+        self.path_length = 0
         self.set_maze(maze_str)
 
     def current_waypoint(self):
@@ -30,6 +34,9 @@ class WaypointController(object):
             self.env = grid_env.GridEnv(grid_spec.spec_from_array(maze_str))
         else:
             raise NotImplementedError(f'Unexpected maze str type {type(maze_str)}')
+        self.walls = self.env.gs.spec == WALL
+        # goal cell -> (distance of each cell to the goal, next cell on the path to the goal), see _goal_tables
+        self.goal_tables = {}
 
     def get_action(self, location, velocity, target_pos):
         self.new_target(location, target_pos)
@@ -71,8 +78,64 @@ class WaypointController(object):
                 waypoints = waypoints[1:]
         self.waypoints = waypoints
         self._target = raw_target
+        # All waypoints but the last are neighbouring cells, so only the first and last segments need a norm
+        self.path_length = np.linalg.norm(waypoints[0] - raw_start)
+        if len(waypoints) >= 2:
+            self.path_length += len(waypoints) - 2 + np.linalg.norm(waypoints[-1] - waypoints[-2])
+
+    def _goal_tables(self, goal):
+        """
+        Distance of each cell to goal (-1 if it can't reach it) and the next cell on the path from each cell to goal.
+        The next cell is the first neighbour one step closer, in the order _queue_search expands the neighbours, so
+        following them gives the same paths as _queue_search. Computed once per goal cell of the maze.
+        """
+        if goal in self.goal_tables:
+            return self.goal_tables[goal]
+        h, w = self.walls.shape
+        distances = np.full((h, w), -1, dtype=np.int32)
+        distances[goal] = 0
+        queue = collections.deque([goal])
+        while queue:
+            i, j = queue.popleft()
+            for k, l in [(1, 0), (0, 1), (-1, 0), (0, -1)]:
+                ni, nj = i + k, j + l
+                if 0 <= ni < h and 0 <= nj < w and not self.walls[ni, nj] and distances[ni, nj] < 0:
+                    distances[ni, nj] = distances[i, j] + 1
+                    queue.append((ni, nj))
+        next_cells = np.full((h, w, 2), -1, dtype=np.int32)
+        for i, j in zip(*np.nonzero(distances > 0)):
+            adj_cells = [(i + k, j + l) for k, l in [(1, 0), (0, 1), (-1, 0), (0, -1)]]
+            adj_cells.sort(key=lambda x: np.linalg.norm(np.array(x) - goal))
+            for ni, nj in adj_cells:
+                if 0 <= ni < h and 0 <= nj < w and distances[ni, nj] == distances[i, j] - 1:
+                    next_cells[i, j] = ni, nj
+                    break
+        self.goal_tables[goal] = distances, next_cells
+        return distances, next_cells
 
     def _breadth_first_search(self, initial_state, goal, grid):
+        # Add the offset mapping, which changes from world coordinates to grid coordinates
+        start = tuple(initial_state + self.offset_mapping)
+        goal_cell = tuple(goal + self.offset_mapping)
+        h, w = self.walls.shape
+        if not (0 <= start[0] < h and 0 <= start[1] < w and 0 <= goal_cell[0] < h and 0 <= goal_cell[1] < w):
+            return self._queue_search(initial_state, goal, grid)
+        distances, next_cells = self._goal_tables(goal_cell)
+        if distances[start] < 0:
+            return self._queue_search(initial_state, goal, grid)
+        # Subtract the offset mapping to change back into world coordinates
+        path = [np.array(start) - self.offset_mapping]
+        pos = start
+        for _ in range(distances[start]):
+            pos = tuple(next_cells[pos])
+            path.append(np.array(pos) - self.offset_mapping)
+        return path
+
+    def _queue_search(self, initial_state, goal, grid):
+        """
+        Breadth first search from initial_state, for the cases the goal tables don't cover (start position off the
+        grid or cut off from the goal).
+        """
 
         # Add the offset mapping, which changes from world coordinates to grid coordinates
         initial_state = initial_state + self.offset_mapping
@@ -113,6 +176,39 @@ class WaypointController(object):
             queue += [(next_pos, (i, j)) for next_pos in adj_cells]
 
 
+def test(num_random_mazes=5):
+    """
+    Check the paths looked up in the goal tables against _queue_search, for all the pairs of open cells of the fixed
+    mazes and of seeded random mazes
+    """
+    import random
+    from d4rl_content.pointmaze.maze_model import U_MAZE, MEDIUM_MAZE, LARGE_MAZE, OPEN, TWELVE, FIFTEEN
+    from d4rl_content.pointmaze.generate_new_maze import generate_maze
+
+    mazes = [U_MAZE, MEDIUM_MAZE, LARGE_MAZE, OPEN, TWELVE, FIFTEEN]
+    for seed in range(num_random_mazes):
+        random.seed(seed)
+        np.random.seed(seed)
+        mazes.append(generate_maze(maze_size=8 + seed))
+
+    for index, maze in enumerate(mazes):
+        print('WaypointController on maze %d/%d' % (index + 1, len(mazes)))
+        for offset_mapping in [np.array([0, 0]), np.array([1, 1])]:
+            controller = WaypointController(maze, offset_mapping=offset_mapping)
+            grid = controller.env.gs
+            cells = [np.array(cell) - offset_mapping for cell in zip(*np.nonzero(~controller.walls))]
+            for start in cells:
+                for goal in cells:
+                    try:
+                        expected = controller._queue_search(start, goal, grid)
+                    except IndexError:
+                        # The queue search runs out of cells when the goal can't be reached
+                        continue
+                    path = controller._breadth_first_search(start, goal, grid)
+                    assert len(path) == len(expected)
+                    assert all(np.array_equal(a, b) for a, b in zip(path, expected))
+
+
 if __name__ == "__main__":
     print(q_iteration.__file__)
     TEST_MAZE = \
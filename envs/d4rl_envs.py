@@ -164,8 +164,12 @@ class D4RLEnv:
         self.past_imgs = []
         self.reset_target = reset_target
         self.reset_start = reset_start
-        self._wrapped_env = gym.envs.make(env_name, reset_target=reset_target, reset_start=reset_start,
-                                          reward_type=reward_type)
+        self._wrapped_env = self.make_wrapped_env()
+        # Envs without a fixed maze generate a new random one each time they are built, so only they are rebuilt
+        # at every reset. The others keep their simulator, and reset() only resets its state.
+        spec = gym.spec(env_name)
+        spec_kwargs = getattr(spec, 'kwargs', None) or getattr(spec, '_kwargs', {})
+        self.random_maze = 'maze_spec' not in spec_kwargs and 'maze_map' not in spec_kwargs
         self.feedback_type = feedback_type
         self.np_random = np.random.RandomState(kwargs.get('seed', 0))
         self.teacher_action = self.action_space.sample() * 0 - 1
@@ -177,6 +181,11 @@ class D4RLEnv:
         self.waypoint_controller = WaypointController(self.get_maze(), offset_mapping=om)
         self.scale_factor = 5
         self.repeat_input = 5
+        # See get_maze_plane and update_obs
+        self.maze_plane = None
+        self.obs_buffer = None
+        self.obs_buffer_maze = None
+        self.agent_cell = None
         teachers = {}
         if type(cartesian_steps) is int:
             cartesian_steps = [cartesian_steps]
@@ -214,6 +223,16 @@ class D4RLEnv:
     def get_timestep(self):
         return .02
 
+    def make_wrapped_env(self):
+        return gym.envs.make(self.env_name, reset_target=self.reset_target, reset_start=self.reset_start,
+                             reward_type=self.reward_type)
+
+    def reset_default_target(self):
+        """
+        Set the target a newly built wrapped env starts with (before its reset, which may sample another one)
+        """
+        raise NotImplementedError
+
     def get_target(self):
         raise NotImplementedError
 
@@ -251,14 +270,32 @@ class D4RLEnv:
             dist_to_wall_3 = 1
         return np.array([dist_to_wall_0, dist_to_wall_1, dist_to_wall_2, dist_to_wall_3])
 
+    def get_maze_plane(self):
+        """
+        The maze (without its start cell) padded to max_grid_size x max_grid_size and flattened, as it appears in the
+        observations. Computed once per maze; read-only since it is shared by all the observations.
+        """
+        if self.maze_plane is None:
+            state = self.waypoint_controller.env.gs.spec_no_start
+            max_grid = np.zeros((self.max_grid_size, self.max_grid_size))
+            h, w = state.shape
+            max_grid[:h, :w] = state
+            self.maze_plane = max_grid.flatten()
+            self.maze_plane.setflags(write=False)
+        return self.maze_plane
+
+    def get_obs_tail(self):
+        """
+        :return: array repeated repeat_input times at the end of the observation (after the maze), or None
+        """
+        return None
+
     def update_obs(self, obs_dict):
-        state = self.waypoint_controller.env.gs.spec_no_start
-        max_grid = np.zeros((self.max_grid_size, self.max_grid_size))
-        h, w = state.shape
-        if self.args.show_agent_in_grid:
-            x, y = (self.get_pos() + np.array(self.waypoint_controller.offset_mapping)).round()
-            state[int(x), int(y)] = 2
-        max_grid[:h, :w] = state
+        """
+        Build the observation [state_obs] * repeat_input + [maze plane] (+ [tail] * repeat_input) in obs_buffer.
+        The maze plane is only copied into the buffer when the buffer or the maze changes; the agent marker is
+        moved from its previous cell to the current one.
+        """
         # obs_dict['obs'] = np.concatenate([obs_dict['obs'], self.wall_distance()])
         state_obs = obs_dict['obs']# / self.scale_factor
         if self.args.env == 'ant':
@@ -275,7 +312,28 @@ class D4RLEnv:
             elif self.args.show_goal == 'none':
                 goal = np.array([0, 0])
             state_obs = np.concatenate([state_obs, goal])
-        obs_dict['obs'] = np.concatenate([state_obs] * self.repeat_input + [max_grid.flatten()])  # TODO: /5 is a hacky way of trying to make the max grid less useful
+        tail = self.get_obs_tail()
+        maze_plane = self.get_maze_plane()
+        maze_start = len(state_obs) * self.repeat_input
+        maze_end = maze_start + len(maze_plane)
+        size = maze_end + (0 if tail is None else len(tail) * self.repeat_input)
+        if self.obs_buffer is None or len(self.obs_buffer) != size or self.obs_buffer_maze is not maze_plane:
+            self.obs_buffer = np.zeros(size)
+            self.obs_buffer[maze_start:maze_end] = maze_plane  # TODO: /5 is a hacky way of trying to make the max grid less useful
+            self.obs_buffer_maze = maze_plane
+            self.agent_cell = None
+        if self.agent_cell is not None:
+            self.obs_buffer[self.agent_cell] = maze_plane[self.agent_cell - maze_start]
+            self.agent_cell = None
+        if self.args.show_agent_in_grid:
+            x, y = (self.get_pos() + np.array(self.waypoint_controller.offset_mapping)).round()
+            self.agent_cell = maze_start + int(x) * self.max_grid_size + int(y)
+            self.obs_buffer[self.agent_cell] = 2
+        self.obs_buffer[:maze_start].reshape(self.repeat_input, -1)[:] = state_obs
+        if tail is not None:
+            self.obs_buffer[maze_end:].reshape(self.repeat_input, -1)[:] = tail
+        # The callers keep the observations of past steps, so they get their own copy of the buffer
+        obs_dict['obs'] = self.obs_buffer.copy()
         if self.teacher is not None and not 'None' in self.teacher.teachers:
             advice = self.teacher.give_feedback(self)
             obs_dict.update(advice)
@@ -294,9 +352,7 @@ class D4RLEnv:
         obs, rew, done, info = self._wrapped_env.step(action)
         self.waypoint_controller.new_target(self.get_pos(), self.get_target())
         # Distance to goal
-        start_points = [self.get_pos()] + self.waypoint_controller.waypoints[:-1]
-        end_points = self.waypoint_controller.waypoints
-        distance = sum([np.linalg.norm(end - start) for start, end in zip(start_points, end_points)])
+        distance = self.waypoint_controller.path_length
         gave_reward = True
         if self.reward_type == 'sparse':
             gave_reward = done
@@ -436,18 +492,22 @@ class D4RLEnv:
         pass  # for compatibility with babyai, which does set tasks
 
     def reset(self):
-        self._wrapped_env = gym.envs.make(self.env_name, reset_target=self.reset_target, reset_start=self.reset_start,
-                                          reward_type=self.reward_type)
+        if self.random_maze:
+            self._wrapped_env = self.make_wrapped_env()
+        else:
+            self.reset_default_target()
         obs = self._wrapped_env.reset()
         obs_dict = {'obs': obs}
         self.steps_since_recompute = 0
-        self.waypoint_controller.set_maze(self.get_maze())
-        if 'ant' in self.env_name:
-            om = self._wrapped_env.env.wrapped_env._xy_to_rowcol(np.array([self._wrapped_env.env.wrapped_env._init_torso_x,
-                                                                       self._wrapped_env.env.wrapped_env._init_torso_y]))
-        else:
-            om = np.array([0, 0])
-        self.waypoint_controller.offset_mapping = om
+        if self.random_maze:
+            self.waypoint_controller.set_maze(self.get_maze())
+            self.maze_plane = None
+            if 'ant' in self.env_name:
+                om = self._wrapped_env.env.wrapped_env._xy_to_rowcol(np.array([self._wrapped_env.env.wrapped_env._init_torso_x,
+                                                                           self._wrapped_env.env.wrapped_env._init_torso_y]))
+            else:
+                om = np.array([0, 0])
+            self.waypoint_controller.offset_mapping = om
         self.waypoint_controller.new_target(self.get_pos(), self.get_target())
         self.min_waypoints = len(self.waypoint_controller.waypoints)
         if hasattr(self, 'teacher') and self.teacher is not None:
@@ -498,6 +558,14 @@ class PointMassEnv(D4RLEnv):
     def get_target(self):
         return self._wrapped_env.get_target()
 
+    def reset_default_target(self):
+        # Same as MazeEnv.__init__: the goal cell if there is one, otherwise the first empty cell
+        maze_env = self._wrapped_env.unwrapped
+        if len(maze_env.goal_locations) > 0:
+            maze_env.set_target(maze_env.goal_locations[0])
+        else:
+            maze_env.set_target(np.array(maze_env.reset_locations[0]).astype(maze_env.observation_space.dtype))
+
     def get_maze(self):
         return self._wrapped_env.get_maze()
 
@@ -507,10 +575,12 @@ class PointMassEnv(D4RLEnv):
     def get_vel(self):
         return self._wrapped_env.get_sim().data.qvel
 
+    def get_obs_tail(self):
+        # Adding goal
+        return self.get_target() / self.scale_factor
+
     def step(self, action):
         obs_dict, rew, done, info = super().step(action)
-        target = self.get_target() / self.scale_factor
-        obs_dict['obs'] = np.concatenate([obs_dict['obs']] + [target] * self.repeat_input)
         if self.reward_type == 'dense':
             rew = rew / 10 - .01
         # done = done or info['success']
@@ -518,12 +588,6 @@ class PointMassEnv(D4RLEnv):
             rew += 1
         return obs_dict, rew, done, info
 
-    def reset(self):
-        obs_dict = super().reset()
-        target = self.get_target() / self.scale_factor
-        obs_dict['obs'] = np.concatenate([obs_dict['obs']] + [target] * self.repeat_input)
-        return obs_dict
-
 
 class PointMassSACEnv(PointMassEnv):
     def step(self, action):
@@ -546,6 +610,10 @@ class AntEnv(D4RLEnv):
     def get_target(self):
         return np.array(self._wrapped_env.xy_to_rowcolcontinuous(self._wrapped_env.get_target()))
 
+    def reset_default_target(self):
+        # AntMazeEnv.__init__ samples a new goal
+        self._wrapped_env.set_target()
+
     def get_maze(self):
         return self._wrapped_env.get_maze()
 
@@ -17,7 +17,11 @@ class PPOAlgo(BaseAlgo):
         super().__init__(envs, policy_dict, args.frames_per_proc, args.discount, args.lr, args.gae_lambda, args.entropy_coef,
                          args.value_loss_coef, args.max_grad_norm, args.recurrence, obs_preprocessor, None,
                          None, not args.sequential, args.rollouts_per_meta_task, instr_dropout_prob=args.collect_dropout_prob,
-                         repeated_seed=repeated_seed, reset_each_batch=args.reset_each_batch)
+                         repeated_seed=repeated_seed, reset_each_batch=args.reset_each_batch,
+                         batched_env=getattr(args, 'batched_env', False),
+                         shared_memory_env=getattr(args, 'shared_memory_env', False),
+                         pipelined_collection=getattr(args, 'pipelined_collection', False),
+                         inline_first_env=not getattr(args, 'env0_worker', False))
 
         num_frames_per_proc = args.frames_per_proc or 128
         self.policy_dict = policy_dict
@@ -128,11 +132,15 @@ class PPOAlgo(BaseAlgo):
         model_running_time = 0
         backward_time = 0
 
+        # The batch is preprocessed once, and its tensors are shared by all the epochs, which only read them. The
+        # exception is the memory, which the recurrence overwrites, so each epoch starts from a copy of it.
+        exps = copy.copy(original_exps)
+        exps.obs = self.preprocess_obss(original_exps.obs, teacher_dict)
+        teacher_max = exps.teacher_action.detach().cpu().numpy()
+        orig_actions = exps.action.detach().cpu().numpy()
+
         for e in range(self.epochs):
-            exps = copy.deepcopy(original_exps)
-            exps.obs = self.preprocess_obss(exps.obs, teacher_dict)
-            teacher_max = exps.teacher_action.detach().cpu().numpy()
-            orig_actions = exps.action.detach().cpu().numpy()
+            exps.memory = original_exps.memory.clone()
 
             # Initialize log values
             log_returnn = []
@@ -8,8 +8,8 @@ from collections import OrderedDict
 
 from pyprind import ProgBar
 import numpy as np
+import torch
 import time
-import itertools
 
 
 class MetaSampler(BaseSampler):
@@ -97,7 +97,8 @@ class MetaSampler(BaseSampler):
             paths[i] = []
 
         n_samples = 0
-        running_paths = [_get_empty_running_paths_dict() for _ in range(self.vec_env.num_envs)]
+        # Room for all the paths of each env, which are concatenated into one RL2 trial
+        trials = TrialBuffer(self.vec_env.num_envs, self.rollouts_per_meta_task * self.max_path_length)
 
         total_paths = self.rollouts_per_meta_task * self.meta_batch_size * self.envs_per_task
         pbar = ProgBar(total_paths)
@@ -121,13 +122,12 @@ class MetaSampler(BaseSampler):
             obses = self.obs_preprocessor(obses, teacher_dict, show_instrs=show_instrs)
             if random:
                 actions = np.stack([[self.env.action_space.sample()] for _ in range(len(obses.obs))], axis=0)
-                agent_infos = [[{'mean': np.zeros_like(self.env.action_space.sample()),
-                                 'log_std': np.zeros_like(
-                                     self.env.action_space.sample())}] * self.envs_per_task] * self.meta_batch_size
+                action_shape = (len(actions),) + np.shape(self.env.action_space.sample())
+                agent_infos = {'mean': np.zeros(action_shape), 'log_std': np.zeros(action_shape)}
             else:
                 actions, agent_infos = policy.get_actions_t(obses, temp=temperature)
                 if max_action:
-                    actions = np.array([np.argmax(d['probs']) for d in agent_infos], dtype=np.int32)
+                    actions = np.argmax(agent_infos.probs, axis=1).astype(np.int32)
 
 
             policy_time += time.time() - t
@@ -137,40 +137,26 @@ class MetaSampler(BaseSampler):
             next_obses, rewards, dones, env_infos = self.vec_env.step(actions)
             env_time += time.time() - t
 
+            # Only store the steps of envs whose task still needs paths
+            idxs = np.array([idx for idx in range(self.vec_env.num_envs)
+                             if len(paths[idx // self.envs_per_task]) < self.rollouts_per_meta_task], dtype='int')
+            trials.append(idxs,
+                          observations={k: _to_numpy(v) for k, v in dict.items(obses)},
+                          actions=np.asarray(actions),
+                          rewards=np.reshape(np.asarray(rewards, dtype=np.float64), (len(rewards), -1))[:, 0],
+                          dones=np.asarray(dones),
+                          env_infos=utils.stack_tensor_dict_list(env_infos),
+                          agent_infos={k: v for k, v in dict.items(agent_infos) if k != 'memory'})
+
             new_samples = 0
             new_paths = 0
-            for idx, action, reward, env_info, agent_info, done in zip(itertools.count(), actions,
-                                                                                    rewards, env_infos, agent_infos,
-                                                                                    dones):
-                observation = obses[idx]
-                # append new samples to running paths
-                if isinstance(reward, np.ndarray):
-                    reward = reward[0]
-                running_paths[idx]["observations"].append(observation)
-                running_paths[idx]["actions"].append(action)
-                running_paths[idx]["rewards"].append(reward)
-                running_paths[idx]["dones"].append(done)
-                running_paths[idx]["env_infos"].append(env_info)
-                del agent_info['memory']
-                running_paths[idx]["agent_infos"].append(agent_info)
-
-                # if running path is done, add it to paths and empty the running path
-                if done:
-                    curr_path = paths[idx // self.envs_per_task]
-                    if len(curr_path) >= self.rollouts_per_meta_task:
-                        continue
-                    paths[idx // self.envs_per_task].append(dict(
-                        observations=np.asarray(running_paths[idx]["observations"]),
-                        actions=np.asarray(running_paths[idx]["actions"]),
-                        rewards=np.asarray(running_paths[idx]["rewards"]),
-                        dones=np.asarray(running_paths[idx]["dones"]),
-                        env_infos=utils.stack_tensor_dict_list(running_paths[idx]["env_infos"]),
-                        agent_infos=utils.stack_tensor_dict_list(running_paths[idx]["agent_infos"]),
-                    ))
-                    num_paths += 1
-                    new_paths += 1
-                    new_samples += len(running_paths[idx]["rewards"])
-                    running_paths[idx] = _get_empty_running_paths_dict()
+            for idx in idxs[np.asarray(dones)[idxs]]:
+                # if running path is done, add it to paths
+                path = trials.end_path(idx)
+                paths[idx // self.envs_per_task].append(path)
+                num_paths += 1
+                new_paths += 1
+                new_samples += len(path["rewards"])
 
             pbar.update(new_paths)
             n_samples += new_samples
@@ -182,12 +168,199 @@ class MetaSampler(BaseSampler):
             logger.logkv(log_prefix + "PolicyExecTime", policy_time)
             logger.logkv(log_prefix + "EnvExecTime", env_time)
 
-        return paths
+        return SampledPaths(paths, trials)
 
 
     def advance_curriculum(self):
         self.vec_env.advance_curriculum()
 
+    def sync_curriculum(self, curriculum_state):
+        """
+        Bring the curricula of the sampler's envs to curriculum_state (see Curriculum.get_curriculum_state)
+        """
+        self.vec_env.sync_curriculum(curriculum_state)
+
+
+class SampledPaths(OrderedDict):
+    """
+    The paths of each meta task, as returned by MetaSampler.obtain_samples. The paths are views of trials, the
+    TrialBuffer they were written to, which sample processors can use directly.
+    """
+
+    def __init__(self, paths, trials):
+        super(SampledPaths, self).__init__(paths)
+        self.trials = trials
+
+
+class TrialBuffer(object):
+    """
+    Struct-of-arrays storage for the steps of a sampling run. Each env has a row of preallocated arrays, which its
+    paths are written to one after the other, so that the row holds the RL2 trial of the env. Finished paths are views
+    of a row, and the zero-padded [num_envs x max_length] arrays of the trials are slices of the rows.
+
+    The rows start with room for min(max_length, initial_capacity) steps, and double in size whenever a path runs
+    past them, so max_length may be infinite (the default of --max_path_length). Paths finished before the rows grow
+    stay views of the previous arrays, which no longer change.
+
+    Args:
+        num_envs (int): number of envs (rows)
+        max_length (int or float): maximum number of steps of a row (can be inf)
+    """
+
+    # Number of steps of the rows when they are first allocated, if max_length is larger
+    initial_capacity = 256
+
+    def __init__(self, num_envs, max_length=float('inf')):
+        self.num_envs = num_envs
+        self.max_length = max_length
+        self.capacity = int(min(max_length, self.initial_capacity))
+        self.lengths = np.zeros(num_envs, dtype='int')
+        self.path_starts = np.zeros(num_envs, dtype='int')
+        # (env, start, end, path) of each finished path
+        self.finished = []
+        # Allocated on the first step, once the shapes are known
+        self.data = None
+
+    def append(self, idxs, **step):
+        """
+        Store a step of the envs idxs.
+
+        Args:
+            idxs (np.ndarray): indices of the envs whose step is stored
+            step: batched observations, actions, rewards, dones, env_infos and agent_infos of all the envs.
+                The dicts (observations and infos) hold one array per key.
+        """
+        if len(idxs) == 0:
+            return
+        if self.data is None:
+            self.data = _allocate(step, (self.num_envs, self.capacity))
+        assert np.all(self.lengths[idxs] < self.max_length), "A path is longer than max_path_length"
+        if np.any(self.lengths[idxs] >= self.capacity):
+            self.capacity *= 2
+            self.data = _grow(self.data, self.capacity)
+        _write(self.data, step, idxs, self.lengths[idxs])
+        self.lengths[idxs] += 1
+
+    def end_path(self, idx):
+        """
+        Returns:
+            (dict): the path env idx just finished, as views of its row
+        """
+        start, end = self.path_starts[idx], self.lengths[idx]
+        self.path_starts[idx] = end
+        path = _slice(self.data, idx, slice(start, end))
+        self.finished.append((idx, start, end, path))
+        return path
+
+    def stacked(self):
+        """
+        Returns:
+            (dict): the finished paths of each env, concatenated and zero-padded to the longest trial
+        """
+        return _slice(self.data, slice(None), slice(0, self.path_starts.max()))
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _allocate(example, shape):
+    if isinstance(example, dict):
+        return {k: _allocate(v, shape) for k, v in example.items()}
+    example = np.asarray(example)
+    dtype = example.dtype if example.dtype.kind in 'biuf' else object
+    return np.zeros(shape + example.shape[1:], dtype=dtype)
+
+
+def _grow(data, capacity):
+    if isinstance(data, dict):
+        return {k: _grow(v, capacity) for k, v in data.items()}
+    grown = np.zeros((data.shape[0], capacity) + data.shape[2:], dtype=data.dtype)
+    grown[:, :data.shape[1]] = data
+    return grown
+
+
+def _write(data, values, idxs, steps):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            _write(v, values[k], idxs, steps)
+    else:
+        data[idxs, steps] = values[idxs]
+
+
+def _slice(data, rows, steps):
+    if isinstance(data, dict):
+        return {k: _slice(v, rows, steps) for k, v in data.items()}
+    return data[rows, steps]
+
+
+def test(rollouts_per_meta_task=6, meta_batch_size=3):
+    """
+    Check that obtain_samples works with the default (infinite) max_path_length, and that process_samples gives the
+    same data for the paths as views of a TrialBuffer as for the same paths as separate arrays (the list-based path)
+    """
+    from babyai.arguments import ArgumentParser
+    from babyai.levels.curriculum import Curriculum
+    from babyai.model import ACModel
+    from babyai.utils.obs_preprocessor import make_obs_preprocessor
+    from meta_mb.meta_envs.rl2_env import rl2env
+    from meta_mb.envs.normalized_env import normalize
+    from meta_mb.samplers.meta_samplers.rl2_sample_processor import RL2SampleProcessor
+
+    args = ArgumentParser().parse_args([])
+    assert args.max_path_length == float('inf')
+    utils.set_seed(0)
+    feedback_type = 'PreActionAdvice'
+    arguments = dict(start_loc='all', include_holdout_obj=False, persist_goal=True, persist_objs=True,
+                     persist_agent=True, feedback_type=[feedback_type], feedback_freq=[1], cartesian_steps=[1],
+                     num_meta_tasks=rollouts_per_meta_task, intermediate_reward=False, reward_type='sparse',
+                     fully_observed=False, padding=False, args=args, seed=0, static_env=False)
+    env = rl2env(normalize(Curriculum(args.advance_curriculum_func, env='babyai', start_index=0,
+                                      curriculum_type=args.curriculum_type, **arguments)), ceil_reward=args.ceil_reward)
+    obs = env.reset()
+    args.discrete = True
+    args.advice_size = args.reconstruct_advice_size = np.prod(obs[feedback_type].shape)
+    policy = ACModel(action_space=env.action_space, env=env, args=args)
+    sampler = MetaSampler(env=env, policy={feedback_type: policy}, rollouts_per_meta_task=rollouts_per_meta_task,
+                          meta_batch_size=meta_batch_size, max_path_length=args.max_path_length, envs_per_task=1,
+                          obs_preprocessor=make_obs_preprocessor(env.teacher.null_feedback()))
+    sample_processor = RL2SampleProcessor(discount=args.discount, gae_lambda=args.gae_lambda, normalize_adv=True,
+                                          positive_adv=False)
+
+    for random in [True, False]:
+        print('MetaSampler, %s actions' % ('random' if random else 'policy'))
+        paths = sampler.obtain_samples(policy=policy, teacher_dict={feedback_type: True}, random=random)
+        assert paths.trials.capacity > TrialBuffer.initial_capacity, "The trials should be long enough to grow"
+        list_paths = OrderedDict((task, [_copy(path) for path in task_paths]) for task, task_paths in paths.items())
+        samples_data = sample_processor.process_samples(paths)
+
+        # The list-based path stacks arrays, so it gets the observations one key at a time
+        obs_keys = list(list_paths[0][0]['observations'].keys())
+        expected = sample_processor.process_samples(OrderedDict(
+            (task, [dict(path, observations=path['observations'][obs_keys[0]]) for path in task_paths])
+            for task, task_paths in list_paths.items()))
+        for key in ['actions', 'rewards', 'dones', 'returns', 'advantages', 'env_infos', 'agent_infos',
+                    'avg_reward']:
+            _assert_equal(samples_data[key], expected[key])
+        for obs_key in obs_keys:
+            stacked = sample_processor._stack_padding(
+                [{'observations': np.concatenate([path['observations'][obs_key] for path in task_paths])}
+                 for task_paths in list_paths.values()], 'observations', samples_data['rewards'].shape[1])
+            _assert_equal(samples_data['observations'][obs_key], stacked)
+
+
+def _copy(data):
+    if isinstance(data, dict):
+        return {k: _copy(v) for k, v in data.items()}
+    return np.array(data)
+
 
-def _get_empty_running_paths_dict():
-    return dict(observations=[], actions=[], rewards=[], dones=[], env_infos=[], agent_infos=[])
+def _assert_equal(data, expected):
+    if isinstance(data, dict):
+        assert data.keys() == expected.keys()
+        for k in data:
+            _assert_equal(data[k], expected[k])
+    else:
+        assert np.shape(data) == np.shape(expected) and np.array_equal(data, expected), (data, expected)
@@ -1,7 +1,56 @@
+import inspect
 import numpy as np
-import pickle as pickle
 from multiprocessing import Process, Pipe
 import copy
+from meta_mb.utils.serializable import Serializable
+
+
+class EnvSpec(object):
+    """
+    What a worker needs to build its own copy of a Serializable env: the class and constructor arguments of the env and
+    of each Serializable env it wraps. Making a spec doesn't pickle or copy any env.
+
+    Args:
+        env_class (type): class of the env
+        args (list): positional arguments of the env; the wrapped env is given by its own EnvSpec
+        kwargs (dict): keyword arguments of the env
+    """
+
+    def __init__(self, env_class, args, kwargs):
+        self.env_class = env_class
+        self.args = args
+        self.kwargs = kwargs
+
+    @classmethod
+    def from_env(cls, env, **kwargs):
+        """
+        Args:
+            env (Serializable): env, possibly wrapped (e.g. in normalize and rl2env)
+            kwargs: arguments to change in the innermost Serializable env, e.g. the start_index of a Curriculum
+
+        Returns:
+            (EnvSpec): spec of env
+        """
+        assert isinstance(env, Serializable)
+        state = Serializable.__getstate__(env)
+        args, env_kwargs = list(state["__args"]), dict(state["__kwargs"])
+        wrapped_env = env.__dict__.get('_wrapped_env')
+        if isinstance(wrapped_env, Serializable) and any(arg is wrapped_env for arg in args):
+            index = [arg is wrapped_env for arg in args].index(True)
+            args[index] = cls.from_env(wrapped_env, **kwargs)
+        else:
+            # Same as Serializable.clone
+            in_order_args = inspect.getfullargspec(env.__init__).args[1:]
+            for kw, val in kwargs.items():
+                if kw in in_order_args:
+                    args[in_order_args.index(kw)] = val
+                else:
+                    env_kwargs[kw] = val
+        return cls(type(env), args, env_kwargs)
+
+    def build(self):
+        args = [arg.build() if isinstance(arg, EnvSpec) else arg for arg in self.args]
+        return self.env_class(*args, **self.kwargs)
 
 
 class MetaIterativeEnvExecutor(object):
@@ -90,6 +139,13 @@ class MetaIterativeEnvExecutor(object):
         advances = [env.advance_curriculum() for env in self.envs]
         return advances
 
+    def sync_curriculum(self, curriculum_state):
+        """
+        Brings the curricula of the envs to curriculum_state (see Curriculum.get_curriculum_state)
+        """
+        for env in self.envs:
+            env.set_curriculum_state(curriculum_state)
+
     def set_dropout(self, dropout_proportion):
         """
         Changes the dropout level
@@ -142,8 +198,13 @@ class MetaParallelEnvExecutor(object):
         self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(meta_batch_size)])
         seeds = np.random.choice(range(10**6), size=meta_batch_size, replace=False)
 
+        # The workers build their envs from a spec, directly at the current level of the curriculum, and only get the
+        # curriculum state to sync to
+        self.curriculum_state = env.get_curriculum_state()
+        env_spec = EnvSpec.from_env(env, start_index=self.curriculum_state['index'])
         self.ps = [
-            Process(target=worker, args=(work_remote, remote, pickle.dumps(env), envs_per_task, max_path_length, seed))
+            Process(target=worker, args=(work_remote, remote, env_spec, self.curriculum_state, envs_per_task,
+                                         max_path_length, seed))
             for (work_remote, remote, seed) in zip(self.work_remotes, self.remotes, seeds)]  # Why pass work remotes?
 
         for p in self.ps:
@@ -151,7 +212,6 @@ class MetaParallelEnvExecutor(object):
             p.start()
         for remote in self.work_remotes:
             remote.close()
-        self.set_level_distribution(env.index)
         self.set_tasks()
         self.reset()
 
@@ -200,9 +260,22 @@ class MetaParallelEnvExecutor(object):
         """
         for remote in self.remotes:
             remote.send(('advance_curriculum', None))
-        [remote.recv() for remote in self.remotes]
+        self.curriculum_state = [remote.recv() for remote in self.remotes][0]
         return None
 
+    def sync_curriculum(self, curriculum_state):
+        """
+        Brings the curricula of the workers to curriculum_state (see Curriculum.get_curriculum_state). Nothing is sent
+        if they are already there.
+        """
+        if same_curriculum_state(curriculum_state, self.curriculum_state):
+            return
+        for remote in self.remotes:
+            remote.send(('set_curriculum_state', curriculum_state))
+        for remote in self.remotes:
+            remote.recv()
+        self.curriculum_state = copy.deepcopy(curriculum_state)
+
     def set_dropout(self, dropout_proportion):
         """
         Changes the dropout level
@@ -247,8 +320,7 @@ class MetaParallelEnvExecutor(object):
         """
         for remote in self.remotes:
             remote.send(('set_level_distribution', index))
-        for remote in self.remotes:
-            remote.recv()
+        self.curriculum_state = [remote.recv() for remote in self.remotes][0]
 
     def render(self):
         for remote in self.remotes:
@@ -267,7 +339,11 @@ class MetaParallelEnvExecutor(object):
         return self.n_envs
 
 
-def worker(remote, parent_remote, env_pickle, n_envs, max_path_length, seed):
+def same_curriculum_state(state, other):
+    return state['index'] == other['index'] and np.array_equal(state['distribution'], other['distribution'])
+
+
+def worker(remote, parent_remote, env_spec, curriculum_state, n_envs, max_path_length, seed):
     """
     Instantiation of a parallel worker for collecting samples. It loops continually checking the task that the remote
     sends to it.
@@ -275,15 +351,17 @@ def worker(remote, parent_remote, env_pickle, n_envs, max_path_length, seed):
     Args:
         remote (multiprocessing.Connection):
         parent_remote (multiprocessing.Connection):
-        env_pickle (pkl): pickled environment
+        env_spec (EnvSpec): spec the worker builds its environments from
+        curriculum_state (dict): state of the curriculum to start from (see Curriculum.get_curriculum_state)
         n_envs (int): number of environments per worker
         max_path_length (int): maximum path length of the task
         seed (int): random seed for the worker
     """
     parent_remote.close()
 
-    envs = [pickle.loads(env_pickle) for _ in range(n_envs)]
+    envs = [env_spec.build() for _ in range(n_envs)]
     for env in envs:
+        env.set_curriculum_state(curriculum_state)
         env.seed(int(seed))
     np.random.seed(seed)
 
@@ -323,6 +401,11 @@ def worker(remote, parent_remote, env_pickle, n_envs, max_path_length, seed):
         elif cmd == 'advance_curriculum':
             for env in envs:
                 env.advance_curriculum()
+            remote.send(envs[0].get_curriculum_state())
+
+        elif cmd == 'set_curriculum_state':
+            for env in envs:
+                env.set_curriculum_state(data)
             remote.send(None)
 
         # close the remote and stop the worker
@@ -338,7 +421,7 @@ def worker(remote, parent_remote, env_pickle, n_envs, max_path_length, seed):
         elif cmd == 'set_level_distribution':
             for env in envs:
                 env.set_level_distribution(data)
-            remote.send(None)
+            remote.send(envs[0].get_curriculum_state())
 
         elif cmd == 'render':
             img = [env.render('rgb_array') for env in envs]
@@ -1,4 +1,5 @@
 from meta_mb.samplers.base import SampleProcessor
+from meta_mb.utils import utils
 import numpy as np
 import copy
 
@@ -23,6 +24,8 @@ class RL2SampleProcessor(SampleProcessor):
             (list of dicts) : Processed sample data among the meta-batch; size: [meta_batch_size] x [7] x (batch_size x max_path_length)
         """
         assert isinstance(paths_meta_batch, dict), 'paths must be a dict'
+        if getattr(paths_meta_batch, 'trials', None) is not None:
+            return self._process_trials(paths_meta_batch, log=log, log_prefix=log_prefix, log_teacher=log_teacher)
         original_paths = paths_meta_batch
 
         samples_data_meta_batch = []
@@ -53,3 +56,31 @@ class RL2SampleProcessor(SampleProcessor):
             avg_reward=np.mean([sum(path["rewards"]) for path in all_paths])
         )
         return samples_data
+
+    def _process_trials(self, paths_meta_batch, log=False, log_prefix='', log_teacher=True):
+        """
+        Same as process_samples, for paths which are views of a TrialBuffer (as sampled by MetaSampler). The stacked
+        data are slices of the buffer's arrays, so only the returns are computed.
+        """
+        trials = paths_meta_batch.trials
+        stacked = trials.stacked()
+        returns = np.zeros(stacked['rewards'].shape)
+        for idx, start, end, path in trials.finished:
+            returns[idx, start:end] = utils.discount_cumsum(path['rewards'], self.discount)
+            path['returns'] = returns[idx, start:end]
+            path['advantages'] = path['actions']  # Placeholder, like _compute_advantages
+        all_paths = [path for paths in paths_meta_batch.values() for path in paths]
+
+        self._log_path_stats(all_paths, log=log, log_prefix=log_prefix, log_teacher=log_teacher)
+        samples_data = dict(
+            observations=stacked['observations'],
+            actions=stacked['actions'],
+            rewards=stacked['rewards'],
+            dones=stacked['dones'],
+            returns=returns,
+            advantages=stacked['actions'],
+            env_infos=stacked['env_infos'],
+            agent_infos=stacked['agent_infos'],
+            avg_reward=np.mean([sum(path["rewards"]) for path in all_paths])
+        )
+        return samples_data
@@ -105,7 +105,8 @@ class ImitationLearning(object):
             else:
                 reconstructor.eval()
 
-    def run_epoch_recurrence_one_batch(self, batch, is_training=False, source='agent', teacher_dict={}, backprop=True):
+    def run_epoch_recurrence_one_batch(self, batch, is_training=False, source='agent', teacher_dict={}, backprop=True,
+                                       preprocessed_obs=None, trunk=None):
         active_teachers = [k for k, v in teacher_dict.items() if v]
         assert len(active_teachers) <= 2
         teacher_name = 'none' if len(active_teachers) == 0 else active_teachers[0]
@@ -122,12 +123,20 @@ class ImitationLearning(object):
         # Inds holds the start of each demo
         obss, action_true, action_teacher = batch
         self.initialize_logs(len(action_true))
-        # Dropout instructions with probability instr_dropout_prob,
-        # unless we have no teachers present in which case we keep the instr.
-        instr_dropout_prob = 0 if np.sum(list(teacher_dict.values())) == 0 else self.instr_dropout_prob
-        obss = self.preprocess_obs(obss, teacher_dict, show_instrs=np.random.uniform() > instr_dropout_prob)
-
-        dist, info = acmodel(obss)
+        if preprocessed_obs is not None:
+            # Already preprocessed for this teacher_dict (e.g. by a BatchPrefetcher)
+            obss = preprocessed_obs
+        else:
+            # Dropout instructions with probability instr_dropout_prob,
+            # unless we have no teachers present in which case we keep the instr.
+            instr_dropout_prob = 0 if np.sum(list(teacher_dict.values())) == 0 else self.instr_dropout_prob
+            obss = self.preprocess_obs(obss, teacher_dict, show_instrs=np.random.uniform() > instr_dropout_prob)
+
+        if trunk is not None:
+            # The trunk was already run on these observations (e.g. shared with other teacher subsets in distill)
+            dist, info = acmodel.forward_heads(trunk, obss.advice if acmodel.advice_size > 0 else None)
+        else:
+            dist, info = acmodel(obss)
         kl_loss = info['kl']
         if len(action_true.shape) == 3:  # Has an extra dimension
             action_true = action_true.squeeze(1)
@@ -292,145 +301,155 @@ class ImitationLearning(object):
         return log
 
     def relabel(self, batch, relabel_dict, source):
+        """
+        Replace the action labels of a batch from preprocess_batch with the actions of the policy for relabel_dict.
+        The sampled frames are independent (columns of observations, not whole demos), so they are all relabeled
+        with one forward pass.
+        """
         if source == 'teacher':
             return batch
-        self.set_mode(False)
-        obss_list_original, action_true, action_teacher, done, inds_original, mask = batch
-        inds = inds_original.copy()
-
-        # All the batch demos are in a single flat vector.
-        # Inds holds the start of each demo
-        obss_list = [self.preprocess_obs(o, relabel_dict, show_instrs=True) for o in obss_list_original]
-        obss = {}
-        keys = obss_list[0].keys()
-        for k in keys:
-            obss[k] = torch.cat([getattr(o, k) for o in obss_list])
-        obss = DictList(obss)
+        obss, action_true, action_teacher = batch
+        active_teachers = [k for k, v in relabel_dict.items() if v]
+        acmodel = self.policy_dict['none' if len(active_teachers) == 0 else active_teachers[0]]
+        self.set_mode(False, acmodel, None)
         dtype = torch.long if self.args.discrete and not (source == 'agent_probs') else torch.float32
-        actions = torch.zeros_like(action_true, device=self.device,
-                                   dtype=dtype)
-        memory = torch.zeros([len(inds), self.acmodel.memory_size], device=self.device)
-
-        # We're going to loop through each trajectory together.
-        # inds holds the current index of each trajectory (initialized to the start of each trajectory)
-        while True:
-            # taking observations and done located at inds
-            num_demos = len(inds)
-            obs = obss[inds]
-            done_step = done[inds]
-
-            with torch.no_grad():
-                # Taking memory up until num_demos, as demos after that have finished
-                dist, info = self.acmodel(obs, memory[:num_demos])
-                if source == 'agent':
-                    action = dist.sample().to(dtype)
-                elif source == 'agent_argmax':
-                    action = dist.probs.max(1, keepdim=False)[1].to(dtype)
-                elif source == 'agent_probs':
-                    action = dist.probs.float()
-                new_memory = info['memory']
-            actions[inds] = action[:num_demos]
-            memory[:num_demos] = new_memory
-
-            # Updating inds, by removing those indices corresponding to which the demonstrations have finished
-            num_trajs_finished = sum(done_step)
-            inds = inds[:int(num_demos - num_trajs_finished)]
-            if len(inds) == 0:
-                break
-
-            # Incrementing the remaining indices
-            inds = [index + 1 for index in inds]
-        return obss_list_original, actions, action_teacher, done, inds_original, mask
-
-    def distill(self, demo_batch, is_training=True, source='agent', teachers_dict={}, distill_target='distill_powerset',
-                relabel=False, relabel_dict={}, distill_to_none=True):
-
-        preprocessed_batch = self.preprocess_batch(demo_batch, source)
-        if relabel:
-            preprocessed_batch = self.relabel(preprocessed_batch, relabel_dict, source)
-
-        # Distill to the powerset of distillation types
+        with torch.no_grad():
+            dist, _ = acmodel(self.preprocess_obs(obss, relabel_dict, show_instrs=True))
+            if source == 'agent':
+                action = dist.sample().to(dtype)
+            elif source == 'agent_argmax':
+                action = dist.probs.max(1, keepdim=False)[1].to(dtype)
+            elif source == 'agent_probs':
+                action = dist.probs.float()
+        return obss, action, action_teacher
+
+    def teacher_subsets(self, teachers_dict, distill_target='distill_powerset', distill_to_none=True):
+        """
+        List the teacher subsets distill() trains on.
+        :return: list of (key_set, teacher_subset_dict), in training order
+        """
         keys = [key for key in teachers_dict.keys() if teachers_dict[key]]
         powerset = chain.from_iterable(combinations(keys, r) for r in range(len(keys) + 1))
-        logs = {}
-        if distill_target =='single_teachers_none' and not distill_to_none:
+        if distill_target == 'single_teachers_none' and not distill_to_none:
             distill_target = 'single_teachers'
-            print('NOT distilling to none this itr')
 
+        subsets = []
         if distill_target == 'powerset':
             for key_set in powerset:
                 if len(key_set) > 1:
                     continue
-                teacher_subset_dict = {}
-                for k in teachers_dict.keys():
-                    if k in key_set:
-                        teacher_subset_dict[k] = True
-                    else:
-                        teacher_subset_dict[k] = False
-                log, _ = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
-                                                          teacher_dict=teacher_subset_dict)
-                logs[key_set] = log
+                subsets.append((key_set, {k: k in key_set for k in teachers_dict.keys()}))
         elif distill_target == 'all_but_none':
             for key_set in powerset:
                 if len(key_set) > 1:
                     continue
-                teacher_subset_dict = {}
                 if len(key_set) == 0:  # Don't distill to no teacher
                     continue
-                for k in teachers_dict.keys():
-                    if k in key_set:
-                        teacher_subset_dict[k] = True
-                    else:
-                        teacher_subset_dict[k] = False
-                log, _ = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
-                                                          teacher_dict=teacher_subset_dict)
-                logs[key_set] = log
+                subsets.append((key_set, {k: k in key_set for k in teachers_dict.keys()}))
         elif distill_target == 'single_teachers':
             for key in teachers_dict.keys():
                 if not teachers_dict[key]:
                     continue
-                teacher_subset_dict = {k: k == key for k in teachers_dict.keys()}
-                log, _ = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
-                                                          teacher_dict=teacher_subset_dict)
-                logs[(key,)] = log
+                subsets.append(((key,), {k: k == key for k in teachers_dict.keys()}))
         elif distill_target == 'single_teachers_none':  # TODO: modify things to wrk with all distill_targets
-            teacher_dict_list = [((), {k: False for k in teachers_dict.keys()})] 
+            subsets.append(((), {k: False for k in teachers_dict.keys()}))
             for key in teachers_dict.keys():
                 if not teachers_dict[key]:
                     continue
-                teacher_dict_list.append(((key,), {k: k == key for k in teachers_dict.keys()}))
-            full_loss = None
-            mixed_batch = False
-            for key_set, teacher_subset_dict in teacher_dict_list:
-                log, loss = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training,
-                                                                source=source, teacher_dict=teacher_subset_dict,
-                                                                backprop=not mixed_batch)
-                if full_loss is None:
-                    full_loss = loss
-                else:
-                    full_loss += loss
-                logs[key_set] = log
-            if is_training and mixed_batch:
-                optimizer = list(self.optimizer_dict.values())[0]  # All the same, so we can use any one
-                optimizer.zero_grad()
-                full_loss.backward()
-                optimizer.step()
-
+                subsets.append(((key,), {k: k == key for k in teachers_dict.keys()}))
         elif distill_target == 'all_teachers':
             key_set = tuple(set(keys))
             if len(key_set) > 1:
                 raise NotImplementedError
-            log, _ = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
-                                                      teacher_dict=teachers_dict)
-            logs[key_set] = log
+            subsets.append((key_set, teachers_dict))
         elif distill_target == 'no_teachers':
-            key_set = tuple(set())
-            teacher_subset_dict = {}
-            for k in teachers_dict.keys():
-                teacher_subset_dict[k] = False
-            log, _ = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
-                                                      teacher_dict=teacher_subset_dict)
+            subsets.append(((), {k: False for k in teachers_dict.keys()}))
+        return subsets
+
+    def preprocess_teacher_subsets(self, obss, teacher_subsets, rng=np.random):
+        """
+        Preprocess the observations for every teacher subset, with the same instruction dropout as
+        run_epoch_recurrence_one_batch, drawn from rng.
+        The observations are preprocessed once; the subsets share the obs and instr tensors and only differ in which
+        advice is masked out and whether the instr is dropped.
+        :return: dict mapping each key_set to the preprocessed observations
+        """
+        # The instruction mask is passed as an array, so the preprocessor doesn't draw from the global state
+        shared = self.preprocess_obs(obss, None, show_instrs=np.ones(len(obss), dtype=bool),
+                                     teacher_dicts=[teacher_dict for _, teacher_dict in teacher_subsets])
+        no_instr = None
+        preprocessed = {}
+        for (key_set, teacher_dict), obs in zip(teacher_subsets, shared):
+            instr_dropout_prob = 0 if np.sum(list(teacher_dict.values())) == 0 else self.instr_dropout_prob
+            if 'instr' in obs and not rng.uniform() > instr_dropout_prob:
+                if no_instr is None:
+                    no_instr = torch.zeros_like(obs.instr)
+                obs = DictList(dict(obs, instr=no_instr))
+            preprocessed[key_set] = obs
+        return preprocessed
+
+    def shared_trunk(self, teacher_subsets, preprocessed_obs, is_training=True):
+        """
+        Run each policy's trunk once per distinct instr tensor, for distill() to share across the teacher subsets.
+        :return: dict mapping each key_set to its trunk output
+        """
+        trunks = {}
+        cache = {}
+        for key_set, teacher_dict in teacher_subsets:
+            obs = preprocessed_obs[key_set]
+            acmodel = self.policy_dict[key_set[0] if len(key_set) > 0 else 'none']
+            cache_key = (id(acmodel), id(obs.instr) if 'instr' in obs else None)
+            if cache_key not in cache:
+                self.set_mode(is_training, acmodel, None)
+                cache[cache_key] = acmodel.forward_trunk(obs)
+            trunks[key_set] = cache[cache_key]
+        return trunks
+
+    def distill(self, demo_batch, is_training=True, source='agent', teachers_dict={}, distill_target='distill_powerset',
+                relabel=False, relabel_dict={}, distill_to_none=True, preprocessed=None):
+        """
+        :param preprocessed: optionally, the (preprocessed_batch, preprocessed_obs) of demo_batch, computed beforehand
+            with preprocess_batch and preprocess_teacher_subsets
+        """
+        if preprocessed is not None:
+            preprocessed_batch, preprocessed_obs = preprocessed
+        else:
+            preprocessed_batch, preprocessed_obs = self.preprocess_batch(demo_batch, source), {}
+        if relabel:
+            preprocessed_batch = self.relabel(preprocessed_batch, relabel_dict, source)
+
+        # Distill to the powerset of distillation types
+        logs = {}
+        if distill_target =='single_teachers_none' and not distill_to_none:
+            print('NOT distilling to none this itr')
+
+        full_loss = None
+        teacher_subsets = self.teacher_subsets(teachers_dict, distill_target, distill_to_none)
+        # With a shared trunk, all subsets are forwarded through the same parameters, so they take a single optimizer
+        # step on the summed loss rather than one step each. That's only possible when they all train one policy.
+        policies = {id(self.policy_dict[k[0] if len(k) > 0 else 'none']) for k, _ in teacher_subsets}
+        shared_trunk = getattr(self.args, 'shared_trunk_distill', False) and self.reconstructor_dict is None and \
+            len(teacher_subsets) > 0 and (not is_training or len(policies) == 1)
+        mixed_batch = shared_trunk and is_training
+        trunks = {}
+        if shared_trunk:
+            if len(preprocessed_obs) == 0:
+                preprocessed_obs = self.preprocess_teacher_subsets(preprocessed_batch[0], teacher_subsets)
+            trunks = self.shared_trunk(teacher_subsets, preprocessed_obs, is_training)
+        for key_set, teacher_subset_dict in teacher_subsets:
+            log, loss = self.run_epoch_recurrence_one_batch(preprocessed_batch, is_training=is_training, source=source,
+                                                            teacher_dict=teacher_subset_dict,
+                                                            backprop=not mixed_batch,
+                                                            preprocessed_obs=preprocessed_obs.get(key_set),
+                                                            trunk=trunks.get(key_set))
+            if mixed_batch:
+                full_loss = loss if full_loss is None else full_loss + loss
             logs[key_set] = log
+        if is_training and mixed_batch:
+            optimizer = list(self.optimizer_dict.values())[0]  # All the same, so we can use any one
+            optimizer.zero_grad()
+            full_loss.backward()
+            optimizer.step()
 
         if is_training:
             for scheduler in self.scheduler_dict.values():
@@ -3,6 +3,7 @@ import numpy as np
 from meta_mb.logger import logger
 from meta_mb.samplers.utils import rollout
 from babyai.utils.buffer import Buffer, trim_batch
+from babyai.utils.prefetch import BatchPrefetcher
 # from scripts.test_generalization import eval_policy, test_success
 import os.path as osp
 import joblib
@@ -10,7 +11,6 @@ import time
 import psutil
 import os
 import copy
-import random
 import pathlib
 
 
@@ -248,7 +248,8 @@ class Trainer(object):
                                                                            collect_reward=should_train_rl,
                                                                            train=should_train_rl,
                                                                            collection_dict=collection_dict)
-                raw_samples_data = copy.deepcopy(samples_data)
+                # optimize_policy and the buffer don't modify the batch, so a shallow copy is enough
+                raw_samples_data = copy.copy(samples_data)
                 try:
                     counts_train = buffer.counts_train[self.curriculum_step]
                 except:
@@ -338,9 +339,14 @@ class Trainer(object):
                 time_sampling_from_buffer = 0
                 time_train_distill = 0
                 time_val_distill = 0
+                prefetcher = self.make_prefetcher(buffer, teacher_distill_dict)
                 for dist_i in range(self.args.distillation_steps):
                     sample_start = time.time()
-                    sampled_batch = buffer.sample(total_num_samples=self.args.batch_size, split='train')
+                    if prefetcher is not None:
+                        sampled_batch, preprocessed = prefetcher.get()
+                    else:
+                        sampled_batch = buffer.sample(total_num_samples=self.args.batch_size, split='train')
+                        preprocessed = None
                     time_sampling_from_buffer += (time.time() - sample_start)
                     sample_start = time.time()
                     self.total_distillation_frames += len(sampled_batch)
@@ -348,7 +354,8 @@ class Trainer(object):
                                                is_training=True,
                                                teachers_dict=teacher_distill_dict,
                                                relabel=self.args.relabel,
-                                               relabel_dict=teacher_train_dict, distill_to_none=True)  # dist_i < 5)
+                                               relabel_dict=teacher_train_dict, distill_to_none=True,
+                                               preprocessed=preprocessed)  # dist_i < 5)
                     time_train_distill += (time.time() - sample_start)
                     if self.args.use_dagger:
                         sampled_dagger_batch = dagger_buffer.sample(total_num_samples=self.args.batch_size,
@@ -366,6 +373,9 @@ class Trainer(object):
                             for k, v in log_dict.items():
                                 logger.logkv(f'Distill/DAgger_{key_set}{k}_Train', v)
 
+                if prefetcher is not None:
+                    prefetcher.close()
+                    prefetcher.log_stats('Distill/')
                 for key_set, log_dict in distill_log.items():
                     key_set = '_'.join(key_set)
                     for k, v in log_dict.items():
@@ -599,7 +609,9 @@ class Trainer(object):
                 if self.curriculum_step >= len(self.env.train_levels):
                     break  # We've finished the curriculum!
                 try:
-                    self.sampler.advance_curriculum()
+                    # The trainer's curriculum leads; the sampler's envs are brought to its state
+                    self.env.advance_curriculum()
+                    self.sampler.sync_curriculum(self.env.get_curriculum_state())
                     self.algo.advance_curriculum()
                 except NotImplementedError:
                     # If we get a NotImplementedError b/c we ran out of levels, stop training
@@ -712,33 +724,54 @@ class Trainer(object):
 
             # Shuffle teachers
             sampled_batch = buffer.sample(total_num_samples=self.args.batch_size, split='val')
-            teacher_feedback = [obs_dict[teacher] for obs_dict in sampled_batch.obs]
-            random.shuffle(teacher_feedback)
-            for obs_dict, shuffled_obs in zip(sampled_batch.obs, teacher_feedback):
-                obs_dict[teacher] = shuffled_obs
+            teacher_feedback = getattr(sampled_batch.obs, teacher)
+            setattr(sampled_batch.obs, teacher, teacher_feedback[np.random.permutation(len(teacher_feedback))])
             log = self.il_trainer.distill(sampled_batch, source=self.args.source, is_training=False,
-                                          teachers_dict=teacher_subset_dict, distill_target='all')
+                                          teachers_dict=teacher_subset_dict, distill_target='all_teachers')
             log_dict = list(log.values())[0]
             logger.logkv(f"CheckTeachers/Shuffled_{teacher}_Accuracy", log_dict['Accuracy'])
 
             # CorrectTeacher, no inst
             sampled_batch = buffer.sample(total_num_samples=self.args.batch_size, split='val')
-            for obs_dict in sampled_batch.obs:
-                obs_dict['instr'] = [0] * len(obs_dict['instr'])
+            sampled_batch.obs.instr[:] = 0
             log = self.il_trainer.distill(sampled_batch, source=self.args.source, is_training=False,
-                                          teachers_dict=teacher_subset_dict, distill_target='all')
+                                          teachers_dict=teacher_subset_dict, distill_target='all_teachers')
             log_dict = list(log.values())[0]
             logger.logkv(f"CheckTeachers/NoInstr_{teacher}_Accuracy", log_dict['Accuracy'])
 
     def distill(self, samples, is_training=False, teachers_dict=None, source=None, relabel=False, relabel_dict={},
-                distill_to_none=True):
+                distill_to_none=True, preprocessed=None):
         if source is None:
             source = self.args.source
         log = self.il_trainer.distill(samples, source=source, is_training=is_training,
                                       teachers_dict=teachers_dict, distill_target=self.args.distillation_strategy,
-                                      relabel=relabel, relabel_dict=relabel_dict, distill_to_none=distill_to_none)
+                                      relabel=relabel, relabel_dict=relabel_dict, distill_to_none=distill_to_none,
+                                      preprocessed=preprocessed)
         return log
 
+    def make_prefetcher(self, buffer, teachers_dict):
+        """
+        Start sampling and preprocessing the training batches of a distillation phase in a background thread,
+        if args.prefetch_batches > 0. The buffer must not change until the prefetcher is closed.
+        """
+        if getattr(self.args, 'prefetch_batches', 0) <= 0:
+            return None
+        source = self.args.source
+        teacher_subsets = self.il_trainer.teacher_subsets(teachers_dict, self.args.distillation_strategy)
+        # The background thread has its own random state, so the batches don't depend on thread timing
+        rng = np.random.RandomState(np.random.randint(2 ** 31))
+
+        def sample_fn():
+            return buffer.sample(total_num_samples=self.args.batch_size, split='train', rng=rng)
+
+        def preprocess_fn(batch):
+            preprocessed_batch = self.il_trainer.preprocess_batch(batch, source)
+            preprocessed_obs = self.il_trainer.preprocess_teacher_subsets(batch.obs, teacher_subsets, rng)
+            return batch, (preprocessed_batch, preprocessed_obs)
+
+        return BatchPrefetcher(sample_fn, preprocess_fn, self.args.distillation_steps,
+                               queue_size=self.args.prefetch_batches)
+
     def run_supervised(self, policy, teacher_dict, tag, show_instrs):
         policy.eval()
         key_set = '_'.join([k for k, v in teacher_dict.items() if v])
@@ -122,7 +122,9 @@ def run_experiment(**config):
         args.accuracy_threshold_rollout_no_teacher = 0
     if original_saved_path is not None:
         env = rl2env(normalize(Curriculum(args.advance_curriculum_func, env=args.env, start_index=curriculum_step,
-                                          curriculum_type=args.curriculum_type, **arguments),
+                                          curriculum_type=args.curriculum_type,
+                                          task_pool_dir=getattr(args, 'task_pool_dir', None),
+                                          warm_next_level=getattr(args, 'warm_next_level', False), **arguments),
                                normalize_actions=args.act_norm, normalize_reward=args.rew_norm,
                                ), ceil_reward=args.ceil_reward)
         try:
@@ -143,8 +145,9 @@ def run_experiment(**config):
     else:
         optimizer = None
         env = rl2env(normalize(Curriculum(args.advance_curriculum_func, env=args.env, start_index=args.level,
-                                          curriculum_type=args.curriculum_type,
-                                          **arguments), normalize_actions=args.act_norm, normalize_reward=args.rew_norm)
+                                          curriculum_type=args.curriculum_type, task_pool_dir=args.task_pool_dir,
+                                          warm_next_level=args.warm_next_level, **arguments),
+                               normalize_actions=args.act_norm, normalize_reward=args.rew_norm)
                      , ceil_reward=args.ceil_reward)
         obs = env.reset()
         args.advice_size = sum([np.prod(obs[k].shape) for k in teacher_train_dict.keys() if k in obs])
@@ -6,9 +6,38 @@ Note: there are other automated tests in .circleci/config.yml
 """
 
 import babyai
-from babyai import levels
+import array_grid
+from babyai import levels, planning
+from babyai.levels import task_pool
+from babyai.rl.utils import benv
 
 # NOTE: please make sure that tests are always deterministic
 
 print('Testing levels, mission generation')
 levels.test()
+
+print('Testing the task pools against the tasks they were sampled from')
+task_pool.test()
+
+print('Testing the batched env against the levels it batches')
+benv.test()
+
+print('Testing ArrayGrid against Grid')
+array_grid.test()
+
+print('Testing the path planner against the BFS of the bot')
+planning.test()
+
+print('Testing the waypoint controller against its queue search')
+# d4rl_content needs mujoco, so it is only imported for its own test
+from d4rl_content.pointmaze import waypoint_controller
+waypoint_controller.test()
+
+print('Testing that warming the next level of a curriculum changes nothing')
+# The curricula import the d4rl envs, which need mujoco
+from babyai.levels import curriculum
+curriculum.test()
+
+print('Testing the sampler against the list-based sample processing')
+from meta_mb.samplers.meta_samplers import meta_sampler
+meta_sampler.test()
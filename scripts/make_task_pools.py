@@ -0,0 +1,41 @@
+"""
+Pre-generate the tasks of the babyai levels of the curriculum, so training can serve them from a pool
+(Curriculum(..., task_pool_dir=...)) instead of rejection sampling them at every reset.
+
+Takes the same level arguments as training (e.g. --leave_out_object, --reset_goal), since a pool is only used by
+levels with the settings it was sampled with.
+"""
+import pathlib
+import time
+
+from babyai.arguments import ArgumentParser
+from babyai.levels.curriculum import Curriculum
+from babyai.levels.task_pool import TaskPool
+
+parser = ArgumentParser()
+parser.add_argument("--save_path", required=True, type=str)
+parser.add_argument("--levels", nargs='+', default=None, type=int, help="curriculum indices (default: all)")
+parser.add_argument("--start_seed", default=0, type=int)
+parser.add_argument("--num_tasks", default=10000, type=int)
+parser.add_argument("--num_workers", default=4, type=int)
+args = parser.parse_args()
+
+# The level arguments of training which change the tasks
+arguments = {
+    "start_loc": 'all',
+    "include_holdout_obj": not args.leave_out_object,
+    "persist_goal": not args.reset_goal,
+    "persist_objs": not args.reset_objs,
+    "persist_agent": not args.reset_agent,
+}
+base_path = pathlib.Path(args.save_path)
+curriculum = Curriculum('one_hot', env='babyai', **arguments)
+levels = args.levels if args.levels is not None else range(len(curriculum.levels_list))
+for index in levels:
+    curriculum.set_wrapped_env(index)
+    level = curriculum.levels_list[index]
+    start = time.time()
+    pool = TaskPool.generate(level, args.start_seed, args.num_tasks, num_workers=args.num_workers)
+    path = base_path.joinpath(f'{type(level).__name__}.pkl')
+    pool.save(path)
+    print(f'{index} {type(level).__name__}: {len(pool)} tasks in {time.time() - start:.1f}s -> {path}')
@@ -6,10 +6,14 @@ import numpy as np
 import argparse
 import pathlib
 import time
+from multiprocessing import Pool
+
+import torch
 
 from meta_mb.samplers.utils import rollout
 from meta_mb.logger import logger
 from babyai.utils.obs_preprocessor import make_obs_preprocessor
+from babyai.evaluate import batch_evaluate_policy
 from babyai.levels.curriculum import Curriculum
 from meta_mb.meta_envs.rl2_env import rl2env
 from meta_mb.envs.normalized_env import normalize
@@ -45,12 +49,7 @@ def load_policy(path):
     return policy, env, args, saved_model
 
 
-def eval_policy(env, policy, save_dir, num_rollouts, teachers, hide_instrs, stochastic, args, seed=0,
-                video_name='generalization_vids', num_save=20):
-    if not save_dir.exists():
-        save_dir.mkdir()
-    env.seed(seed)
-    env.reset()
+def make_eval_preprocessor(env, teachers, args):
     if teachers == ['all']:
         teacher_dict = {f: True for f in env.feedback_type}
     elif teachers == ['none']:
@@ -62,6 +61,16 @@ def eval_policy(env, policy, save_dir, num_rollouts, teachers, hide_instrs, stoc
     except Exception as e:
         teacher_null_dict = {}
     obs_preprocessor = make_obs_preprocessor(teacher_null_dict, include_zeros=args.include_zeros)
+    return teacher_dict, obs_preprocessor
+
+
+def eval_policy(env, policy, save_dir, num_rollouts, teachers, hide_instrs, stochastic, args, seed=0,
+                video_name='generalization_vids', num_save=20):
+    if not save_dir.exists():
+        save_dir.mkdir()
+    env.seed(seed)
+    env.reset()
+    teacher_dict, obs_preprocessor = make_eval_preprocessor(env, teachers, args)
     policy.eval()
     policy.whatever = "WORKING"
     paths, accuracy, stoch_accuracy, det_accuracy, reward = rollout(env, policy,
@@ -98,6 +107,56 @@ def eval_policy(env, policy, save_dir, num_rollouts, teachers, hide_instrs, stoc
     return success_rate, stoch_accuracy, det_accuracy, reward
 
 
+def eval_policy_batched(env, policy, num_rollouts, teachers, hide_instrs, stochastic, args, seed=0, num_envs=64,
+                        temperature=1):
+    """
+    Like eval_policy, but the rollouts are played num_envs at a time with batched policy inference, and no videos are
+    saved. Episodes of seed s use task seeds s * num_rollouts, ..., (s + 1) * num_rollouts - 1.
+    :return: success_rate, stoch_accuracy, det_accuracy, reward and the per-episode logs
+    """
+    env.seed(seed)
+    env.reset()
+    teacher_dict, obs_preprocessor = make_eval_preprocessor(env, teachers, args)
+    logs = batch_evaluate_policy(policy, env, seed * num_rollouts, num_rollouts, obs_preprocessor, teacher_dict,
+                                 show_instrs=not hide_instrs, stochastic=stochastic, temperature=temperature,
+                                 num_envs=num_envs)
+    count = np.sum(logs['num_frames_per_episode'])
+    success_rate = np.mean(logs['success_per_episode'])
+    stoch_accuracy = np.sum(logs['stoch_correct_per_episode']) / count
+    det_accuracy = np.sum(logs['det_correct_per_episode']) / count
+    reward = np.sum(logs['return_per_episode']) / count
+    return success_rate, stoch_accuracy, det_accuracy, reward, logs
+
+
+# Policies already loaded by this (worker) process, by path
+loaded_policies = {}
+
+
+def init_eval_worker():
+    # Workers run side by side, so they shouldn't each use all the cores
+    torch.set_num_threads(1)
+
+
+def eval_job(policy_path, policy_name, env, env_name, seed, target_key, hide_instrs, stochastic, num_rollouts,
+             num_envs, temperature):
+    """
+    Evaluate one (policy, env, seed) combination of the grid. Runs in the pool's worker processes.
+    """
+    if policy_path not in loaded_policies:
+        policy, _, args, _ = load_policy(policy_path)
+        loaded_policies[policy_path] = (policy, args)
+    policy, args = loaded_policies[policy_path]
+    set_seed(seed)
+    success_rate, stoch_accuracy, det_accuracy, reward, logs = eval_policy_batched(
+        env, policy[target_key], num_rollouts, [target_key], hide_instrs, stochastic, args, seed=seed,
+        num_envs=num_envs, temperature=temperature)
+    return policy_name, env_name, seed, (success_rate, stoch_accuracy, det_accuracy, reward), logs
+
+
+def eval_job_star(job):
+    return eval_job(*job)
+
+
 def make_log_fn(env, args, start_num_feedback, save_dir, teacher, hide_instrs, seed=1, stochastic=True,
                 num_rollouts=10, policy_name='policy', env_name='env', log_every=10):
     start = time.time()
@@ -382,6 +441,42 @@ def test_success_checkpoint(env, save_dir, num_rollouts, teachers, policy=None,
     return success_rate, stoch_accuracy, det_accuracy, reward
 
 
+def eval_grid(args, save_dir, policy_path, policy_level_names, envs):
+    """
+    Evaluate every policy on every env and seed without finetuning, splitting the grid across args.num_workers
+    processes. Results are written as each combination finishes: one summary row per combination in results.csv and
+    one row per episode in episodes.csv.
+    """
+    jobs = [(str(policy_path.joinpath(policy_name)), policy_path.stem, env, str(env_index), seed,
+             args.target_policy_key, args.hide_instrs, not args.deterministic, args.num_rollouts, args.eval_envs,
+             args.rollout_temperature)
+            for policy_name in policy_level_names for env, env_index in envs for seed in args.seeds]
+    with open(save_dir.joinpath('episodes.csv'), 'w') as f:
+        f.write('policy_env,policy,env,seed,episode_seed,success,return,num_frames,stoch_correct,det_correct\n')
+
+    def write_results(result):
+        policy_name, env_name, seed, (success_rate, stoch_accuracy, det_accuracy, reward), logs = result
+        policy_env_name = f'Policy{policy_name}-{env_name}'
+        print(f"{policy_env_name} seed {seed} finished with success: {success_rate}, stoch acc: {stoch_accuracy}, "
+              f"det acc: {det_accuracy}, reward: {reward}")
+        with open(save_dir.joinpath('results.csv'), 'a') as f:
+            f.write(
+                f'{policy_env_name},{policy_name},{env_name},{success_rate},{stoch_accuracy},{det_accuracy},{reward} \n')
+        with open(save_dir.joinpath('episodes.csv'), 'a') as f:
+            for row in zip(logs['seed_per_episode'], logs['success_per_episode'], logs['return_per_episode'],
+                           logs['num_frames_per_episode'], logs['stoch_correct_per_episode'],
+                           logs['det_correct_per_episode']):
+                f.write(f'{policy_env_name},{policy_name},{env_name},{seed},' + ','.join(str(x) for x in row) + '\n')
+
+    if args.num_workers == 0:
+        for job in jobs:
+            write_results(eval_job(*job))
+    else:
+        with Pool(args.num_workers, initializer=init_eval_worker) as pool:
+            for result in pool.imap_unordered(eval_job_star, jobs):
+                write_results(result)
+
+
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--policy", required=True)
@@ -428,6 +523,11 @@ def main():
     parser.add_argument('--static_env', action='store_true')
     parser.add_argument('--early_stop', type=int, default=None)
     parser.add_argument('--early_stop_metric', type=str, default=None)
+    parser.add_argument('--eval_envs', type=int, default=0,
+                        help="if > 0 and not finetuning, play this many rollouts at once with batched inference "
+                             "(no videos)")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="processes the (policy, env, seed) grid is split across when --eval_envs > 0")
     args = parser.parse_args()
     set_seed(args.seeds[0])
 
@@ -560,6 +660,9 @@ def main():
         save_dir.mkdir()
     with open(save_dir.joinpath('results.csv'), 'w') as f:
         f.write('policy_env,policy,env,success_rate,stoch_accuracy,det_accuracy,reward \n')
+    if args.eval_envs > 0 and args.finetune_itrs == 0:
+        eval_grid(args, save_dir, policy_path, policy_level_names, envs)
+        return
     for policy_name in policy_level_names:
         for env, env_index in envs:
             inner_env = env